@@ -1,13 +1,12 @@
 import logging
+import threading
 
 from abc import ABC
-from time import sleep
-import RPi.GPIO as GPIO
-from picamera import PiCamera
-from datetime import datetime
-from settings import IMAGES_FOLDER
-
-logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+import backends
+import instrumentation
+from camera_service import CameraCaptureService
+from gpio_bank import OutputBank
+from settings import FLASH_BACKEND
 
 
 class ActuatorsConfigurationException(Exception):
@@ -22,6 +21,11 @@ class Actuator(ABC):
     status = None
     # id = None
     label = None
+    # Momentary actuators (e.g. a camera) perform an action on every trigger
+    # instead of holding a state, so they are never skipped as no-ops
+    momentary = False
+    # Slow actions (e.g. a capture) run on the scheduler's heavy executor
+    heavy = False
 
     def __init__(self, label, status=0):
         # self.id = id
@@ -35,7 +39,8 @@ class Actuator(ABC):
         return str(self)
 
     def trigger(self, value):
-        self.execute_action(value)
+        with instrumentation.timed("actuator_trigger_seconds", actuator=self.label):
+            self.execute_action(value)
         self.status = value
 
     def execute_action(self, value):
@@ -46,18 +51,46 @@ class Actuator(ABC):
 
 
 class ActuatorsControl:
-    actuators = []
-    actuators_map: dict[str, Actuator] = {}
-
-    def __init__(self):
-        pass
-
-    def from_actions(self, actions):
-        for action in actions:
-            actuator = action["actuator"]
-            actuator_id = id(actuator)
-            if actuator_id not in self.actuators_map.keys():
-                self.actuators_map[actuator_id] = actuator
+    # Actuators are keyed by their label, which stays the same across
+    # restarts and is what schedules refer to
+    actuators_map: dict[str, Actuator] = None
+
+    def __init__(self, actuators=()):
+        self.actuators_map = {}
+        self.listeners = []
+        # While tripped (a latched fault) the actuators are held off, and
+        # the last state requested for each is kept for release()
+        self.tripped = False
+        self._held = {}
+        # Steps, climate ticks, RPCs and the supervisor change the state from
+        # their own threads: the diff and the bank writes are done under it
+        self._lock = threading.RLock()
+        for actuator in actuators:
+            self.add(actuator)
+
+    def subscribe(self, callback):
+        # callback(label, status) is called when an actuator (other than a
+        # momentary one) changes status, outside of the lock: it may be
+        # slow (e.g. the history writing to the SD card)
+        self.listeners.append(callback)
+
+    def _notify(self, changes):
+        for label, value in changes:
+            for callback in self.listeners:
+                try:
+                    callback(label, value)
+                except Exception:
+                    logging.error("Actuator listener failed", exc_info=True)
+
+    def add(self, actuator):
+        existing = self.actuators_map.get(actuator.label)
+        if existing is None:
+            self.actuators_map[actuator.label] = actuator
+        elif existing is not actuator:
+            raise ActuatorsConfigurationException(
+                f"Another actuator is already labelled {actuator.label}"
+            )
+        return actuator.label
 
     # def execute_actions(self, actions):
     #     logging.info(f"Executing actions")
@@ -72,20 +105,140 @@ class ActuatorsControl:
     #         f'Switching actuator {self._actuator_name(action["id"])} to {action["status"]}'
     #     )
 
+    def _get_actuator(self, actuator_id):
+        actuator = self.actuators_map.get(actuator_id)
+        if not actuator:
+            raise ActuatorsTriggerException(
+                f"Actuator with id {actuator_id} not found. Available actuators: {list(self.actuators_map.keys())}"
+            )
+        return actuator
+
     def trigger_actuators(self, actions):
-        for action in actions:
-            actuator_id = action["actuator_id"]
-            value = action["status"]
-            actuator = self.actuators_map.get(actuator_id)
-            if not actuator:
-                raise ActuatorsTriggerException(
-                    f"Actuator with id {actuator_id} not found. Available actuators: {self.actuators_map.keys()}"
-                )
+        # Only the listed actuators are changed
+        with instrumentation.timed("trigger_actuators_seconds"):
+            self.apply_state(
+                {action["actuator_id"]: action["status"] for action in actions}
+            )
+
+    def apply_step(self, step_state: dict, keep=()):
+        # Every relay status defaults to 0: the actuators that are not listed
+        # in a schedule step are switched off.
+        # Actuators in `keep` (e.g. driven by the climate controller) are left as they are.
+        state = {
+            actuator_id: 0
+            for actuator_id, actuator in self.actuators_map.items()
+            if not actuator.momentary
+        }
+        state.update(step_state)
+        for actuator_id in keep:
+            state.pop(actuator_id, None)
+        self.apply_state(state)
+
+    def apply_state(self, state: dict, force=False):
+        """
+        Brings the actuators to the given {actuator_id: status} state.
+
+        Actuators already in the requested state are left alone, unless
+        `force`, and the relays that change are written with one batch per
+        output bank. While tripped, the actuators are only switched off.
+        """
+        with self._lock:
+            if self.tripped:
+                state = dict(state)
+                for actuator_id, value in state.items():
+                    if not self._get_actuator(actuator_id).momentary:
+                        self._held[actuator_id] = value
+                        state[actuator_id] = 0
+            momentary, changes = self._apply(state, force)
+        # Outside of the lock, as a capture takes seconds
+        self._notify(changes)
+        for actuator, value in momentary:
             actuator.trigger(value)
 
-    def reset_actuators(self):
-        for _, actuator in self.actuators_map.items():
-            actuator.trigger(value=0)
+    def _apply(self, state, force):
+        # Returns the momentary actuators to trigger and the (label, status)
+        # changes to notify
+        banks = {}
+        momentary = []
+        changes = []
+        for actuator_id, value in state.items():
+            actuator = self._get_actuator(actuator_id)
+            if actuator.momentary:
+                if value:
+                    momentary.append((actuator, value))
+                continue
+            if actuator.status == value and not force:
+                continue
+            changed = actuator.status != value
+            if isinstance(actuator, RelayActuator):
+                banks.setdefault(actuator.bank, []).append((actuator, value))
+            else:
+                actuator.trigger(value)
+                if changed:
+                    changes.append((actuator_id, value))
+
+        for bank, relays in banks.items():
+            logging.info(
+                "Switching "
+                + ", ".join(f"{actuator.label} to {value}" for actuator, value in relays)
+            )
+            with instrumentation.timed("gpio_write_seconds"):
+                bank.set_values({actuator.pin: value for actuator, value in relays})
+            for actuator, value in relays:
+                changed = actuator.status != value
+                actuator.status = value
+                if changed:
+                    changes.append((actuator.label, value))
+        return momentary, changes
+
+    def reset_actuators(self, force=False):
+        # `force` writes every relay, whatever its last known status
+        self.apply_state(
+            {actuator_id: 0 for actuator_id in self.actuators_map}, force=force
+        )
+
+    def trip(self):
+        """
+        Switches every actuator off and holds them off, whatever the schedule
+        or the climate controller request, until `release()`.
+        """
+        with self._lock:
+            if not self.tripped:
+                logging.critical("Actuators tripped, holding them off")
+                self._held = {
+                    actuator_id: actuator.status
+                    for actuator_id, actuator in self.actuators_map.items()
+                    if not actuator.momentary
+                }
+            self.tripped = True
+            _, changes = self._apply(
+                {actuator_id: 0 for actuator_id in self.actuators_map}, True
+            )
+        self._notify(changes)
+
+    def force_off(self):
+        """
+        Writes every relay off without taking the locks, for the supervisor
+        when `trip()` is stuck. The statuses are not updated.
+        """
+        banks = {
+            actuator.bank
+            for actuator in self.actuators_map.values()
+            if isinstance(actuator, RelayActuator)
+        }
+        for bank in banks:
+            bank.force_off()
+
+    def release(self):
+        # Back to the state last requested while tripped
+        with self._lock:
+            if not self.tripped:
+                return
+            self.tripped = False
+            held, self._held = self._held, {}
+        logging.warning("Actuators released, restoring %s", held)
+        # A trip in between holds them off again
+        self.apply_state(held)
 
 
 class DummyActuator(Actuator):
@@ -93,59 +246,65 @@ class DummyActuator(Actuator):
         super().__init__(label, status)
 
     def execute_action(self, value):
-        logging.info(f"Switching actuator {self.label} to {value}")
+        logging.info("Switching actuator %s to %s", self.label, value)
+
+
+class RelayActuator(Actuator):
+    """
+    A relay on a pin of an OutputBank. ActuatorsControl groups the changes
+    of all the relays of a bank into a single write.
+    """
+
+    def __init__(self, label, pin, bank: OutputBank, status=0):
+        super().__init__(label, status)
+        self.pin = pin
+        self.bank = bank
+
+    def execute_action(self, value):
+        logging.info("Switching relay %s to %s", self.label, value)
+        self.bank.set_values({self.pin: value})
 
 
 class CameraActuator(Actuator):
+    momentary = True
+    heavy = True
     flash_pin = None
+    service: CameraCaptureService = None
 
-    def __init__(self, label, status=0, flash_pin=None):
+    def __init__(
+        self, label, status=0, flash_pin=None, service=None, flash_backend=FLASH_BACKEND
+    ):
         super().__init__(label, status)
+        # The camera is opened on the first picture and kept open
+        self.service = service
 
         if flash_pin:
             self.flash_pin = flash_pin
-            GPIO.setmode(GPIO.BCM)
-            # removing the warings
-            GPIO.setwarnings(False)
-            # setting the mode for all pins so all will be switched on
-            GPIO.setup(self.flash_pin, GPIO.OUT)
+            # The flash is switched on by pulling the pin low
+            self.flash = backends.create(
+                "gpio", flash_backend, [flash_pin], active_low=True
+            )
             self.flash_off()
 
     def flash_off(self):
         if self.flash_pin:
             logging.info("De-activating flash")
-            GPIO.output(self.flash_pin, GPIO.HIGH)
+            self.flash.set_values({self.flash_pin: 0})
 
     def flash_on(self):
         if self.flash_pin:
             logging.info("Activating flash")
-            GPIO.output(self.flash_pin, GPIO.LOW)
+            self.flash.set_values({self.flash_pin: 1})
 
     def take_picture(self):
-        try:
-            with PiCamera() as camera:
-                if self.flash_pin:
-                    self.flash_on()
-                    sleep(2)
-                current_td = datetime.now().strftime("%Y_%m_%d-%I_%M_%S_%p")
-                # Set ISO to the desired value
-                camera.iso = 600
-                # Wait for the automatic gain control to settle
-                sleep(2)
-                # Now fix the values
-                camera.shutter_speed = camera.exposure_speed
-                camera.exposure_mode = "off"
-                g = camera.awb_gains
-                camera.awb_mode = "off"
-                camera.awb_gains = g
-                # Finally, take a photo with the fixed settings
-                image_name = f"{IMAGES_FOLDER}/image_{current_td}.jpg"
-                camera.capture(image_name)
-
-        finally:
-            logging.info("Deactivating the flash")
-            if self.flash_pin:
-                self.flash_off()
+        if self.service is None:
+            self.service = CameraCaptureService()
+        if self.flash_pin:
+            image = self.service.capture(self.flash_on, self.flash_off)
+        else:
+            image = self.service.capture()
+        logging.info(f"Captured {image.name}")
+        return image
 
     def execute_action(self, value):
         if value == 1:
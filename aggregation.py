@@ -0,0 +1,155 @@
+"""
+Streaming aggregation of the temperature/humidity readings.
+
+Every reading of the SensorAcquisitionEngine goes through a SensorAggregator,
+which keeps a small ring buffer of the last accepted values and running
+statistics over the current window, in fixed memory per sensor. Readings
+out of the sensor range or too far from the recent median are rejected.
+
+`collect()` returns the min, max, mean and EMA of each sensor over the
+window, plus the dewpoint, and starts a new window.
+"""
+import math
+import threading
+
+from settings import (
+    AGGREGATION_BUFFER_SIZE,
+    AGGREGATION_EMA_ALPHA,
+    AGGREGATION_OUTLIER_THRESHOLD,
+)
+
+# DHT22 measurement range
+LIMITS = {"temperature": (-40.0, 80.0), "humidity": (0.0, 100.0)}
+# Smallest deviation ever considered an outlier, as a DHT22 often repeats
+# the same value, which would make the spread of the buffer zero
+MIN_DEVIATION = {"temperature": 1.0, "humidity": 3.0}
+
+
+def dewpoint(temperature, humidity):
+    # Magnus formula, within 0.4C between -40C and 50C
+    if humidity <= 0:
+        return None
+    b, c = 17.62, 243.12
+    gamma = math.log(humidity / 100) + b * temperature / (c + temperature)
+    return c * gamma / (b - gamma)
+
+
+class Channel:
+    """
+    Running statistics of one measured quantity of a sensor.
+    """
+
+    def __init__(self, name, buffer_size, ema_alpha, outlier_threshold) -> None:
+        self.name = name
+        self.low, self.high = LIMITS[name]
+        self.min_deviation = MIN_DEVIATION[name]
+        self.ema_alpha = ema_alpha
+        self.outlier_threshold = outlier_threshold
+        self.buffer = [0.0] * buffer_size
+        self.size = 0
+        self.position = 0
+        self.ema = None
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def clear(self):
+        # Forgets the recent values, the next ones start a new buffer
+        self.size = 0
+        self.position = 0
+        self.ema = None
+
+    def accepts(self, value):
+        if value is None or math.isnan(value) or not self.low <= value <= self.high:
+            return False
+        if self.size < 3:
+            return True
+        # Median absolute deviation of the recent values
+        recent = sorted(self.buffer[: self.size])
+        median = recent[self.size // 2]
+        spread = sorted(abs(x - median) for x in recent)[self.size // 2]
+        return abs(value - median) <= max(
+            self.outlier_threshold * spread, self.min_deviation
+        )
+
+    def add(self, value):
+        self.buffer[self.position] = value
+        self.position = (self.position + 1) % len(self.buffer)
+        self.size = min(self.size + 1, len(self.buffer))
+
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if self.ema is None:
+            self.ema = value
+        else:
+            self.ema += self.ema_alpha * (value - self.ema)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+
+class SensorAggregator:
+    def __init__(
+        self,
+        buffer_size=AGGREGATION_BUFFER_SIZE,
+        ema_alpha=AGGREGATION_EMA_ALPHA,
+        outlier_threshold=AGGREGATION_OUTLIER_THRESHOLD,
+    ) -> None:
+        self.temperature = Channel(
+            "temperature", buffer_size, ema_alpha, outlier_threshold
+        )
+        self.humidity = Channel("humidity", buffer_size, ema_alpha, outlier_threshold)
+        self.rejected = 0
+        self._consecutive_rejections = 0
+        self._lock = threading.Lock()
+
+    def add(self, temperature, humidity):
+        with self._lock:
+            if self._consecutive_rejections >= len(self.temperature.buffer) // 2:
+                # The values really changed (e.g. after a long failure),
+                # restart from the new ones
+                self.temperature.clear()
+                self.humidity.clear()
+            # A reading is kept or rejected as a whole
+            if self.temperature.accepts(temperature) and self.humidity.accepts(
+                humidity
+            ):
+                self.temperature.add(temperature)
+                self.humidity.add(humidity)
+                self._consecutive_rejections = 0
+                return True
+            self.rejected += 1
+            self._consecutive_rejections += 1
+            return False
+
+    def collect(self, label):
+        """
+        Telemetry of the current window, e.g. `temperature_Top` (mean),
+        `temperature_Top_min`, `dewpoint_Top`, and starts a new window.
+        Nothing is returned for a window without any accepted reading.
+        """
+        with self._lock:
+            telemetry = {}
+            if self.temperature.count:
+                for channel in (self.temperature, self.humidity):
+                    key = f"{channel.name}_{label}"
+                    telemetry[key] = round(channel.mean, 2)
+                    telemetry[f"{key}_min"] = channel.min
+                    telemetry[f"{key}_max"] = channel.max
+                    telemetry[f"{key}_ema"] = round(channel.ema, 2)
+                point = dewpoint(self.temperature.mean, self.humidity.mean)
+                telemetry[f"dewpoint_{label}"] = round(point, 2) if point is not None else None
+                telemetry[f"readings_{label}"] = self.temperature.count
+            if self.rejected:
+                telemetry[f"rejected_{label}"] = self.rejected
+            self.temperature.reset()
+            self.humidity.reset()
+            self.rejected = 0
+            return telemetry
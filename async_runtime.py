@@ -0,0 +1,115 @@
+import asyncio
+import signal
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from job_dispatch import phase_offset
+from settings import EXECUTOR_WORKERS, SAMPLING_INTERVAL
+
+
+class AsyncRuntime:
+    """
+    Runs the sampling/publishing of every ThingsBoardDevice on its own cadence.
+
+    Each device gets a task that wakes up on a fixed grid
+    (start + phase + n * interval, the phase spreading the devices over the
+    interval), so the time spent publishing does not make the
+    loop drift, and a slow device does not delay the others. The blocking
+    device calls run in a bounded thread pool.
+
+    SIGINT and SIGTERM stop the tasks, then stop the ScheduleControl
+    (which resets the actuators) and disconnect the devices.
+
+    With a Supervisor, every completed device cycle is an
+    "uplink-<device name>" heartbeat.
+    """
+
+    def __init__(
+        self,
+        devices,
+        schedule_control=None,
+        max_workers=EXECUTOR_WORKERS,
+        supervisor=None,
+    ) -> None:
+        self.devices = [device for device in devices if device]
+        self.schedule_control = schedule_control
+        self.supervisor = supervisor
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="device"
+        )
+        self._stopping = None
+
+    def run(self):
+        asyncio.run(self.main())
+
+    def stop(self):
+        if self._stopping is not None:
+            self._stopping.set()
+
+    async def main(self):
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self._on_signal, signum)
+
+        tasks = [
+            asyncio.create_task(self._device_loop(device), name=device.name)
+            for device in self.devices
+        ]
+        try:
+            await self._stopping.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self._shutdown(loop)
+
+    def _on_signal(self, signum):
+        logging.info(f"Received {signal.Signals(signum).name}, exiting gracefully")
+        self._stopping.set()
+
+    async def _shutdown(self, loop):
+        if self.supervisor:
+            # The heartbeats stop with the scheduler
+            await loop.run_in_executor(self.executor, self.supervisor.stop)
+        if self.schedule_control:
+            # Safely turn all relays off
+            await loop.run_in_executor(self.executor, self.schedule_control.stop)
+        for device in self.devices:
+            try:
+                await loop.run_in_executor(self.executor, device.disconnect)
+            except Exception:
+                logging.error(f"Failed disconnecting {device.name}", exc_info=True)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _device_loop(self, device):
+        loop = asyncio.get_running_loop()
+        # Devices publish at their own phase of the interval, not together
+        interval = getattr(device, "sampling_interval", SAMPLING_INTERVAL)
+        next_run = loop.time() + phase_offset(f"publish-{device.name}", interval)
+        await asyncio.sleep(next_run - loop.time())
+        while True:
+            # Read on every cycle, it can be changed live from ThingsBoard
+            interval = getattr(device, "sampling_interval", SAMPLING_INTERVAL)
+            try:
+                await loop.run_in_executor(self.executor, self._cycle, device)
+            except Exception:
+                logging.error("Failed publishing %s", device.name, exc_info=True)
+            else:
+                if self.supervisor:
+                    self.supervisor.beat(f"uplink-{device.name}")
+
+            next_run += interval
+            now = loop.time()
+            if next_run < now:
+                # The cycle took longer than the interval: skip the missed
+                # slots but stay on the same grid
+                skipped = int((now - next_run) // interval) + 1
+                logging.warning("%s overran %d interval(s)", device.name, skipped)
+                next_run += skipped * interval
+            await asyncio.sleep(next_run - now)
+
+    @staticmethod
+    def _cycle(device):
+        device.sample()
+        device.flush()
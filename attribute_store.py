@@ -0,0 +1,108 @@
+"""
+Typed store of the shared attributes of a device.
+
+Each attribute is declared with its default value, whose type is the
+attribute type. Updates from ThingsBoard are converted to that type and
+diffed against the current values, and only the subscribers of the keys
+that actually changed are called, with (key, old value, new value). A
+subscriber rejects a value by raising, the attribute then keeps its old one:
+
+    store = AttributeStore({"samplingInterval": 30})
+    store.subscribe("samplingInterval", lambda key, old, new: ...)
+    store.update({"samplingInterval": "60"})
+"""
+import logging
+import threading
+
+
+class AttributeStore:
+    def __init__(self, schema: dict = None) -> None:
+        self.types = {}
+        self.values = {}
+        self._subscribers: dict[str, list] = {}
+        self._lock = threading.Lock()
+        for key, default in (schema or {}).items():
+            self.declare(key, default)
+
+    def declare(self, key, default):
+        # The "states" format of ThingsBoardDevice: {"key": {"value": default}}
+        if isinstance(default, dict) and "value" in default:
+            default = default["value"]
+        self.types[key] = type(default) if default is not None else None
+        self.values[key] = default
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def keys(self):
+        return list(self.values)
+
+    def subscribe(self, keys, callback):
+        if isinstance(keys, str):
+            keys = [keys]
+        for key in keys:
+            if key not in self.values:
+                raise KeyError(f"Unknown attribute {key}")
+            self._subscribers.setdefault(key, []).append(callback)
+
+    def _convert(self, key, value):
+        kind = self.types[key]
+        if kind is None or value is None or isinstance(value, kind):
+            return value
+        if kind is bool and isinstance(value, str):
+            return value.lower() in ("1", "true", "yes", "on")
+        return kind(value)
+
+    def update(self, values: dict):
+        """
+        Applies the known attributes of `values` and notifies their
+        subscribers. Returns the {key: (old, new)} changes.
+        """
+        changes = {}
+        with self._lock:
+            for key, value in values.items():
+                if key not in self.values:
+                    logging.debug("Ignoring unknown attribute %s", key)
+                    continue
+                try:
+                    value = self._convert(key, value)
+                except (TypeError, ValueError):
+                    logging.warning(
+                        "Invalid value %r for attribute %s, expected %s",
+                        value,
+                        key,
+                        self.types[key].__name__,
+                    )
+                    continue
+                old = self.values[key]
+                if value != old:
+                    self.values[key] = value
+                    changes[key] = (old, value)
+
+        # Called outside of the lock, so callbacks can read the store
+        for key, (old, new) in list(changes.items()):
+            logging.info("Attribute %s changed from %s to %s", key, old, new)
+            for callback in self._subscribers.get(key, ()):
+                try:
+                    callback(key, old, new)
+                except Exception:
+                    logging.error(
+                        "Failed applying attribute %s, keeping %s",
+                        key,
+                        old,
+                        exc_info=True,
+                    )
+                    # A rejected value is not kept, so the store matches
+                    # the device and the same value is tried again if resent
+                    with self._lock:
+                        if self.values[key] == new:
+                            self.values[key] = old
+                    del changes[key]
+                    break
+        return changes
@@ -0,0 +1,98 @@
+"""
+Registry of the hardware backends.
+
+Backends are registered by kind and name with a "module:attribute"
+reference, and the module is only imported the first time the backend is
+used. The controller can therefore start without the libraries of the
+backends it does not use (e.g. off-Pi), and does not pay their import time
+at startup.
+
+    create("sensor", "dht22", "D5")
+    register("mqtt", "my_broker", "my_module:MyClient")
+"""
+import importlib
+import os
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+_registry: dict[tuple[str, str], object] = {}
+# Re-entrant so that a backend module can register others while imported
+_lock = threading.RLock()
+
+
+class BackendNotFound(Exception):
+    pass
+
+
+def register(kind, name, target):
+    """
+    `target` is either the factory itself or a "module:attribute" string
+    resolved on first use.
+    """
+    with _lock:
+        _registry[(kind, name)] = target
+
+
+def available(kind):
+    return sorted(name for registered_kind, name in _registry if registered_kind == kind)
+
+
+def get(kind, name):
+    with _lock:
+        try:
+            target = _registry[(kind, name)]
+        except KeyError:
+            raise BackendNotFound(
+                f"No {kind} backend named '{name}'. Available backends: {available(kind)}"
+            )
+        if isinstance(target, str):
+            module_name, _, attribute = target.partition(":")
+            target = getattr(importlib.import_module(module_name), attribute)
+            _registry[(kind, name)] = target
+        return target
+
+
+def create(kind, name, *args, **kwargs):
+    return get(kind, name)(*args, **kwargs)
+
+
+def dht22_sensor(pin):
+    import adafruit_dht
+    import board
+
+    # Pins can be given by name, e.g. "D5"
+    if isinstance(pin, str):
+        pin = getattr(board, pin)
+    return adafruit_dht.DHT22(pin, use_pulseio=False)
+
+
+def thingsboard_client(access_token):
+    from tb_gateway_mqtt import TBDeviceMqttClient
+
+    return TBDeviceMqttClient(
+        os.getenv("THINGSBOARD_SERVER"),
+        int(os.getenv("THINGSBOARD_PORT")),
+        access_token,
+    )
+
+
+def thingsboard_gateway_client(access_token):
+    from tb_gateway_mqtt import TBGatewayMqttClient
+
+    return TBGatewayMqttClient(
+        os.getenv("THINGSBOARD_SERVER"),
+        int(os.getenv("THINGSBOARD_PORT")),
+        access_token,
+    )
+
+
+register("sensor", "dht22", "backends:dht22_sensor")
+register("gpio", "gpiod", "gpio_bank:GpiodOutputBank")
+register("gpio", "rpi_gpio", "gpio_bank:RPiGPIOOutputBank")
+register("gpio", "fake", "gpio_bank:FakeOutputBank")
+register("camera", "picamera", "picamera:PiCamera")
+register("mqtt", "thingsboard", "backends:thingsboard_client")
+register("mqtt", "thingsboard_gateway", "backends:thingsboard_gateway_client")
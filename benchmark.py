@@ -0,0 +1,204 @@
+"""
+Benchmarks the controller on the simulated drying room.
+
+Runs the example schedule of configs/schedule.json through ScheduleControl
+and the publish loop, faster than real time, and reports:
+- scheduling jitter: how late jobs start compared to their scheduled time
+- publish latency and CPU time of each device publish cycle
+- energy proxy: heater and fan minutes, relay writes
+
+With `--zones N`, it instead runs 1 to N rooms on one ZoneController and
+reports the process CPU time and the memory held by the setup of each
+added zone.
+
+    python benchmark.py [--speedup 600] [--minutes 100] [--no-control]
+    python benchmark.py --zones 4 [--speedup 600] [--minutes 100]
+
+With `--supervisor N`, it injects N stalls and N over-temperature readings
+into a Supervisor and reports its reaction times, from the fault becoming
+detectable to the actuators being reset.
+
+    python benchmark.py --supervisor 20 [--check-interval 0.1]
+"""
+import argparse
+import logging
+import random
+import time
+import tracemalloc
+
+import instrumentation
+from actuators_control import ActuatorsControl, RelayActuator
+from gpio_bank import FakeOutputBank
+from logging_setup import setup_logging
+from sensor_engine import Reading
+from simulation import DryingRoomSimulation, MultiZoneSimulation
+from supervisor import Supervisor
+
+
+def percentiles(values, points=(50, 95, 99)):
+    if not values:
+        return {f"p{point}": None for point in points} | {"max": None}
+    ordered = sorted(values)
+    result = {
+        f"p{point}": ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))]
+        for point in points
+    }
+    result["max"] = ordered[-1]
+    return result
+
+
+def format_ms(stats):
+    return "  ".join(
+        f"{name}={value * 1000:8.3f}ms" if value is not None else f"{name}=       -"
+        for name, value in stats.items()
+    )
+
+
+def report(simulation: DryingRoomSimulation):
+    lines = []
+    lines.append(
+        f"Simulated {simulation.clock.elapsed / 60:.0f} min in {simulation.wall_time:.1f} s "
+        f"(x{simulation.clock.elapsed / simulation.wall_time:.0f}), "
+        f"process CPU {simulation.cpu_time:.2f} s"
+    )
+    lines.append(
+        f"{'scheduling jitter':<44}{format_ms(percentiles(simulation.scheduler.lateness))}"
+    )
+    for name, latencies in simulation.publish_latency.items():
+        lines.append(f"{'publish latency ' + name:<44}{format_ms(percentiles(latencies))}")
+    for name, cpu in simulation.publish_cpu.items():
+        lines.append(f"{'publish CPU ' + name:<44}{format_ms(percentiles(cpu))}")
+    lines.append(
+        f"{'energy proxy':<44}heater={simulation.heater_seconds / 60:.0f}min  "
+        f"fan={simulation.fan_seconds / 60:.0f}min  "
+        f"relay writes={len(simulation.bank.writes)}  "
+        f"final T={simulation.room.temperature:.1f}C RH={simulation.room.humidity:.0f}%"
+    )
+    if simulation.drying:
+        lines.append(
+            f"{'drying control':<44}schedule {simulation.timeline.duration / 60:.0f}min -> "
+            f"{simulation.schedule_control.timeline.duration / 60:.0f}min  "
+            f"extended={simulation.drying.extended:.0f}min  "
+            f"ended early={(simulation.drying.ended or 0) / 60:.0f}min  "
+            f"product water left={simulation.room.moisture:.0%}"
+        )
+    return "\n".join(lines)
+
+
+def zones_report(max_zones, speedup, minutes):
+    lines = [
+        f"{'zones':>5}{'CPU s':>10}{'CPU s/zone':>12}{'+CPU s':>10}"
+        f"{'memory KiB':>12}{'+memory KiB':>13}"
+    ]
+    previous = None
+    for zones in range(1, max_zones + 1):
+        # Memory still allocated once the zones are set up: the per-zone
+        # state (schedules, jobs, aggregators, buffers)
+        tracemalloc.start()
+        simulation = MultiZoneSimulation(zones, speedup=speedup)
+        memory = tracemalloc.get_traced_memory()[0] / 1024
+        tracemalloc.stop()
+        simulation.run(minutes)
+        cpu = simulation.cpu_time
+        added = (cpu - previous[0], memory - previous[1]) if previous else (cpu, memory)
+        lines.append(
+            f"{zones:>5}{cpu:>10.2f}{cpu / zones:>12.3f}{added[0]:>10.2f}"
+            f"{memory:>12.0f}{added[1]:>13.0f}"
+        )
+        previous = (cpu, memory)
+    return "\n".join(lines)
+
+
+def _wait_for(condition, timeout=5.0):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("The supervisor did not react")
+        time.sleep(0.001)
+
+
+def supervisor_report(trials, check_interval=0.1, stall_timeout=0.2):
+    bank = FakeOutputBank(DryingRoomSimulation.PINS.values())
+    actuators = ActuatorsControl(
+        RelayActuator(label, pin, bank)
+        for label, pin in DryingRoomSimulation.PINS.items()
+    )
+    options = dict(
+        fail_safe=[actuators.trip],
+        release=[actuators.release],
+        check_interval=check_interval,
+        notify=lambda state: False,
+    )
+    stalls = instrumentation.histogram("supervisor_reaction_seconds", fault="stall")
+    hot = instrumentation.histogram("supervisor_reaction_seconds", fault="temperature")
+
+    # Stalls: the heartbeat stops at a random phase of the check interval.
+    # Exiting is replaced by stopping the supervisor.
+    for _ in range(trials):
+        exits = []
+        supervisor = Supervisor(
+            timeouts={"scheduler": stall_timeout}, exit=exits.append, **options
+        )
+        supervisor.start()
+        time.sleep(random.uniform(0, check_interval))
+        supervisor.beat("scheduler")
+        _wait_for(lambda: exits)
+        supervisor.stop()
+
+    # Over temperature: a hot reading, then a normal one and clearing the
+    # latched fault
+    supervisor = Supervisor(exit=lambda status: None, **options)
+    supervisor.start()
+    for _ in range(trials):
+        actuators.apply_state({"heater": 1})
+        time.sleep(random.uniform(0, check_interval))
+        count = hot.count
+        supervisor.on_reading(
+            "Top", Reading(supervisor.max_temperature + 5, 20.0, time.time())
+        )
+        _wait_for(lambda: hot.count > count)
+        supervisor.on_reading("Top", Reading(40.0, 20.0, time.time()))
+        supervisor.clear()
+        time.sleep(check_interval * 1.5)
+    supervisor.stop()
+
+    lines = [
+        f"check interval {check_interval * 1000:.0f}ms, reset deadline "
+        f"{supervisor.reset_deadline * 1000:.0f}ms, {trials} faults of each kind"
+    ]
+    for name, histogram in (("stall", stalls), ("over temperature", hot)):
+        stats = {
+            f"p{quantile * 100:g}": value
+            for quantile, value in histogram.quantiles((0.5, 0.95, 0.99)).items()
+        }
+        stats["max"] = histogram.max
+        lines.append(f"{'reaction ' + name:<44}{format_ms(stats)}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--speedup", type=float, default=600)
+    parser.add_argument("--minutes", type=float, default=None)
+    parser.add_argument("--no-control", action="store_true")
+    parser.add_argument("--drying-target", type=float, default=None)
+    parser.add_argument("--zones", type=int, default=None)
+    parser.add_argument("--supervisor", type=int, default=None)
+    parser.add_argument("--check-interval", type=float, default=0.1)
+    args = parser.parse_args()
+
+    setup_logging(level=logging.WARNING)
+    if args.supervisor:
+        # The supervisor logs every injected fault as critical
+        logging.disable(logging.CRITICAL)
+        print(supervisor_report(args.supervisor, args.check_interval))
+        raise SystemExit
+    if args.zones:
+        print(zones_report(args.zones, args.speedup, args.minutes))
+        raise SystemExit
+    simulation = DryingRoomSimulation(
+        speedup=args.speedup,
+        control=not args.no_control,
+        drying_target=args.drying_target,
+    ).run(args.minutes)
+    print(report(simulation))
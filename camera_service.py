@@ -0,0 +1,212 @@
+import io
+import os
+import queue
+import threading
+import time
+import logging
+from datetime import datetime
+from time import sleep
+from typing import TYPE_CHECKING
+
+import backends
+from settings import (
+    CAMERA_BACKEND,
+    CAMERA_CALIBRATION_TTL,
+    CAMERA_FLASH_WARMUP,
+    CAMERA_ISO,
+    CAMERA_QUEUE_SIZE,
+    CAMERA_RESIZE,
+    CAMERA_SETTLE_TIME,
+    CAMERA_THUMBNAIL_SIZE,
+)
+from file_utils import write_atomic
+from image_store import ImageStore
+
+if TYPE_CHECKING:
+    from image_analysis import ImageAnalyzer
+
+
+class CapturedImage:
+    def __init__(self, name, data, taken_at) -> None:
+        self.name = name
+        self.data = data
+        self.taken_at = taken_at
+
+
+class CameraCaptureService:
+    """
+    Keeps the PiCamera open between captures.
+
+    Exposure and white balance are measured once, locked, and reused until
+    they are older than `calibration_ttl` seconds, so the AGC warm-up only
+    happens when the light may have changed. Pictures are captured to memory
+    and handed over to a writer thread, which saves them (and an optional
+    thumbnail) to the image store. The caller is only blocked for the
+    capture itself.
+
+    With an ImageAnalyzer, the writer thread analyzes every picture first
+    and only stores the ones it tells to keep. With `analyze`, one is
+    created on the first picture, so numpy and Pillow are not imported at
+    startup.
+    """
+
+    def __init__(
+        self,
+        store: ImageStore = None,
+        iso=CAMERA_ISO,
+        calibration_ttl=CAMERA_CALIBRATION_TTL,
+        settle_time=CAMERA_SETTLE_TIME,
+        flash_warmup=CAMERA_FLASH_WARMUP,
+        resize=CAMERA_RESIZE,
+        thumbnail_size=CAMERA_THUMBNAIL_SIZE,
+        queue_size=CAMERA_QUEUE_SIZE,
+        backend=CAMERA_BACKEND,
+        analyzer: "ImageAnalyzer" = None,
+        analyze=False,
+    ) -> None:
+        self.store = store if store is not None else ImageStore()
+        self.analyzer = analyzer
+        self.analyze = analyze and analyzer is None
+        self.backend = backend
+        self.iso = iso
+        self.calibration_ttl = calibration_ttl
+        self.settle_time = settle_time
+        self.flash_warmup = flash_warmup
+        self.resize = resize
+        self.thumbnail_size = thumbnail_size
+        self.camera = None
+        self.calibrated_at = None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._writer = threading.Thread(
+            target=self._write_loop, name="camera-writer", daemon=True
+        )
+        self._writer.start()
+
+    def _open(self):
+        if self.camera is None:
+            logging.info("Opening camera")
+            self.camera = backends.create("camera", self.backend)
+            self.camera.iso = self.iso
+            self.calibrated_at = None
+        return self.camera
+
+    def _calibrate(self, camera):
+        logging.info("Calibrating camera exposure and white balance")
+        camera.shutter_speed = 0
+        camera.exposure_mode = "auto"
+        camera.awb_mode = "auto"
+        # Wait for the automatic gain control to settle
+        sleep(self.settle_time)
+        # Now fix the values
+        camera.shutter_speed = camera.exposure_speed
+        camera.exposure_mode = "off"
+        g = camera.awb_gains
+        camera.awb_mode = "off"
+        camera.awb_gains = g
+        self.calibrated_at = time.monotonic()
+
+    def is_calibrated(self):
+        return (
+            self.calibrated_at is not None
+            and time.monotonic() - self.calibrated_at < self.calibration_ttl
+        )
+
+    def capture(self, flash_on=None, flash_off=None):
+        with self._lock:
+            try:
+                camera = self._open()
+                if flash_on:
+                    flash_on()
+                    sleep(self.flash_warmup)
+                if not self.is_calibrated():
+                    self._calibrate(camera)
+                stream = io.BytesIO()
+                camera.capture(stream, format="jpeg", resize=self.resize)
+            except Exception:
+                # Force re-opening the camera on the next capture
+                self.close_camera()
+                raise
+            finally:
+                if flash_off:
+                    flash_off()
+
+        current_td = datetime.now().strftime("%Y_%m_%d-%I_%M_%S_%p")
+        image = CapturedImage(f"image_{current_td}.jpg", stream.getvalue(), time.time())
+        try:
+            self._queue.put_nowait(image)
+        except queue.Full:
+            logging.warning(f"Image writer is behind, dropping {image.name}")
+        return image
+
+    def _write_loop(self):
+        while True:
+            image = self._queue.get()
+            if image is None:
+                return
+            try:
+                self.persist(image)
+            except Exception:
+                logging.error(f"Failed saving image {image.name}", exc_info=True)
+
+    def _get_analyzer(self):
+        if self.analyze:
+            self.analyze = False
+            try:
+                from image_analysis import ImageAnalyzer
+
+                self.analyzer = ImageAnalyzer()
+            except ImportError:
+                logging.error("Image analysis disabled", exc_info=True)
+        return self.analyzer
+
+    def collect_analysis(self):
+        # (ts in ms, telemetry) of the pictures analyzed since the last call
+        if self.analyzer is None:
+            return []
+        return self.analyzer.collect()
+
+    def persist(self, image):
+        analyzer = self._get_analyzer()
+        if analyzer is not None:
+            try:
+                if not analyzer.process(image):
+                    # Unchanged, only its statistics are sent
+                    return
+            except Exception:
+                logging.error(f"Failed analyzing image {image.name}", exc_info=True)
+        self.store.save(image.name, image.data, image.taken_at)
+        if self.thumbnail_size:
+            self.write_thumbnail(image)
+
+    def write_thumbnail(self, image):
+        try:
+            from PIL import Image
+        except ImportError:
+            logging.warning("Pillow is not installed, disabling thumbnails")
+            self.thumbnail_size = None
+            return
+        # Thumbnails are removed by the store together with their image
+        folder = os.path.join(self.store.folder, "thumbnails")
+        os.makedirs(folder, exist_ok=True)
+        with Image.open(io.BytesIO(image.data)) as picture:
+            # draft() lets the JPEG decoder downscale while decoding
+            picture.draft("RGB", self.thumbnail_size)
+            picture.thumbnail(self.thumbnail_size)
+            output = io.BytesIO()
+            picture.save(output, format="JPEG")
+        write_atomic(os.path.join(folder, image.name), output.getvalue())
+
+    def close_camera(self):
+        if self.camera is not None:
+            try:
+                self.camera.close()
+            finally:
+                self.camera = None
+                self.calibrated_at = None
+
+    def close(self):
+        with self._lock:
+            self.close_camera()
+        self._queue.put(None)
+        self._writer.join()
@@ -0,0 +1,258 @@
+import time
+import logging
+
+from settings import (
+    CONTROL_MAX_TEMPERATURE,
+    CONTROL_MIN_OFF_TIME,
+    CONTROL_MIN_ON_TIME,
+    CONTROL_TEMPERATURE_BAND,
+    CONTROL_HUMIDITY_BAND,
+    CONTROL_PID_GAINS,
+    CONTROL_PID_WINDOW,
+    CONTROL_TICK_INTERVAL,
+    SENSOR_MAX_AGE,
+)
+
+
+class Hysteresis:
+    """
+    On/off control with a dead band around the setpoint.
+
+    For heating (`reverse=False`) the output goes on below
+    `setpoint - band / 2` and off above `setpoint + band / 2`. With
+    `reverse=True` it goes on above the band (e.g. a fan venting humidity).
+    """
+
+    def __init__(self, band, reverse=False) -> None:
+        self.band = band
+        self.reverse = reverse
+
+    def update(self, setpoint, value, is_on):
+        low = setpoint - self.band / 2
+        high = setpoint + self.band / 2
+        if self.reverse:
+            if value > high:
+                return True
+            if value < low:
+                return False
+        else:
+            if value < low:
+                return True
+            if value > high:
+                return False
+        return is_on
+
+
+class PID:
+    """
+    PID giving a duty cycle between 0 and 1. The integral term is clamped
+    so it cannot wind up while the output is saturated.
+    """
+
+    def __init__(self, kp, ki, kd) -> None:
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.last_error = None
+
+    def update(self, setpoint, value, dt):
+        error = setpoint - value
+        derivative = 0.0
+        if self.last_error is not None and dt > 0:
+            derivative = (error - self.last_error) / dt
+        self.last_error = error
+
+        integral = self.integral + error * dt
+        output = self.kp * error + self.ki * integral + self.kd * derivative
+        if 0.0 < output < 1.0 or (output >= 1.0) != (error > 0):
+            # Only integrate when not saturated in the direction of the error
+            self.integral = integral
+        return min(max(output, 0.0), 1.0)
+
+
+class CycleGuard:
+    """
+    Anti-short-cycle protection: an output must stay on for at least
+    `min_on` seconds and off for at least `min_off` seconds.
+    """
+
+    def __init__(self, min_on, min_off) -> None:
+        self.min_on = min_on
+        self.min_off = min_off
+        self.changed_at = None
+
+    def allow(self, desired, is_on, now):
+        if desired == is_on:
+            return is_on
+        if self.changed_at is not None:
+            held = now - self.changed_at
+            if held < (self.min_on if is_on else self.min_off):
+                return is_on
+        self.changed_at = now
+        return desired
+
+    def force(self, value, is_on, now):
+        if value != is_on:
+            self.changed_at = now
+        return value
+
+
+class ClimateController:
+    """
+    Drives the heater and the fan toward the setpoints of the current
+    schedule step.
+
+    The heater follows the temperature setpoint, either with a hysteresis
+    band or with a PID whose duty cycle is applied over a `pid_window`
+    seconds time-proportioning window. The fan vents when the humidity is
+    above its setpoint. Both outputs are protected by a CycleGuard, except
+    that the heater is always switched off above `max_temperature`.
+
+    `read_climate()` returns the current (temperature, humidity), or None
+    when no fresh reading is available, in which case the heater is turned
+    off. It can add the hottest temperature read, (temperature, humidity,
+    hottest), which the `max_temperature` cutoff then uses instead of the
+    average. `actuators` is anything with an ActuatorsControl-like
+    `apply_state({actuator_id: status})` and `actuators_map`.
+
+    When no setpoints are set the controller does nothing and the schedule
+    steps drive the heater and fan directly.
+
+    `tick()` is run every `tick_interval` seconds by a scheduler job, see
+    ScheduleControl.start() and Zone.start().
+    """
+
+    def __init__(
+        self,
+        actuators,
+        read_climate,
+        heater_id=None,
+        fan_id=None,
+        mode="hysteresis",
+        tick_interval=CONTROL_TICK_INTERVAL,
+        temperature_band=CONTROL_TEMPERATURE_BAND,
+        humidity_band=CONTROL_HUMIDITY_BAND,
+        pid_gains=CONTROL_PID_GAINS,
+        pid_window=CONTROL_PID_WINDOW,
+        min_on=CONTROL_MIN_ON_TIME,
+        min_off=CONTROL_MIN_OFF_TIME,
+        max_temperature=CONTROL_MAX_TEMPERATURE,
+    ) -> None:
+        if mode not in ("hysteresis", "pid"):
+            raise ValueError(f"Unknown control mode {mode}")
+        self.actuators = actuators
+        self.read_climate = read_climate
+        self.heater_id = heater_id
+        self.fan_id = fan_id
+        self.mode = mode
+        self.tick_interval = tick_interval
+        self.max_temperature = max_temperature
+        self.pid_window = pid_window
+
+        self.heater_hysteresis = Hysteresis(temperature_band)
+        self.fan_hysteresis = Hysteresis(humidity_band, reverse=True)
+        self.pid = PID(*pid_gains)
+        self.heater_guard = CycleGuard(min_on, min_off)
+        self.fan_guard = CycleGuard(min_on, min_off)
+
+        self.setpoints = None
+        self._duty = 0.0
+        self._window_start = None
+
+    @property
+    def controlled_ids(self):
+        # Actuators that schedule steps must leave alone while active
+        if not self.setpoints:
+            return set()
+        return {
+            actuator_id
+            for actuator_id in (self.heater_id, self.fan_id)
+            if actuator_id is not None
+        }
+
+    def set_setpoints(self, setpoints):
+        if setpoints != self.setpoints:
+            logging.info(f"Climate setpoints changed to {setpoints}")
+            self.pid.reset()
+            self._window_start = None
+        self.setpoints = setpoints or None
+
+    def _status(self, actuator_id):
+        return bool(self.actuators.actuators_map[actuator_id].status)
+
+    def tick(self, now=None):
+        if not self.setpoints:
+            return
+        now = time.monotonic() if now is None else now
+        climate = self.read_climate()
+        state = {}
+        if self.heater_id is not None:
+            state[self.heater_id] = self._heater(climate, now)
+        if self.fan_id is not None:
+            state[self.fan_id] = self._fan(climate, now)
+        if state:
+            self.actuators.apply_state(state)
+
+    def _heater(self, climate, now):
+        is_on = self._status(self.heater_id)
+        setpoint = self.setpoints.get("temperature")
+        if climate is None or setpoint is None:
+            return int(self.heater_guard.force(False, is_on, now))
+        temperature = climate[0]
+        # A single sensor near the heater is enough to cut it off
+        hottest = climate[2] if len(climate) > 2 else temperature
+        if hottest >= self.max_temperature:
+            logging.warning(f"Over temperature {hottest}, heater off")
+            return int(self.heater_guard.force(False, is_on, now))
+
+        if self.mode == "hysteresis":
+            desired = self.heater_hysteresis.update(setpoint, temperature, is_on)
+        else:
+            if self._window_start is None or now - self._window_start >= self.pid_window:
+                # The duty cycle is only recomputed once per window, over the
+                # time since the last one (longer after a late tick)
+                dt = self.pid_window
+                if self._window_start is not None:
+                    dt = now - self._window_start
+                self._window_start = now
+                self._duty = self.pid.update(setpoint, temperature, dt)
+            desired = now - self._window_start < self._duty * self.pid_window
+        return int(self.heater_guard.allow(desired, is_on, now))
+
+    def _fan(self, climate, now):
+        is_on = self._status(self.fan_id)
+        setpoint = self.setpoints.get("humidity")
+        if climate is None or setpoint is None:
+            return int(is_on)
+        desired = self.fan_hysteresis.update(setpoint, climate[1], is_on)
+        return int(self.fan_guard.allow(desired, is_on, now))
+
+
+def engine_climate(engine, max_age=SENSOR_MAX_AGE, labels=None):
+    """
+    Returns a `read_climate` callable averaging the fresh readings of a
+    SensorAcquisitionEngine, or only of its sensors in `labels` when the
+    engine is shared (e.g. by several zones), along with the hottest one.
+    """
+    labels = set(labels) if labels is not None else None
+
+    def read_climate():
+        oldest = time.time() - max_age
+        readings = [
+            reading
+            for label, reading in engine.snapshot().items()
+            if reading.timestamp >= oldest and (labels is None or label in labels)
+        ]
+        if not readings:
+            return None
+        return (
+            sum(reading.temperature for reading in readings) / len(readings),
+            sum(reading.humidity for reading in readings) / len(readings),
+            max(reading.temperature for reading in readings),
+        )
+
+    return read_climate
@@ -0,0 +1,233 @@
+"""
+Drying progress estimation and end-of-run prediction.
+
+While the product dries, the air of each shelf gets drier: its humidity
+falls toward the target as less water evaporates. DryingEstimator fits a
+line to the humidity of each shelf (Top, Top-middle, ...) over a sliding
+window of aggregation windows, for all the shelves at once:
+
+- the slope is the drying rate of the shelf, in %RH per hour,
+- the time for the fitted humidity to reach `target` is the time-to-target
+  of the shelf, and the run is predicted to end when the wettest shelf
+  reaches it.
+
+The regression is incremental: the sums of the least squares are updated
+with the sample added and the one leaving the window, as numpy vectors
+over the shelves, so an update costs the same whatever the window size.
+Missing readings (NaN) only leave out their shelf.
+
+DryingControl applies the prediction to a ScheduleControl: it ends the run
+early when every shelf is at the target, and extends the last step when
+the schedule is about to end before the product is dry.
+"""
+import logging
+import math
+import threading
+import time
+
+import numpy as np
+
+from settings import (
+    DRYING_CHECK_INTERVAL,
+    DRYING_MAX_EXTENSION,
+    DRYING_MIN_RUN,
+    DRYING_MIN_SAMPLES,
+    DRYING_TARGET_HUMIDITY,
+    DRYING_WINDOW,
+)
+
+
+class DryingEstimator:
+    def __init__(
+        self,
+        labels,
+        target=DRYING_TARGET_HUMIDITY,
+        window=DRYING_WINDOW,
+        min_samples=DRYING_MIN_SAMPLES,
+        clock=time.time,
+    ) -> None:
+        self.labels = list(labels)
+        self.clock = clock
+        self.target = target
+        self.window = window
+        self.min_samples = min_samples
+        shelves = len(self.labels)
+        # Ring buffer of the samples in the window, times in hours
+        self._times = np.full(window, np.nan)
+        self._values = np.full((window, shelves), np.nan)
+        self._next = 0
+        self._origin = None
+        self.last_time = None
+        # Least squares sums per shelf over the valid samples of the window
+        self._n = np.zeros(shelves)
+        self._st = np.zeros(shelves)
+        self._stt = np.zeros(shelves)
+        self._sh = np.zeros(shelves)
+        self._sth = np.zeros(shelves)
+        # Shelves left out of remaining(), logged when it changes
+        self._left_out = []
+        # Added to by the publishing loop, read by the scheduler
+        self._lock = threading.Lock()
+
+    def _accumulate(self, t, values, sign):
+        valid = ~np.isnan(values)
+        h = np.where(valid, values, 0.0)
+        weight = valid * sign
+        self._n += weight
+        self._st += weight * t
+        self._stt += weight * t * t
+        self._sh += sign * h
+        self._sth += sign * h * t
+
+    def add(self, humidity: dict, timestamp=None):
+        """
+        Adds the {label: humidity} of one aggregation window, at
+        `timestamp` (seconds, now by default).
+        """
+        timestamp = self.clock() if timestamp is None else timestamp
+        if self._origin is None:
+            # Relative times keep the sums well conditioned
+            self._origin = timestamp
+        t = (timestamp - self._origin) / 3600
+        values = np.array(
+            [
+                np.nan if humidity.get(label) is None else humidity[label]
+                for label in self.labels
+            ],
+            dtype=float,
+        )
+
+        with self._lock:
+            if not np.isnan(self._times[self._next]):
+                # The oldest sample leaves the window
+                self._accumulate(
+                    self._times[self._next], self._values[self._next], -1
+                )
+            self._times[self._next] = t
+            self._values[self._next] = values
+            self._accumulate(t, values, 1)
+            self._next = (self._next + 1) % self.window
+            self.last_time = t
+
+    def fit(self):
+        """
+        (slope in %RH/h, fitted humidity now) per shelf, NaN for the shelves
+        with less than `min_samples` samples in the window.
+        """
+        with self._lock, np.errstate(divide="ignore", invalid="ignore"):
+            n = self._n.copy()
+            denominator = n * self._stt - self._st**2
+            slope = (n * self._sth - self._st * self._sh) / denominator
+            intercept = (self._sh - slope * self._st) / n
+            last_time = self.last_time or 0.0
+        enough = (n >= self.min_samples) & (denominator > 0)
+        slope = np.where(enough, slope, np.nan)
+        now = intercept + slope * last_time
+        return slope, np.where(enough, now, np.nan)
+
+    def time_to_target(self):
+        """
+        Hours until each shelf reaches the target: 0 when it is there, inf
+        when it is not drying, NaN without enough samples.
+        """
+        slope, now = self.fit()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            hours = np.where(slope < 0, (now - self.target) / -slope, np.inf)
+        hours = np.where(now <= self.target, 0.0, hours)
+        return np.where(np.isnan(now), np.nan, hours)
+
+    def remaining(self):
+        """
+        Hours until the wettest shelf reaches the target, or None when no
+        shelf has enough samples. The shelves without enough samples (e.g.
+        a failed sensor) are left out.
+        """
+        hours = self.time_to_target()
+        missing = np.isnan(hours)
+        left_out = [label for label, nan in zip(self.labels, missing) if nan]
+        if missing.all():
+            return None
+        if left_out != self._left_out:
+            if left_out:
+                logging.warning(
+                    "Not enough humidity samples of %s, left out of the drying "
+                    "prediction",
+                    ", ".join(left_out),
+                )
+            self._left_out = left_out
+        return float(np.nanmax(hours))
+
+    def telemetry(self):
+        slope, now = self.fit()
+        hours = self.time_to_target()
+        telemetry = {}
+        for index, label in enumerate(self.labels):
+            if not np.isnan(slope[index]):
+                telemetry[f"drying_rate_{label}"] = round(float(slope[index]), 3)
+            if not np.isnan(hours[index]) and np.isfinite(hours[index]):
+                telemetry[f"drying_eta_{label}"] = round(float(hours[index]) * 60)
+        fitted = now[~np.isnan(now)]
+        if len(fitted) > 1:
+            # Humidity spread between the wettest and the driest shelf
+            spread = float(fitted.max() - fitted.min())
+            telemetry["drying_gradient"] = round(spread, 2)
+        remaining = self.remaining()
+        if remaining is not None and math.isfinite(remaining):
+            telemetry["drying_eta"] = round(remaining * 60)
+        return telemetry
+
+
+class DryingControl:
+    """
+    Ends or extends the schedule of a ScheduleControl from the estimator's
+    prediction, checked with `check()` (e.g. a scheduler job):
+
+    - once the run has lasted `min_run` minutes and every shelf is at the
+      target, the schedule ends,
+    - when the schedule ends within `horizon` minutes and the product is
+      predicted to need longer, the last step is extended by the predicted
+      time, up to `max_extension` minutes in total.
+    """
+
+    def __init__(
+        self,
+        estimator: DryingEstimator,
+        schedule_control,
+        min_run=DRYING_MIN_RUN,
+        max_extension=DRYING_MAX_EXTENSION,
+        horizon=3 * DRYING_CHECK_INTERVAL,
+    ) -> None:
+        self.estimator = estimator
+        self.schedule_control = schedule_control
+        self.min_run = min_run
+        self.max_extension = max_extension
+        self.horizon = horizon
+        self.ended = None  # seconds before the schedule end, when ended early
+
+    def check(self, now=None):
+        remaining = self.estimator.remaining()
+        left = self.schedule_control.remaining(now)
+        if remaining is None or left <= 0:
+            return
+        elapsed = self.schedule_control.timeline.duration - left
+        if remaining == 0 and elapsed >= self.min_run * 60:
+            logging.info("Every shelf reached the target humidity, ending the run")
+            self.ended = left
+            self.schedule_control.end()
+            return
+
+        needed = remaining * 60 - left / 60
+        budget = self.max_extension - self.extended
+        if left <= self.horizon * 60 and needed > 0 and budget > 0:
+            minutes = min(needed, budget)
+            logging.info(
+                f"The product needs {remaining * 60:.0f} more minutes, "
+                f"extending the schedule by {minutes:.0f} minutes"
+            )
+            self.schedule_control.extend(minutes * 60)
+
+    @property
+    def extended(self):
+        # Minutes the schedule was extended by, kept by the schedule (and
+        # stored with it) so the budget survives a restart
+        return self.schedule_control.extended / 60
@@ -0,0 +1,16 @@
+"""
+File helpers shared by the stores (images, schedule state, history).
+"""
+import os
+
+
+def write_atomic(path, data, sync=False):
+    # With `sync` the data is on disk before the rename, so a power loss
+    # leaves either the old or the new file
+    tmp_path = str(path) + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
@@ -0,0 +1,130 @@
+import threading
+import logging
+
+from settings import GPIO_CHIP, RELAYS_ACTIVE_LOW
+
+
+class OutputBank:
+    """
+    A group of GPIO output lines written together.
+
+    `set_values({pin: 0/1})` applies all the given levels in a single write.
+    Levels are logical: 1 means the relay is on, whatever the wiring.
+    """
+
+    def __init__(self, pins, active_low=RELAYS_ACTIVE_LOW) -> None:
+        self.pins = list(pins)
+        self.active_low = active_low
+        self.values = {pin: 0 for pin in self.pins}
+        self._lock = threading.Lock()
+
+    def set_values(self, values: dict[int, int]):
+        unknown = set(values) - set(self.values)
+        if unknown:
+            raise ValueError(f"Pins {sorted(unknown)} are not part of this bank")
+        with self._lock:
+            self.write(values)
+            self.values.update(values)
+
+    def write(self, values: dict[int, int]):
+        raise NotImplementedError()
+
+    def force_off(self):
+        # Last resort before exiting: every line off, without waiting for
+        # the lock a hung write may hold
+        self.write({pin: 0 for pin in self.pins})
+
+    def close(self):
+        pass
+
+
+class GpiodOutputBank(OutputBank):
+    """
+    Output bank backed by a single libgpiod line request, so every batch is
+    one ioctl on the chip.
+    """
+
+    def __init__(
+        self,
+        pins,
+        chip=GPIO_CHIP,
+        active_low=RELAYS_ACTIVE_LOW,
+        consumer="pi-drying-controller",
+    ) -> None:
+        import gpiod
+
+        try:
+            from gpiod.line import Direction, Value
+        except ImportError:
+            # python3-libgpiod of Raspberry Pi OS Bookworm is the v1 API
+            version = getattr(gpiod, "__version__", "1.x")
+            raise ImportError(
+                "The gpiod backend needs the libgpiod v2 bindings (gpiod>=2 of "
+                f"requirements.txt), found gpiod {version}. Or set "
+                "GPIO_BACKEND to rpi_gpio."
+            ) from None
+
+        super().__init__(pins, active_low)
+        self._active = Value.ACTIVE
+        self._inactive = Value.INACTIVE
+        # Lines are requested switched off
+        self.request = gpiod.request_lines(
+            chip,
+            consumer=consumer,
+            config={
+                tuple(self.pins): gpiod.LineSettings(
+                    direction=Direction.OUTPUT,
+                    active_low=active_low,
+                    output_value=Value.INACTIVE,
+                )
+            },
+        )
+
+    def write(self, values):
+        self.request.set_values(
+            {
+                pin: self._active if value else self._inactive
+                for pin, value in values.items()
+            }
+        )
+
+    def close(self):
+        self.request.release()
+
+
+class RPiGPIOOutputBank(OutputBank):
+    """
+    Output bank using RPi.GPIO, one call per pin.
+    """
+
+    def __init__(self, pins, active_low=RELAYS_ACTIVE_LOW) -> None:
+        import RPi.GPIO as GPIO
+
+        super().__init__(pins, active_low)
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+        # removing the warings
+        GPIO.setwarnings(False)
+        for pin in self.pins:
+            GPIO.setup(pin, GPIO.OUT)
+        self.write(self.values)
+
+    def write(self, values):
+        for pin, value in values.items():
+            level = bool(value) != self.active_low
+            self.GPIO.output(pin, self.GPIO.HIGH if level else self.GPIO.LOW)
+
+
+class FakeOutputBank(OutputBank):
+    """
+    In-memory output bank for tests and simulations. Every batch written is
+    recorded in `writes`.
+    """
+
+    def __init__(self, pins, active_low=RELAYS_ACTIVE_LOW) -> None:
+        super().__init__(pins, active_low)
+        self.writes = []
+
+    def write(self, values):
+        logging.debug("Setting pins %s", values)
+        self.writes.append(dict(values))
@@ -0,0 +1,426 @@
+"""
+Local time-series history of the telemetry and actuator changes.
+
+Samples are numeric values of named series ("TempHumDevice/temperature_Top",
+"actuator/heater"), stored as fixed-width binary records in one
+memory-mapped segment file per UTC day:
+
+    <folder>/raw/20261017.bin   (ts ms, series id, value)
+    <folder>/1m/20261017.bin    (bucket ts ms, series id, count, min, max, sum)
+    <folder>/15m/...
+    <folder>/1h/...
+
+Series names are mapped to ids in <folder>/series.json. Each segment starts
+with a small header holding its record count, so reading a day is a single
+mmap and a range query a bisection on the timestamps (or a scan, for the
+rare segment written out of order after a clock change).
+
+`add()` only buffers the samples: they are written, and the rollup buckets
+that ended are appended, every `flush_interval` seconds or when the buffer
+is full, so the SD card sees a few sequential page writes per flush.
+Queries also see the buffered samples and the open rollup buckets.
+
+The history is the replay source to backfill ThingsBoard: `replay()`
+returns a device's telemetry of a time range in the `[{"ts", "values"}]`
+format of TelemetryPipeline.
+"""
+import bisect
+import json
+import logging
+import mmap
+import struct
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from operator import itemgetter
+from pathlib import Path
+
+from file_utils import write_atomic
+from settings import (
+    HISTORY_BUFFER_RECORDS,
+    HISTORY_FLUSH_INTERVAL,
+    HISTORY_FOLDER,
+    HISTORY_RAW_DAYS,
+    HISTORY_ROLLUP_DAYS,
+    HISTORY_SEGMENT_RECORDS,
+)
+
+HEADER = struct.Struct("<4sHHQ")  # magic, record size, flags, record count
+MAGIC = b"HST1"
+FLAG_UNSORTED = 1
+RAW = struct.Struct("<qHd")  # ts ms, series id, value
+ROLLUP = struct.Struct("<qHIddd")  # bucket ts ms, series id, count, min, max, sum
+TIMESTAMP = struct.Struct("<q")
+MAX_SERIES = 0xFFFF
+
+# Rollup resolutions, in seconds
+RESOLUTIONS = {"1m": 60, "15m": 900, "1h": 3600}
+DAY_MS = 86400 * 1000
+
+
+def _day(ts):
+    return datetime.fromtimestamp(ts / 1000, timezone.utc).strftime("%Y%m%d")
+
+
+def _days(start, end):
+    day = datetime.fromtimestamp(start / 1000, timezone.utc).date()
+    last = datetime.fromtimestamp(end / 1000, timezone.utc).date()
+    while day <= last:
+        yield day.strftime("%Y%m%d")
+        day += timedelta(days=1)
+
+
+class Segment:
+    """
+    A file of fixed-width records behind a header, memory-mapped. Writable
+    segments grow by doubling their size when full.
+    """
+
+    def __init__(
+        self,
+        path,
+        record: struct.Struct,
+        capacity=HISTORY_SEGMENT_RECORDS,
+        writable=True,
+    ):
+        self.path = Path(path)
+        self.record = record
+        self.writable = writable
+        if writable and not self.path.exists():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "wb") as f:
+                f.write(HEADER.pack(MAGIC, record.size, 0, 0))
+                f.truncate(HEADER.size + capacity * record.size)
+        self._file = open(self.path, "r+b" if writable else "rb")
+        self._map = mmap.mmap(
+            self._file.fileno(),
+            0,
+            access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ,
+        )
+        magic, size, self.flags, self.count = HEADER.unpack_from(self._map)
+        if magic != MAGIC or size != record.size:
+            self.close()
+            raise ValueError(f"{self.path} is not a history segment")
+
+    @property
+    def capacity(self):
+        return (len(self._map) - HEADER.size) // self.record.size
+
+    def _ts(self, index):
+        offset = HEADER.size + index * self.record.size
+        return TIMESTAMP.unpack_from(self._map, offset)[0]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        # Timestamps, for bisect
+        return self._ts(index)
+
+    def append(self, records):
+        if not records:
+            return
+        if self.count + len(records) > self.capacity:
+            self._grow(self.count + len(records))
+        if self.count and records[0][0] < self._ts(self.count - 1):
+            self.flags |= FLAG_UNSORTED
+        offset = HEADER.size + self.count * self.record.size
+        for record in records:
+            self.record.pack_into(self._map, offset, *record)
+            offset += self.record.size
+        self.count += len(records)
+        # The count is updated last: a crash loses the batch, not the file
+        HEADER.pack_into(
+            self._map, 0, MAGIC, self.record.size, self.flags, self.count
+        )
+
+    def _grow(self, needed):
+        capacity = max(self.capacity, 1)
+        while capacity < needed:
+            capacity *= 2
+        self._map.flush()
+        self._map.close()
+        self._file.truncate(HEADER.size + capacity * self.record.size)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE)
+
+    def records(self, start, end):
+        """
+        Records with start <= ts < end.
+        """
+        if self.flags & FLAG_UNSORTED:
+            low, high = 0, self.count
+        else:
+            low = bisect.bisect_left(self, start)
+            high = bisect.bisect_left(self, end, low)
+        data = self._map[
+            HEADER.size + low * self.record.size : HEADER.size + high * self.record.size
+        ]
+        for record in self.record.iter_unpack(data):
+            if start <= record[0] < end:
+                yield record
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        if not self._map.closed:
+            if self.writable:
+                self._map.flush()
+            self._map.close()
+        self._file.close()
+
+
+class HistoryStore:
+    def __init__(
+        self,
+        folder=HISTORY_FOLDER,
+        flush_interval=HISTORY_FLUSH_INTERVAL,
+        buffer_records=HISTORY_BUFFER_RECORDS,
+        raw_days=HISTORY_RAW_DAYS,
+        rollup_days=HISTORY_ROLLUP_DAYS,
+    ) -> None:
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.flush_interval = flush_interval
+        self.buffer_records = buffer_records
+        self.retention = {"raw": raw_days}
+        self.retention.update({name: rollup_days for name in RESOLUTIONS})
+
+        self.series = self._load_series()
+        self._series_saved = len(self.series)
+        self._buffer = []
+        # {(resolution, series id, bucket ts): [count, min, max, sum]}
+        self._buckets = {}
+        # {(kind, day): Segment} open for writing
+        self._segments = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+
+    def _load_series(self):
+        try:
+            with open(self.folder / "series.json", "rb") as f:
+                return json.loads(f.read())
+        except FileNotFoundError:
+            return {}
+
+    def _series_id(self, name):
+        series_id = self.series.get(name)
+        if series_id is None:
+            if len(self.series) > MAX_SERIES:
+                raise ValueError(f"Too many history series, cannot add {name}")
+            series_id = self.series[name] = len(self.series)
+        return series_id
+
+    def add(self, values: dict, ts=None, prefix=""):
+        """
+        Buffers the numeric values of `{key: value}`, as the series
+        `prefix + key`, at `ts` (ms, now by default).
+        """
+        if ts is None:
+            ts = int(time.time() * 1000)
+        with self._lock:
+            for key, value in values.items():
+                if isinstance(value, bool):
+                    value = float(value)
+                elif not isinstance(value, (int, float)):
+                    continue
+                self._buffer.append((ts, self._series_id(prefix + key), float(value)))
+            full = len(self._buffer) >= self.buffer_records
+        if full or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self, close_buckets=False):
+        """
+        Writes the buffered samples and the rollup buckets that ended, or
+        all of them with `close_buckets` (e.g. on shutdown).
+        """
+        with self._lock:
+            self._last_flush = time.monotonic()
+            buffer, self._buffer = self._buffer, []
+            if len(self.series) != self._series_saved:
+                # Names first, so written records always have one
+                write_atomic(
+                    self.folder / "series.json",
+                    json.dumps(self.series).encode(),
+                    sync=True,
+                )
+                self._series_saved = len(self.series)
+
+            # Stable: samples of the same ms keep their order
+            buffer.sort(key=itemgetter(0))
+            for day, records in self._by_day(buffer):
+                self._segment("raw", day, RAW).append(records)
+            for ts, series_id, value in buffer:
+                for name, seconds in RESOLUTIONS.items():
+                    bucket = ts - ts % (seconds * 1000)
+                    stats = self._buckets.get((name, series_id, bucket))
+                    if stats is None:
+                        stats = [1, value, value, value]
+                        self._buckets[(name, series_id, bucket)] = stats
+                    else:
+                        stats[0] += 1
+                        stats[1] = min(stats[1], value)
+                        stats[2] = max(stats[2], value)
+                        stats[3] += value
+
+            now = int(time.time() * 1000)
+            ended = sorted(
+                (bucket, name, series_id)
+                for (name, series_id, bucket) in self._buckets
+                if close_buckets or bucket + RESOLUTIONS[name] * 1000 <= now
+            )
+            rollups = {}
+            for bucket, name, series_id in ended:
+                stats = self._buckets.pop((name, series_id, bucket))
+                rollups.setdefault(name, []).append((bucket, series_id, *stats))
+            for name, records in rollups.items():
+                for day, day_records in self._by_day(records):
+                    self._segment(name, day, ROLLUP).append(day_records)
+
+            for segment in self._segments.values():
+                segment.flush()
+            self._prune(now)
+
+    @staticmethod
+    def _by_day(records):
+        day_records = {}
+        for record in records:
+            day_records.setdefault(_day(record[0]), []).append(record)
+        return sorted(day_records.items())
+
+    def _segment(self, kind, day, record):
+        segment = self._segments.get((kind, day))
+        if segment is None:
+            segment = self._segments[(kind, day)] = Segment(
+                self.folder / kind / f"{day}.bin", record
+            )
+        return segment
+
+    def _prune(self, now):
+        # Closes the segments of past days and deletes the expired ones
+        today = _day(now)
+        for key in [key for key in self._segments if key[1] < today]:
+            self._segments.pop(key).close()
+        for kind, days in self.retention.items():
+            oldest = _day(now - days * DAY_MS)
+            for path in (self.folder / kind).glob("*.bin"):
+                if path.stem < oldest:
+                    logging.info(f"Deleting expired history segment {path}")
+                    path.unlink()
+
+    def _segment_records(self, kind, record, start, end):
+        for day in _days(start, end - 1):
+            with self._lock:
+                segment = self._segments.get((kind, day))
+                # Segments open for writing are read under the lock
+                records = list(segment.records(start, end)) if segment else None
+            if records is not None:
+                yield from records
+                continue
+            path = self.folder / kind / f"{day}.bin"
+            if not path.exists():
+                continue
+            segment = Segment(path, record, writable=False)
+            try:
+                yield from segment.records(start, end)
+            finally:
+                segment.close()
+
+    def query(self, series, start, end=None, resolution=None):
+        """
+        Values of `series` with start <= ts < end (ms): [(ts, value)], or
+        with a `resolution` of RESOLUTIONS [(ts, count, min, max, mean)]
+        per bucket.
+        """
+        end = end if end is not None else int(time.time() * 1000) + 1
+        series_id = self.series.get(series)
+        if series_id is None:
+            return []
+        if resolution is None:
+            values = [
+                (ts, value)
+                for ts, record_id, value in self._segment_records("raw", RAW, start, end)
+                if record_id == series_id
+            ]
+            with self._lock:
+                values += [
+                    (ts, value)
+                    for ts, record_id, value in self._buffer
+                    if record_id == series_id and start <= ts < end
+                ]
+            return sorted(values, key=itemgetter(0))
+
+        if resolution not in RESOLUTIONS:
+            raise ValueError(
+                f"Unknown resolution {resolution}, use one of {list(RESOLUTIONS)}"
+            )
+        buckets = {}
+
+        def merge(bucket, count, low, high, total):
+            stats = buckets.get(bucket)
+            # A bucket written in several parts (e.g. across a restart)
+            if stats is None:
+                buckets[bucket] = [count, low, high, total]
+            else:
+                stats[0] += count
+                stats[1] = min(stats[1], low)
+                stats[2] = max(stats[2], high)
+                stats[3] += total
+
+        rollups = self._segment_records(resolution, ROLLUP, start, end)
+        for bucket, record_id, *stats in rollups:
+            if record_id == series_id:
+                merge(bucket, *stats)
+        with self._lock:
+            open_buckets = [
+                (bucket, *stats)
+                for (name, record_id, bucket), stats in self._buckets.items()
+                if name == resolution
+                and record_id == series_id
+                and start <= bucket < end
+            ]
+            # Buffered samples are not in the buckets yet
+            seconds = RESOLUTIONS[resolution] * 1000
+            buffered = [
+                (ts - ts % seconds, 1, value, value, value)
+                for ts, record_id, value in self._buffer
+                if record_id == series_id and start <= ts - ts % seconds < end
+            ]
+        for bucket in open_buckets + buffered:
+            merge(*bucket)
+        return [
+            (bucket, count, low, high, total / count)
+            for bucket, (count, low, high, total) in sorted(buckets.items())
+        ]
+
+    def replay(self, prefix, start, end=None, batch_size=None):
+        """
+        The samples of the series named `prefix + key` between start and
+        end (ms) as `[{"ts": ts, "values": {key: value}}]`, oldest first, in
+        lists of at most `batch_size` records.
+        """
+        end = end if end is not None else int(time.time() * 1000) + 1
+        keys = {
+            series_id: name[len(prefix):]
+            for name, series_id in self.series.items()
+            if name.startswith(prefix)
+        }
+        samples = {}
+        for ts, series_id, value in self._segment_records("raw", RAW, start, end):
+            if series_id in keys:
+                samples.setdefault(ts, {})[keys[series_id]] = value
+        records = [
+            {"ts": ts, "values": values} for ts, values in sorted(samples.items())
+        ]
+        if batch_size:
+            return [
+                records[i : i + batch_size] for i in range(0, len(records), batch_size)
+            ]
+        return [records] if records else []
+
+    def close(self):
+        with self._lock:
+            self.flush(close_buckets=True)
+            for segment in self._segments.values():
+                segment.close()
+            self._segments = {}
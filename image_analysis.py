@@ -0,0 +1,218 @@
+"""
+Statistics of the camera pictures, computed on the Pi at every capture.
+
+Each picture is decoded at a low resolution (the JPEG decoder downscales
+while decoding, see `size`) and split into a `grid` of regions. For every
+region the pixels are counted in a histogram of `bins` hue bins, plus one
+bin of gray pixels (low saturation, e.g. mold or dust) and one of dark
+pixels, whose hue means nothing. From it:
+
+- the mean hue (degrees, of the colored pixels) and brightness (%) of the
+  picture and of each region, e.g. the product browning,
+- the change score: the largest difference between the histograms of a
+  region in two pictures (total variation distance, 0 for identical
+  pictures, 1 for nothing in common), so a change in a single region
+  counts fully.
+
+The statistics are sent as telemetry ("image_hue", "image_brightness_r0c1",
+"image_change" against the previous picture...). The full picture is only
+stored when it changed by `threshold` or more since the last stored one,
+or when none was stored for `keyframe_interval` seconds.
+
+Decoding needs Pillow (in requirements.txt), an ImageAnalyzer cannot be
+created without it. Set IMAGE_ANALYSIS to False to store every picture.
+"""
+import collections
+import io
+import math
+import threading
+from typing import NamedTuple
+
+import numpy as np
+
+import instrumentation
+from settings import (
+    IMAGE_ANALYSIS_BINS,
+    IMAGE_ANALYSIS_GRID,
+    IMAGE_ANALYSIS_SIZE,
+    IMAGE_CHANGE_THRESHOLD,
+    IMAGE_KEYFRAME_INTERVAL,
+)
+
+# Below this saturation pixels are gray, below this brightness dark
+GRAY_SATURATION = 0.15
+DARK_BRIGHTNESS = 0.1
+
+
+class FrameAnalysis(NamedTuple):
+    hue: float  # degrees, NaN without colored pixels
+    brightness: float  # 0-1
+    region_hue: np.ndarray
+    region_brightness: np.ndarray
+    # (regions, bins + 2) fractions of the pixels of each region, the last
+    # two bins are the gray and the dark pixels
+    histograms: np.ndarray
+
+    def telemetry(self, grid):
+        telemetry = {"image_brightness": round(self.brightness * 100, 1)}
+        if not math.isnan(self.hue):
+            telemetry["image_hue"] = round(self.hue)
+        columns = grid[1]
+        for index, histogram in enumerate(self.histograms):
+            region = f"r{index // columns}c{index % columns}"
+            if not math.isnan(self.region_hue[index]):
+                telemetry[f"image_hue_{region}"] = round(float(self.region_hue[index]))
+            telemetry[f"image_brightness_{region}"] = round(
+                float(self.region_brightness[index]) * 100, 1
+            )
+            telemetry[f"image_gray_{region}"] = round(float(histogram[-2]) * 100, 1)
+        return telemetry
+
+
+def change_score(histograms, previous):
+    # Largest total variation distance between the regions' histograms
+    return float(np.abs(histograms - previous).sum(axis=1).max() / 2)
+
+
+class ImageAnalyzer:
+    def __init__(
+        self,
+        size=IMAGE_ANALYSIS_SIZE,
+        grid=IMAGE_ANALYSIS_GRID,
+        bins=IMAGE_ANALYSIS_BINS,
+        threshold=IMAGE_CHANGE_THRESHOLD,
+        keyframe_interval=IMAGE_KEYFRAME_INTERVAL,
+        max_pending=100,
+    ) -> None:
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            raise ImportError(
+                "Image analysis needs Pillow: pip install Pillow, "
+                "or set IMAGE_ANALYSIS to False"
+            ) from None
+        self.size = size
+        self.grid = grid
+        self.bins = bins
+        self.threshold = threshold
+        self.keyframe_interval = keyframe_interval
+        # Histograms of the previous and of the last stored pictures
+        self._previous = None
+        self._stored = None
+        self._stored_at = None
+        self._regions = None
+        # (ts in ms, telemetry) of each picture, until collected
+        self._pending = collections.deque(maxlen=max_pending)
+        self._lock = threading.Lock()
+
+    def decode(self, data):
+        """
+        The picture as a (height, width, 3) uint8 array, downscaled to fit
+        `size`.
+        """
+        from PIL import Image
+
+        with Image.open(io.BytesIO(data)) as picture:
+            # draft() lets the JPEG decoder downscale while decoding
+            picture.draft("RGB", self.size)
+            picture = picture.convert("RGB")
+            picture.thumbnail(self.size)
+            return np.asarray(picture)
+
+    def _region_map(self, shape):
+        # Region index of every pixel, row by row of the grid
+        if self._regions is None or self._regions.shape != shape:
+            rows, columns = self.grid
+            height, width = shape
+            row = np.arange(height) * rows // height
+            column = np.arange(width) * columns // width
+            self._regions = row[:, None] * columns + column[None, :]
+        return self._regions
+
+    def analyze(self, frame) -> FrameAnalysis:
+        rgb = frame.astype(np.float32) / 255
+        value = rgb.max(axis=2)
+        delta = value - rgb.min(axis=2)
+        red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            saturation = np.where(value > 0, delta / value, 0)
+            # Hue in sextants [0, 6) of the color wheel
+            sextant = np.where(
+                value == red,
+                ((green - blue) / delta) % 6,
+                np.where(value == green, (blue - red) / delta + 2, (red - green) / delta + 4),
+            )
+        sextant = np.nan_to_num(sextant)
+
+        regions = self._region_map(value.shape)
+        count = self.grid[0] * self.grid[1]
+        colored = (saturation >= GRAY_SATURATION) & (value >= DARK_BRIGHTNESS)
+        bins = np.minimum((sextant * self.bins / 6).astype(np.intp), self.bins - 1)
+        bins = np.where(colored, bins, self.bins)
+        bins = np.where(value < DARK_BRIGHTNESS, self.bins + 1, bins)
+        width = self.bins + 2
+        histograms = np.bincount(
+            (regions * width + bins).ravel(), minlength=count * width
+        ).reshape(count, width)
+        pixels = histograms.sum(axis=1)
+
+        # Hue is an angle: average the unit vectors of the colored pixels
+        angle = sextant * (math.pi / 3)
+        flat = regions.ravel()
+        cosine = np.bincount(flat, np.where(colored, np.cos(angle), 0).ravel(), count)
+        sine = np.bincount(flat, np.where(colored, np.sin(angle), 0).ravel(), count)
+        brightness = np.bincount(flat, value.ravel(), count)
+        region_hue = np.degrees(np.arctan2(sine, cosine)) % 360
+        region_hue[histograms[:, : self.bins].sum(axis=1) == 0] = np.nan
+        hue = math.nan
+        if colored.any():
+            hue = math.degrees(math.atan2(sine.sum(), cosine.sum())) % 360
+        return FrameAnalysis(
+            hue=hue,
+            brightness=float(brightness.sum() / pixels.sum()),
+            region_hue=region_hue,
+            region_brightness=brightness / pixels,
+            histograms=histograms / pixels[:, None],
+        )
+
+    def process(self, image) -> bool:
+        """
+        Analyzes a CapturedImage and queues its telemetry. Returns whether
+        the full picture should be stored.
+        """
+        with instrumentation.timed("image_analysis_seconds"):
+            frame = self.decode(image.data)
+            analysis = self.analyze(frame)
+        telemetry = analysis.telemetry(self.grid)
+        if self._previous is not None:
+            telemetry["image_change"] = round(
+                change_score(analysis.histograms, self._previous), 3
+            )
+        self._previous = analysis.histograms
+
+        keep = (
+            self.threshold is None
+            or self._stored is None
+            or change_score(analysis.histograms, self._stored) >= self.threshold
+            or (
+                self.keyframe_interval is not None
+                and image.taken_at - self._stored_at >= self.keyframe_interval
+            )
+        )
+        if keep:
+            self._stored = analysis.histograms
+            self._stored_at = image.taken_at
+        telemetry["image_stored"] = int(keep)
+        with self._lock:
+            self._pending.append((int(image.taken_at * 1000), telemetry))
+        return keep
+
+    def collect(self):
+        """
+        The (ts in ms, telemetry) of the pictures analyzed since the last
+        call.
+        """
+        with self._lock:
+            pending = list(self._pending)
+            self._pending.clear()
+        return pending
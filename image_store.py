@@ -0,0 +1,227 @@
+import bisect
+import json
+import os
+import threading
+import time
+import logging
+from typing import NamedTuple
+
+from file_utils import write_atomic
+from settings import (
+    IMAGES_FOLDER,
+    IMAGES_MAX_AGE,
+    IMAGES_QUOTA_MB,
+    IMAGES_TIERS,
+)
+
+INDEX_FILE = "index.jsonl"
+
+
+class StoredImage(NamedTuple):
+    name: str
+    seq: int
+    taken_at: float
+    size: int
+
+
+class ImageStore:
+    """
+    Saves pictures to `folder` and keeps the folder within a quota.
+
+    Every saved or deleted image is appended to an index file, so listing
+    and eviction never need to scan the folder. The index is rewritten when
+    it holds more deleted than live entries.
+
+    Eviction rules, applied after every save:
+    - time-lapse tiers: `tiers` is a list of (age in hours, N); images older
+      than the age only keep every Nth picture. Use multiples for the Ns of
+      older tiers (e.g. 4 then 12) so the kept pictures stay evenly spaced.
+    - images older than `max_age` days are deleted.
+    - the oldest images are deleted while the total is above `quota_mb`.
+    """
+
+    def __init__(
+        self,
+        folder=IMAGES_FOLDER,
+        quota_mb=IMAGES_QUOTA_MB,
+        max_age=IMAGES_MAX_AGE,
+        tiers=IMAGES_TIERS,
+    ) -> None:
+        self.folder = folder
+        self.quota = quota_mb * 1024 * 1024
+        self.max_age = max_age * 86400 if max_age else None
+        self.tiers = sorted((hours * 3600, every) for hours, every in tiers)
+        self.index_path = os.path.join(folder, INDEX_FILE)
+        os.makedirs(folder, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # Images by sequence number, `seqs` is kept sorted (oldest first)
+        self.images: dict[int, StoredImage] = {}
+        self.seqs: list[int] = []
+        self.total_bytes = 0
+        self._next_seq = 0
+        self._dead_entries = 0
+        # Last sequence number thinned out by each tier
+        self._tier_cursors = [-1] * len(self.tiers)
+
+        if os.path.exists(self.index_path):
+            self._load_index()
+        else:
+            self._rebuild_index()
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def _load_index(self):
+        with open(self.index_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry["op"] == "add":
+                    self._next_seq = max(self._next_seq, entry["seq"] + 1)
+                    self._add_entry(
+                        StoredImage(
+                            entry["name"], entry["seq"], entry["ts"], entry["size"]
+                        )
+                    )
+                else:
+                    self._dead_entries += 2
+                    self._remove_entry(entry["seq"])
+
+    def _rebuild_index(self):
+        # Only needed once, for folders created before the index existed
+        logging.info(f"Building image index for {self.folder}")
+        files = [
+            entry
+            for entry in os.scandir(self.folder)
+            if entry.is_file() and entry.name.endswith(".jpg")
+        ]
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for seq, entry in enumerate(files):
+            stat = entry.stat()
+            self._add_entry(StoredImage(entry.name, seq, stat.st_mtime, stat.st_size))
+        self._next_seq = len(files)
+        self._compact_index()
+
+    def _add_entry(self, image):
+        self.images[image.seq] = image
+        bisect.insort(self.seqs, image.seq)
+        self.total_bytes += image.size
+
+    def _remove_entry(self, seq):
+        image = self.images.pop(seq, None)
+        if image is None:
+            return None
+        del self.seqs[bisect.bisect_left(self.seqs, seq)]
+        self.total_bytes -= image.size
+        return image
+
+    def _append_index(self, entries):
+        with open(self.index_path, "a") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries))
+
+    def _compact_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for seq in self.seqs:
+                image = self.images[seq]
+                entry = {
+                    "op": "add",
+                    "name": image.name,
+                    "seq": image.seq,
+                    "ts": image.taken_at,
+                    "size": image.size,
+                }
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.index_path)
+        self._dead_entries = 0
+
+    def save(self, name, data, taken_at=None):
+        write_atomic(os.path.join(self.folder, name), data)
+
+        with self._lock:
+            image = StoredImage(
+                name, self._next_seq, taken_at or time.time(), len(data)
+            )
+            self._next_seq += 1
+            self._add_entry(image)
+            self._append_index(
+                [
+                    {
+                        "op": "add",
+                        "name": name,
+                        "seq": image.seq,
+                        "ts": image.taken_at,
+                        "size": image.size,
+                    }
+                ]
+            )
+            self._enforce()
+        return image
+
+    def list(self, since=None, until=None):
+        with self._lock:
+            images = [self.images[seq] for seq in self.seqs]
+        # Images are in capture order, so the time range is found by bisection
+        start = 0
+        end = len(images)
+        if since is not None:
+            start = bisect.bisect_left(images, since, key=lambda image: image.taken_at)
+        if until is not None:
+            end = bisect.bisect_right(images, until, key=lambda image: image.taken_at)
+        return images[start:end]
+
+    def enforce(self, now=None):
+        with self._lock:
+            self._enforce(now)
+
+    def _enforce(self, now=None):
+        now = now or time.time()
+        evicted = []
+
+        for idx, (age, every) in enumerate(self.tiers):
+            # Only look at the images that crossed the tier age since last time
+            start = bisect.bisect_right(self.seqs, self._tier_cursors[idx])
+            thinned = []
+            for position in range(start, len(self.seqs)):
+                seq = self.seqs[position]
+                if now - self.images[seq].taken_at < age:
+                    break
+                self._tier_cursors[idx] = seq
+                if seq % every:
+                    thinned.append(seq)
+            evicted.extend(self._remove_entry(seq) for seq in thinned)
+
+        if self.max_age:
+            while self.seqs and now - self.images[self.seqs[0]].taken_at > self.max_age:
+                evicted.append(self._remove_entry(self.seqs[0]))
+
+        while self.seqs and self.total_bytes > self.quota:
+            evicted.append(self._remove_entry(self.seqs[0]))
+
+        if evicted:
+            self._delete_files(evicted)
+
+    def _delete_files(self, images):
+        self._append_index([{"op": "del", "seq": image.seq} for image in images])
+        self._dead_entries += 2 * len(images)
+        for image in images:
+            for path in (
+                os.path.join(self.folder, image.name),
+                os.path.join(self.folder, "thumbnails", image.name),
+            ):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        logging.info(f"Evicted {len(images)} images")
+        if self._dead_entries > len(self.seqs):
+            self._compact_index()
+
+    def usage(self):
+        return {
+            "images_count": len(self.seqs),
+            "images_disk_usage": round(self.total_bytes / 1024 / 1024, 2),
+            "images_quota_usage": round(self.total_bytes * 100 / self.quota, 2),
+        }
@@ -0,0 +1,213 @@
+"""
+Latency instrumentation of the controller hot paths.
+
+Durations are recorded in fixed-size, HDR-style histograms: buckets grow
+exponentially, each power of two being split in `2 ** precision` linear
+sub-buckets, so every value is kept within a few percent whatever its
+magnitude, in constant memory and time.
+
+    with timed("sensor_read_seconds", sensor="Top"):
+        ...
+    observe("scheduler_lateness_seconds", lateness)
+
+A summary of a few histograms is exported as ThingsBoard telemetry with
+`telemetry()`, and all of them in the Prometheus text format with
+`prometheus_text()`, served over HTTP by `serve()`.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from settings import (
+    METRICS_HOST,
+    METRICS_PRECISION,
+    METRICS_QUANTILES,
+    METRICS_TELEMETRY,
+)
+
+UNIT = 1e-6  # values are bucketed in microseconds
+
+
+class Histogram:
+    def __init__(self, highest=3600.0, precision=METRICS_PRECISION) -> None:
+        self.precision = precision
+        self._sub_buckets = 1 << precision
+        self._half = self._sub_buckets >> 1
+        self._highest = int(highest / UNIT)
+        self.counts = [0] * (self._index(self._highest) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self._lock = threading.Lock()
+
+    def _index(self, value):
+        if value < self._sub_buckets:
+            return value
+        shift = value.bit_length() - self.precision
+        return self._sub_buckets + (shift - 1) * self._half + (value >> shift) - self._half
+
+    def _value(self, index):
+        # Middle of the bucket
+        if index < self._sub_buckets:
+            return index
+        shift, offset = divmod(index - self._sub_buckets, self._half)
+        shift += 1
+        return ((offset + self._half) << shift) + (1 << (shift - 1))
+
+    def record(self, seconds):
+        value = min(max(int(seconds / UNIT), 0), self._highest)
+        index = self._index(value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if self.max is None or seconds > self.max:
+                self.max = seconds
+
+    def quantiles(self, quantiles=METRICS_QUANTILES):
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+        result = {}
+        if not total:
+            return {quantile: None for quantile in quantiles}
+        for quantile in quantiles:
+            rank = max(1, round(quantile * total))
+            seen = 0
+            for index, count in enumerate(counts):
+                seen += count
+                if seen >= rank:
+                    result[quantile] = min(self._value(index) * UNIT, self.max)
+                    break
+        return result
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.histograms: dict[tuple, Histogram] = {}
+        self.help: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help=None, **labels) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(key, Histogram())
+                if help:
+                    self.help[name] = help
+        return histogram
+
+    def observe(self, name, seconds, **labels):
+        self.histogram(name, **labels).record(seconds)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        histogram = self.histogram(name, **labels)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.record(time.perf_counter() - started)
+
+    def telemetry(self, names=METRICS_TELEMETRY, quantile=0.95):
+        """
+        A small fixed summary for the uplink: the `quantile` and the max of
+        each histogram of `names`, in milliseconds and over all its labels
+        (the worst of them), e.g. `gpio_write_p95_ms`. The full set is served
+        by the Prometheus endpoint.
+        """
+        summary = {}
+        for (name, labels), histogram in list(self.histograms.items()):
+            if name not in names or not histogram.count:
+                continue
+            value = histogram.quantiles((quantile,))[quantile]
+            worst = summary.setdefault(name, [value, histogram.max])
+            worst[0] = max(worst[0], value)
+            worst[1] = max(worst[1], histogram.max)
+        telemetry = {}
+        for name, (value, highest) in summary.items():
+            key = name.removesuffix("_seconds")
+            telemetry[f"{key}_p{quantile * 100:g}_ms"] = round(value * 1000, 3)
+            telemetry[f"{key}_max_ms"] = round(highest * 1000, 3)
+        return telemetry
+
+    def prometheus_text(self):
+        lines = []
+        names = {}
+        for (name, labels), histogram in list(self.histograms.items()):
+            names.setdefault(name, []).append((labels, histogram))
+        for name, series in sorted(names.items()):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} summary")
+            for labels, histogram in series:
+                for quantile, value in histogram.quantiles().items():
+                    if value is None:
+                        continue
+                    label_text = _labels(labels + (("quantile", f"{quantile:g}"),))
+                    lines.append(f"{name}{label_text} {value:.6f}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+registry = Registry()
+histogram = registry.histogram
+observe = registry.observe
+timed = registry.timed
+telemetry = registry.telemetry
+prometheus_text = registry.prometheus_text
+
+
+def scheduler_listener(event):
+    """
+    APScheduler EVENT_JOB_SUBMITTED listener recording how late each job
+    starts compared to its scheduled time.
+    """
+    scheduled = event.scheduled_run_times[-1]
+    lateness = time.time() - scheduled.timestamp()
+    observe("scheduler_lateness_seconds", max(lateness, 0.0))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would flood the journal
+        pass
+
+
+def serve(port, host=METRICS_HOST):
+    """
+    Serves the Prometheus endpoint on http://host:port/metrics from a
+    daemon thread. Only to the Pi itself by default, "" serves it on every
+    interface.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="metrics-server", daemon=True
+    ).start()
+    logging.info(f"Serving metrics on {host or '*'}:{port}")
+    return server
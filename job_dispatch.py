@@ -0,0 +1,84 @@
+"""
+How the periodic jobs are spread over time and over threads.
+
+Started together, the interval jobs (the camera, the relay intervals, the
+climate ticks, the monitor and the publish loops) would all fire at the
+same instants, every time their periods line up. Each periodic job instead
+starts at a phase offset within its period, derived from its id so it is
+the same after a restart (the pictures keep their times of day) and
+different for every zone.
+
+The scheduler runs the jobs on two thread pools:
+
+- "default": the actuator jobs (schedule steps, relay intervals, climate
+  ticks), which must switch the relays on time,
+- "heavy": the slow jobs (camera captures, checkpoints, the drying
+  estimation, the scheduler monitor), with few workers, so that however
+  long they take they never hold the threads of the actuator jobs.
+
+Periodic jobs coalesce their missed runs and never run twice at once.
+"""
+import zlib
+from datetime import datetime, timedelta
+
+from apscheduler.events import EVENT_JOB_SUBMITTED
+from apscheduler.executors.pool import ThreadPoolExecutor
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.schedulers.background import BackgroundScheduler
+
+import instrumentation
+from settings import SCHEDULER_HEAVY_WORKERS, SCHEDULER_WORKERS
+
+HEAVY = "heavy"
+
+
+def create_scheduler(
+    scheduler_class=BackgroundScheduler,
+    workers=SCHEDULER_WORKERS,
+    heavy_workers=SCHEDULER_HEAVY_WORKERS,
+):
+    """
+    A scheduler with the "default" and "memory" job stores and the
+    "default" and "heavy" executors, recording how late the jobs start.
+    """
+    scheduler = scheduler_class()
+    scheduler.add_executor(ThreadPoolExecutor(workers), "default")
+    scheduler.add_executor(ThreadPoolExecutor(heavy_workers), HEAVY)
+    scheduler.add_jobstore(MemoryJobStore(), "default")
+    scheduler.add_jobstore(MemoryJobStore(), "memory")
+    scheduler.add_listener(instrumentation.scheduler_listener, EVENT_JOB_SUBMITTED)
+    return scheduler
+
+
+def phase_offset(job_id, period):
+    # Where in [0, period) the job runs, the same for the same id
+    return period * (zlib.crc32(job_id.encode()) / 2**32)
+
+
+def add_periodic(
+    scheduler,
+    func,
+    seconds,
+    id,
+    heavy=False,
+    jobstore="memory",
+    now=None,
+    **kwargs,
+):
+    """
+    Adds an interval job running every `seconds`, first at its phase offset
+    from `now`, on the "heavy" executor when `heavy`.
+    """
+    now = now or datetime.now()
+    return scheduler.add_job(
+        func,
+        "interval",
+        seconds=seconds,
+        id=id,
+        jobstore=jobstore,
+        executor=HEAVY if heavy else "default",
+        start_date=now + timedelta(seconds=phase_offset(id, seconds)),
+        coalesce=True,
+        max_instances=1,
+        **kwargs,
+    )
@@ -0,0 +1,128 @@
+"""
+Logging configuration, done once by the entry points with `setup_logging()`.
+
+- Records below `level` are never formatted nor written.
+- A message logged with `extra=RATE_LIMITED` (e.g. the frequent DHT
+  errors) and repeated within `rate_limit` seconds (same logger, level
+  and formatted text) is written once, then summarised with its repeat
+  count. Other records, e.g. the actuator changes, are always written.
+- With `ring_size`, the last debug records are kept in memory and only
+  written when an error is logged, to give its context.
+
+Hot paths log with lazy %-style arguments, `logging.debug("x %s", x)`, so
+nothing is formatted for the records that are dropped.
+"""
+import collections
+import logging
+import sys
+import threading
+import time
+
+from settings import LOG_FORMAT, LOG_LEVEL, LOG_RATE_LIMIT, LOG_RING_SIZE
+
+# `extra` of the records that may be rate limited
+RATE_LIMITED = {"rate_limit": True}
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, interval) -> None:
+        super().__init__()
+        self.interval = interval
+        # (logger, level, message) -> [window start, suppressed count]
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        # The DebugRingHandler asks first whether the record will be
+        # written: the decision is kept on it, so it is only taken once
+        passed = getattr(record, "rate_limit_passed", None)
+        if passed is None:
+            passed = record.rate_limit_passed = self._passes(record)
+        return passed
+
+    def _passes(self, record):
+        if not getattr(record, "rate_limit", False):
+            return True
+        key = (record.name, record.levelno, record.getMessage())
+        now = record.created
+        with self._lock:
+            seen = self._seen.get(key)
+            if seen is not None and now - seen[0] < self.interval:
+                seen[1] += 1
+                return False
+            suppressed = seen[1] if seen is not None else 0
+            self._seen[key] = [now, 0]
+            if len(self._seen) > 1000:
+                # Forget the messages that are not repeated anymore
+                self._seen = {
+                    key: value
+                    for key, value in self._seen.items()
+                    if now - value[0] < self.interval
+                }
+        if suppressed:
+            record.msg = f"{record.msg} (repeated {suppressed} times)"
+        return True
+
+
+class DebugRingHandler(logging.Handler):
+    """
+    Keeps the last `size` records below `flush_level` in memory, and writes
+    them to `target` when a record at or above `flush_level` is handled and
+    passes the filters of `target`, e.g. is not rate limited.
+    """
+
+    def __init__(self, target: logging.Handler, size, flush_level=logging.ERROR) -> None:
+        super().__init__(logging.DEBUG)
+        self.target = target
+        self.flush_level = flush_level
+        self.ring = collections.deque(maxlen=size)
+
+    def emit(self, record):
+        if record.levelno < self.flush_level:
+            if record.levelno < self.target.level:
+                self.ring.append(record)
+            return
+        if not self.ring or not self.target.filter(record):
+            return
+        # The context itself is written as it is, not rate limited
+        with self.target.lock:
+            self.target.emit(
+                logging.makeLogRecord(
+                    {
+                        "name": "logging_setup",
+                        "levelno": logging.ERROR,
+                        "levelname": "ERROR",
+                        "msg": "Last %d debug events before the error:",
+                        "args": (len(self.ring),),
+                        "created": time.time(),
+                    }
+                )
+            )
+            while self.ring:
+                self.target.emit(self.ring.popleft())
+
+
+def setup_logging(
+    level=LOG_LEVEL, rate_limit=LOG_RATE_LIMIT, ring_size=LOG_RING_SIZE, stream=None
+):
+    level = logging.getLevelName(level) if isinstance(level, str) else level
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setLevel(level)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if rate_limit:
+        handler.addFilter(RateLimitFilter(rate_limit))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    if ring_size:
+        # Added first, so the context is written before the error itself
+        root.addHandler(DebugRingHandler(handler, ring_size))
+        # Debug records must be created to be kept in the ring
+        root.setLevel(min(level, logging.DEBUG))
+    else:
+        root.setLevel(level)
+    root.addHandler(handler)
+    # Libraries are only interesting when something goes wrong
+    for name in ("apscheduler", "tb_device_mqtt", "tb_gateway_mqtt", "paho"):
+        logging.getLogger(name).setLevel(max(level, logging.WARNING))
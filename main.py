@@ -1,105 +1,310 @@
 import sys, signal
 
 import logging
+import backends
+import instrumentation
+from async_runtime import AsyncRuntime
+from logging_setup import setup_logging
+from history_store import HistoryStore
+from job_dispatch import add_periodic
+from rpc import history_commands, schedule_commands, supervisor_commands
 from schedule_control import ScheduleControl
+from supervisor import Supervisor
+from tb_gateway import Gateway
+from schedule_timeline import compile_schedule, load_schedule
 from tb_device_client import RPIDevice, TempHumDevice
-from actuators_control import CameraActuator, DummyActuator
+from zones import ZoneController, load_zones
+from actuators_control import (
+    ActuatorsControl,
+    CameraActuator,
+    DummyActuator,
+    RelayActuator,
+)
+from climate_control import ClimateController, engine_climate
+from camera_service import CameraCaptureService
+from image_store import ImageStore
 
-from settings import PUBLISHING_INTERVAL, PHOTO_INTERVAL
+from settings import (
+    ASYNC_RUNTIME,
+    CONTROL_MAX_TEMPERATURE,
+    CONTROL_MODE,
+    DRYING_CHECK_INTERVAL,
+    DRYING_TARGET_HUMIDITY,
+    GPIO_BACKEND,
+    HISTORY_FOLDER,
+    IMAGE_ANALYSIS,
+    METRICS_PORT,
+    MQTT_GATEWAY,
+    SAMPLING_INTERVAL,
+    PHOTO_INTERVAL,
+    RELAY_PINS,
+    SCHEDULE_PATH,
+    SENSORS,
+    SUPERVISOR_HEARTBEAT_INTERVAL,
+    SUPERVISOR_TIMEOUTS,
+    ZONES_PATH,
+)
 import time
 import os
 
-logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
-
-
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
 
 if __name__ == "__main__":
-    camera = CameraActuator("camera")
-    relay_1 = DummyActuator("relay_1")
-    relay_2 = DummyActuator("relay_2")
-    fan = DummyActuator("fan")
-    heater = DummyActuator("heater")
-
-    # Every relay status defaults to 0
-    # which means that at every new schedule
-    # we only need to specify which relays are on
-    schedule = {
-        "start_time": None,
-        "schedule": [
-            {
-                "duration": 30,  # minutes,
-                "actions": [
-                    {"actuator": relay_1, "status": 1},
-                    {"actuator": relay_2, "status": 1},
-                ],
-            },
-            {
-                "duration": 30,  # minutes,
-                "actions": [
-                    {"actuator": fan, "status": 1},
-                    {"actuator": heater, "status": 1},
-                ],
-            },
-            {
-                "duration": 30,  # minutes,
-                "actions": [
-                    {"actuator": relay_1, "status": 1},
-                    {"actuator": heater, "status": 1},
-                ],
-            },
-        ],
-        "intervals": [
-            {
-                # Take a picture evet 30 min
-                "interval": 30,
-                "actuator": camera,
-                "status": 1,
-            },
-            {
-                "interval": 5,
-                "actuator": relay_1,
-                "status": 1,
-            },
-        ],
-    }
-    scheduler = ScheduleControl(schedule, start_delay=5)
+    setup_logging()
+    if METRICS_PORT:
+        instrumentation.serve(METRICS_PORT)
+
+    image_store = ImageStore()
+    # Telemetry and actuator changes are also kept locally
+    history = HistoryStore() if HISTORY_FOLDER else None
+    # Statistics of every picture, which is only stored when it changed.
+    # The analyzer (numpy and Pillow) is imported on the first capture.
+    camera_service = CameraCaptureService(image_store, analyze=IMAGE_ANALYSIS)
+    camera = CameraActuator("camera", service=camera_service)
+
+    # Racks of the zones file, or the single room of RELAY_PINS
+    zones_config = load_zones(ZONES_PATH) if ZONES_PATH else None
+    relay_pins = RELAY_PINS
+    if zones_config:
+        relay_pins = {
+            (zone["name"], label): pin
+            for zone in zones_config
+            for label, pin in zone["relays"].items()
+        }
+
+    # All the relays share one line request, so a schedule step is one write
+    bank = None
+    if relay_pins:
+        bank = backends.create("gpio", GPIO_BACKEND, relay_pins.values())
+
+    def make_actuator(label, zone=None):
+        key = (zone, label) if zone else label
+        if label == camera.label:
+            return camera
+        if key in relay_pins:
+            return RelayActuator(label, relay_pins[key], bank)
+        return DummyActuator(label)
+
+    # The schedule refers to the actuators by label. The heater and the fan
+    # are always there for the climate controller.
+    zones = None
+    if zones_config:
+        zones = ZoneController()
+        for zone in zones_config:
+            timeline = compile_schedule(zone["schedule"])
+            zones.add_zone(
+                zone["name"],
+                timeline,
+                ActuatorsControl(
+                    make_actuator(label, zone["name"])
+                    for label in sorted(timeline.actuators | {"heater", "fan"})
+                ),
+                sensors_config=zone.get("sensors", ()),
+                control_mode=CONTROL_MODE,
+            )
+    else:
+        timeline = compile_schedule(load_schedule(SCHEDULE_PATH))
+        actuators = ActuatorsControl(
+            make_actuator(label)
+            for label in sorted(timeline.actuators | {"heater", "fan"})
+        )
+
+    # A single TempHumDevice publishes the sensors of all the zones
+    th_options = {}
+    if zones:
+        th_options = {"sensors_config": zones.sensors_config, "engine": zones.engine}
+    elif DRYING_TARGET_HUMIDITY is not None:
+        # Ends or extends the run from the humidity of the shelves. Imported
+        # here as it needs numpy.
+        from drying_estimator import DryingEstimator
+
+        th_options = {
+            "estimator": DryingEstimator(sensor["label"] for sensor in SENSORS)
+        }
+
+    # Actuator changes are kept as "actuator/<label>" (or
+    # "actuator/<zone>/<label>") series
+    controls = (
+        {f"{name}/": zone.actuators for name, zone in zones.zones.items()}
+        if zones
+        else {"": actuators}
+    )
+    if history:
+        for prefix, control in controls.items():
+            control.subscribe(
+                lambda label, value, prefix=prefix: history.add(
+                    {label: value}, prefix=f"actuator/{prefix}"
+                )
+            )
+
+    pi = None
+    th = None
+
+    if MQTT_GATEWAY:
+        # Both devices share the gateway connection, named after their class
+        gateway = Gateway(os.getenv("THINGSBOARD_GATEWAY_ACCESS_TOKEN"))
+        pi = RPIDevice(
+            None,
+            image_store=image_store,
+            camera_service=camera_service,
+            client=gateway.device("RPIDevice"),
+            history=history,
+        )
+        th = TempHumDevice(
+            None,
+            states={"maxTemperature": float(CONTROL_MAX_TEMPERATURE)},
+            client=gateway.device("TempHumDevice"),
+            history=history,
+            **th_options,
+        )
+
+    if not MQTT_GATEWAY and os.getenv("THINGSBOARD_PI_ACCESS_TOKEN"):
+        pi = RPIDevice(
+            os.getenv("THINGSBOARD_PI_ACCESS_TOKEN"),
+            image_store=image_store,
+            camera_service=camera_service,
+            history=history,
+        )
+
+    if not MQTT_GATEWAY and os.getenv("THINGSBOARD_TH_ACCESS_TOKEN"):
+        th = TempHumDevice(
+            os.getenv("THINGSBOARD_TH_ACCESS_TOKEN"),
+            states={"maxTemperature": float(CONTROL_MAX_TEMPERATURE)},
+            history=history,
+            **th_options,
+        )
+
+    climates = []
+    if zones:
+        climates = [zone.climate for zone in zones.zones.values() if zone.climate]
+    elif th:
+        climates = [
+            ClimateController(
+                actuators,
+                engine_climate(th.engine),
+                heater_id="heater",
+                fan_id="fan",
+                mode=CONTROL_MODE,
+            )
+        ]
+    if th:
+        # The over-temperature cutoff can be changed from the dashboard
+        def set_max_temperature(key, old, new):
+            for climate in climates:
+                climate.max_temperature = new
+
+        th.attributes.subscribe("maxTemperature", set_max_temperature)
+        # The value may already have been received from the server
+        set_max_temperature(
+            "maxTemperature", None, th.attributes["maxTemperature"]
+        )
+
+    if zones:
+        # Same start/stop/clear interface as a ScheduleControl
+        scheduler = zones
+    else:
+        scheduler = ScheduleControl(
+            timeline,
+            start_delay=5,
+            actuators=actuators,
+            climate=climates[0] if climates else None,
+        )
+    if th and th.estimator:
+        from drying_estimator import DryingControl
+
+        drying = DryingControl(th.estimator, scheduler)
+        add_periodic(
+            scheduler.scheduler,
+            drying.check,
+            DRYING_CHECK_INTERVAL * 60,
+            id="drying-control",
+            heavy=True,
+        )
+    if pi:
+        # Schedules can be uploaded from ThingsBoard, per zone with zones
+        pi.add_rpc_callbacks(
+            zones.rpc_callbacks() if zones else schedule_commands(scheduler)
+        )
+        if history:
+            pi.add_rpc_callbacks(history_commands(history))
 
     if len(sys.argv) > 1 and sys.argv[1] == "--clear":
         scheduler.clear()
 
+    # Resets the actuators when the scheduler, the sensors or the uplink
+    # stall, or on over temperature, holding them off until it is cleared
+    devices = [device for device in (pi, th) if device]
+    supervisor = Supervisor(
+        [control.trip for control in controls.values()],
+        timeouts={"scheduler": SUPERVISOR_TIMEOUTS["scheduler"]},
+        release=[control.release for control in controls.values()],
+        force_off=[control.force_off for control in controls.values()],
+    )
+    if pi:
+        pi.add_rpc_callbacks(supervisor_commands(supervisor))
+    # On the actuator executor, whose stall is the one to catch
+    add_periodic(
+        scheduler.scheduler,
+        supervisor.beat,
+        SUPERVISOR_HEARTBEAT_INTERVAL,
+        id="supervisor-heartbeat",
+        args=["scheduler"],
+    )
+    engine = zones.engine if zones else th.engine if th else None
+    if engine:
+        supervisor.watch("sensors", SUPERVISOR_TIMEOUTS["sensors"])
+        engine.subscribe(supervisor.on_reading)
+    for device in devices:
+        supervisor.watch(f"uplink-{device.name}", SUPERVISOR_TIMEOUTS["uplink"])
+
+    if ASYNC_RUNTIME or "--async" in sys.argv:
+        logging.info("Starting scheduler")
+        scheduler.start()
+        supervisor.start()
+        # Signals are handled by the runtime, which stops the scheduler
+        AsyncRuntime(
+            devices, schedule_control=scheduler, supervisor=supervisor
+        ).run()
+        if history:
+            history.close()
+        sys.exit(0)
+
     def signal_handler(signal, frame):
         logging.info("\nExiting gracefully")
+        supervisor.stop()
         scheduler.stop()
         # Safely turn all relays off
+        if history:
+            # Writes the buffered samples
+            history.close()
         sys.exit(0)
 
+    # systemd stops the service with SIGTERM
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
 
     try:
-        pi = None
-        th = None
-
-        if os.getenv("THINGSBOARD_PI_ACCESS_TOKEN"):
-            pi = RPIDevice(
-                os.getenv("THINGSBOARD_PI_ACCESS_TOKEN"),
-            )
-
-        if os.getenv("THINGSBOARD_TH_ACCESS_TOKEN"):
-            th = TempHumDevice(
-                os.getenv("THINGSBOARD_TH_ACCESS_TOKEN"),
-            )
         logging.info("Starting scheduler")
         scheduler.start()
+        supervisor.start()
+        next_sample = {device: time.monotonic() for device in devices}
         while True:
-            logger.info("Publishing")
-            if pi:
-                pi.publish()
-            if th:
-                th.publish()
-            time.sleep(PUBLISHING_INTERVAL)
+            logger.debug("Sampling")
+            # Samples are buffered and only sent every PUBLISHING_INTERVAL
+            for device in devices:
+                now = time.monotonic()
+                if now < next_sample[device]:
+                    continue
+                device.sample()
+                device.flush()
+                supervisor.beat(f"uplink-{device.name}")
+                # Read every cycle, so a samplingInterval change applies live
+                next_sample[device] = now + device.sampling_interval
+            wakeup = min(
+                next_sample.values(), default=time.monotonic() + SAMPLING_INTERVAL
+            )
+            time.sleep(max(wakeup - time.monotonic(), 0))
 
     except (KeyboardInterrupt, SystemExit):
         pass
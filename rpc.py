@@ -0,0 +1,170 @@
+"""
+Server-side RPC dispatch.
+
+The RPC callbacks of a device are compiled once into a table of
+`handler(params) -> response`: callbacks given by name are resolved to the
+device methods, and callbacks without parameters are wrapped. A request
+is then a dictionary lookup, and its response (or error) is sent back as
+the RPC reply.
+"""
+import inspect
+import json
+import logging
+
+from schedule_timeline import ScheduleValidationError
+
+
+class RpcError(Exception):
+    pass
+
+
+def _takes_params(callback):
+    try:
+        parameters = inspect.signature(callback).parameters.values()
+    except (TypeError, ValueError):
+        return True
+    return any(
+        parameter.kind
+        in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD, parameter.VAR_POSITIONAL)
+        for parameter in parameters
+    )
+
+
+class RpcDispatcher:
+    def __init__(self, owner=None, callbacks: dict = None) -> None:
+        # Callbacks given as strings are methods of `owner`
+        self.owner = owner
+        self.handlers = {}
+        self.update(callbacks or {})
+
+    def update(self, callbacks: dict):
+        for method, callback in callbacks.items():
+            self.register(method, callback)
+
+    def register(self, method, callback):
+        if isinstance(callback, str):
+            name = callback
+            callback = getattr(self.owner, name, None)
+            if not callable(callback):
+                raise TypeError(f"Invalid callback '{name}' for RPC method '{method}'")
+        elif not callable(callback):
+            raise TypeError(f"Invalid callback {callback!r} for RPC method '{method}'")
+        if _takes_params(callback):
+            self.handlers[method] = callback
+        else:
+            self.handlers[method] = lambda params, callback=callback: callback()
+
+    def dispatch(self, method, params=None):
+        """
+        Calls the handler of `method` and returns its response. Errors are
+        returned as {"error": message}.
+        """
+        handler = self.handlers.get(method)
+        if handler is None:
+            return {
+                "error": f"Unknown method '{method}'. Available methods are: {', '.join(sorted(self.handlers))}"
+            }
+        try:
+            response = handler(params)
+        except (RpcError, ScheduleValidationError) as e:
+            return {"error": str(e)}
+        except Exception as e:
+            logging.error("RPC method %s failed", method, exc_info=True)
+            return {"error": f"{method} failed: {e}"}
+        return {"result": "ok"} if response is None else response
+
+
+def _schedule_param(params):
+    # The schedule can be sent as an object or as a JSON string
+    schedule = params.get("schedule") if isinstance(params, dict) else params
+    if isinstance(schedule, str):
+        try:
+            schedule = json.loads(schedule)
+        except ValueError as e:
+            raise RpcError(f"Invalid schedule JSON: {e}")
+    if not isinstance(schedule, dict):
+        raise RpcError("Missing 'schedule' parameter")
+    return schedule
+
+
+def schedule_commands(schedule_control) -> dict:
+    """
+    RPC methods managing the schedule of a ScheduleControl:
+
+    - getSchedule: the running schedule, its start time and current step
+    - validateSchedule {"schedule": ...}: checks a schedule without running it
+    - uploadSchedule {"schedule": ..., "restart": false}: validates and swaps
+      the running schedule, continuing from the current position unless
+      `restart` is set
+    """
+
+    def status():
+        step = schedule_control.current_step()
+        return {
+            "start_time": schedule_control.start_time.isoformat(),
+            "step": step.index if step is not None else None,
+            "schedule": schedule_control.timeline.to_dict(),
+        }
+
+    def validate(params):
+        timeline = schedule_control.validate(_schedule_param(params))
+        return {
+            "valid": True,
+            "steps": len(timeline.steps),
+            "duration_minutes": timeline.duration / 60,
+        }
+
+    def upload(params):
+        restart = bool(params.get("restart")) if isinstance(params, dict) else False
+        schedule_control.swap(_schedule_param(params), restart=restart)
+        return status()
+
+    return {
+        "getSchedule": status,
+        "validateSchedule": validate,
+        "uploadSchedule": upload,
+    }
+
+
+def history_commands(history) -> dict:
+    """
+    RPC methods reading a HistoryStore:
+
+    - getHistory {"series": ..., "start": ms, "end": ms, "resolution": "1m"}:
+      the [ts, value] samples of a series, or with a resolution of
+      "1m", "15m" or "1h" its [ts, count, min, max, mean] rollups
+    - getHistorySeries: the names of the stored series
+    """
+
+    def query(params):
+        if not isinstance(params, dict) or "series" not in params or "start" not in params:
+            raise RpcError("Missing 'series' or 'start' parameter")
+        try:
+            rows = history.query(
+                params["series"],
+                int(params["start"]),
+                params.get("end"),
+                params.get("resolution"),
+            )
+        except ValueError as e:
+            raise RpcError(str(e))
+        return {"series": params["series"], "rows": [list(row) for row in rows]}
+
+    return {
+        "getHistory": query,
+        "getHistorySeries": lambda: {"series": sorted(history.series)},
+    }
+
+
+def supervisor_commands(supervisor) -> dict:
+    """
+    clearFault: lifts the latch of an over temperature, once every sensor
+    is back below the limit.
+    """
+
+    def clear():
+        if not supervisor.clear():
+            raise RpcError("Still over temperature")
+        return {"cleared": True}
+
+    return {"clearFault": clear}
@@ -1,20 +1,23 @@
 from datetime import datetime, timedelta
 from actuators_control import ActuatorsControl
+from climate_control import ClimateController
+from schedule_store import ScheduleStore
+from schedule_timeline import ScheduleValidationError, Timeline, compile_schedule
 
 from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-from apscheduler.jobstores.memory import MemoryJobStore
 
-from settings import DB_PATH
+from job_dispatch import add_periodic, create_scheduler
 
-import logging
+from settings import SCHEDULE_CHECKPOINT_INTERVAL, SCHEDULE_RESUME_POLICY
 
-logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+import logging
+import threading
 
 
 class ScheduleControl:
     scheduler = None
     actuators: ActuatorsControl = None
+    climate: ClimateController = None
 
     def __init__(
         self,
@@ -23,124 +26,330 @@ class ScheduleControl:
         start_delay=5,
         monitor=True,
         monitor_interval=30,
+        actuators: ActuatorsControl = None,
+        climate: ClimateController = None,
+        persistent=True,
+        store: ScheduleStore = None,
+        resume_policy=SCHEDULE_RESUME_POLICY,
+        checkpoint_interval=SCHEDULE_CHECKPOINT_INTERVAL,
+        scheduler=None,
+        name=None,
+        clock=datetime.now,
+        shared_actuators=(),
     ) -> None:
-        self.actuators = ActuatorsControl()
-        jobstore = SQLAlchemyJobStore(url=str(DB_PATH))
+        if resume_policy not in ("elapsed", "paused"):
+            raise ValueError(f"Unknown resume policy {resume_policy}")
+        self.resume_policy = resume_policy
+        # Simulations run the schedule on a virtual clock
+        self.clock = clock
+        self.checkpoint_interval = checkpoint_interval
+        self.actuators = actuators or ActuatorsControl()
+        # Labels of the actuators another schedule drives (e.g. a camera
+        # shared by zones): their intervals and step actions are left to it
+        self.shared_actuators = set(shared_actuators)
+        # Steps with "setpoints" hand the heater and fan over to the controller
+        self.climate = climate
+        self.schedule = self.validate(schedule)
+        self.timeline = self.schedule
+        self.start_time = None
+        self.finished = False
+        # Seconds the running schedule was extended by, stored with it so a
+        # restart does not reset the extension budget
+        self.extended = 0.0
+        # Steps and schedule swaps do not run concurrently
+        self._lock = threading.RLock()
+        # Bumped on every swap, so a step job of the previous schedule that
+        # was already started is ignored
+        self._generation = 0
+        self._interval_jobs = []
+        # Several schedules (e.g. the zones of a ZoneController) can share
+        # one scheduler, their jobs are told apart by the name prefix
+        self.name = name
+        self._job_prefix = f"{name}:" if name else ""
+        # Only the start time and the steps of the running schedule are
+        # persisted, the jobs are recreated from them on startup.
+        # Non persistent schedules (e.g. simulations) are not stored.
+        self.store = store or (ScheduleStore() if persistent else None)
         # self.actuators_control = ActuatorsControl(schedule)
-        # Init scheduler
-        self.scheduler = scheduler_class()
-        self.scheduler.add_jobstore(jobstore, "default")
-        self.scheduler.add_jobstore(MemoryJobStore(), "memory")
-
-        # We need to start the scheduler in order to retrieve jobs from the jobstore
-        self.scheduler.start()
-        self._process_schedule(schedule, start_delay)
-        self._process_intervals(schedule)
+        # Init scheduler, unless a shared one is given: its job stores and
+        # listeners are then set up by its owner, which also shuts it down
+        self._owns_scheduler = scheduler is None
+        if scheduler is None:
+            scheduler = create_scheduler(scheduler_class)
+        self.scheduler = scheduler
+
+        if not self.scheduler.running:
+            self.scheduler.start()
+        self._process_schedule(start_delay)
+        self._process_intervals()
         # Print the list of scheduled jobs
         # We use the memory store here as print_jobs cannot be
         # serialized and doesn't work with DB stores.
         if monitor:
-            self.scheduler.add_job(
+            add_periodic(
+                self.scheduler,
                 self.scheduler.print_jobs,
-                "interval",
-                seconds=monitor_interval,
-                id="scheduler-monitor",
-                jobstore="memory",
+                monitor_interval,
+                id=self._job_id("scheduler-monitor"),
+                heavy=True,
+                now=self.clock(),
             )
         # self.scheduler.shutdown()
 
-    def _process_intervals(self, schedule):
-        # These are tasks that are triggered preiodically
-        # We store them in memory as on restart we can just recreate them
+    def _job_id(self, job_id):
+        return self._job_prefix + job_id
 
-        # Make sure actuators are passed to the controller
-        self.actuators.from_actions(schedule["intervals"])
+    def _remove_jobs(self, jobstore):
+        for job in self.scheduler.get_jobs(jobstore=jobstore):
+            if job.id.startswith(self._job_prefix):
+                self.scheduler.remove_job(job.id)
 
-        for idx, action in enumerate(schedule["intervals"]):
-            actuator = action["actuator"]
-            actuator_id = id(actuator)
-            value = action["status"]
-            interval = action["interval"]
+    def validate(self, schedule) -> Timeline:
+        # Schedules refer to the actuators by label, which must all be known
+        if not isinstance(schedule, Timeline):
+            schedule = compile_schedule(schedule, self.actuators.actuators_map)
+        unknown = schedule.actuators - set(self.actuators.actuators_map)
+        if unknown:
+            raise ScheduleValidationError(
+                f"The schedule refers to unknown actuators {sorted(unknown)}"
+            )
+        return schedule
 
-            # Start the intervals from now
-            self.scheduler.add_job(
-                actuator.trigger,
-                "interval",
-                minutes=interval,
-                id=f"job-{idx}-{actuator_id}",
-                jobstore="memory",
-                args=[value],
-                start_date=datetime.now() - timedelta(minutes=interval),
+    def _process_intervals(self):
+        # These are tasks that are triggered preiodically
+        # We store them in memory as on restart we can just recreate them
+        for job_id in self._interval_jobs:
+            if self.scheduler.get_job(job_id):
+                self.scheduler.remove_job(job_id)
+        self._interval_jobs = []
+        for idx, interval in enumerate(self.timeline.intervals):
+            if interval.actuator in self.shared_actuators:
+                continue
+            job_id = self._job_id(f"job-{idx}-{interval.actuator}")
+            self._interval_jobs.append(job_id)
+            # Spread over their period rather than all started now. The
+            # camera captures run on the heavy executor, away from the relays.
+            actuator = self.actuators.actuators_map.get(interval.actuator)
+            add_periodic(
+                self.scheduler,
+                self.actuators.trigger_actuators,
+                interval.interval * 60,
+                id=job_id,
+                heavy=getattr(actuator, "heavy", False),
+                now=self.clock(),
+                args=[[{"actuator_id": interval.actuator, "status": interval.status}]],
             )
 
-    def _process_schedule(self, schedule, start_delay):
-        # Init schedule
-        task_start_time = (
-            schedule["start_time"] if schedule["start_time"] else datetime.now()
-        )
-        task_start_time = task_start_time + timedelta(seconds=start_delay)
-        # We might be in a restart.
-        # If there are other jobs, let's no schedule new ones
-        # TODO: Allow to reset previous schedules on startup
-        existing_jobs = self.scheduler.get_jobs(jobstore="default")
-
-        logging.info(f"Found existing jobs {existing_jobs}")
-        if not len(existing_jobs):
+    def _process_schedule(self, start_delay):
+        now = self.clock()
+        self.finished = False
+        # We might be in a restart: keep running the stored schedule
+        stored = self.store.load() if self.store else None
+        if stored is not None:
+            self._resume(stored, now)
+        else:
             logging.info("Scheduling new jobs")
-            task_delay = 0  # minutes
-            for idx, interval in enumerate(schedule["schedule"]):
-                task_start_time += timedelta(minutes=task_delay)
-                actions = []
-                # Make sure actuators are passed to the controller
-                self.actuators.from_actions(interval["actions"])
-                for action in interval["actions"]:
-                    actuator = action["actuator"]
-                    actuator_id = id(actuator)
-                    actions.append(
-                        {"actuator_id": actuator_id, "status": action["status"]}
-                    )
-
-                self.scheduler.add_job(
-                    self.actuators.trigger_actuators,
-                    jobstore="default",
-                    trigger="date",
-                    run_date=task_start_time,
-                    id=f"job-{idx}-{actuator_id}",
-                    args=[actions],
-                )
-
-                task_delay += interval["duration"]
-
-            task_start_time += timedelta(minutes=task_delay)
+            self.timeline = self.schedule
+            self.extended = 0.0
+            # Init schedule
+            task_start_time = self.timeline.start_time or now
+            self.start_time = task_start_time + timedelta(seconds=start_delay)
+            if self.store:
+                self.store.save(self.timeline, self.start_time, now, self.extended)
+        self._schedule_steps(now)
+
+    def _schedule_steps(self, now):
+        for step in self.timeline.steps:
+            run_date = self.start_time + timedelta(seconds=step.start)
+            if run_date < now:
+                continue
             self.scheduler.add_job(
-                self.actuators.reset_actuators,
+                self._run_step_job,
                 jobstore="default",
                 trigger="date",
-                run_date=task_start_time,
-                id=f"shutdown",
+                run_date=run_date,
+                id=self._job_id(f"step-{step.index}"),
+                args=[self._generation, step.state, step.setpoints],
+                # A late step (e.g. a busy or suspended system) must still run
+                misfire_grace_time=None,
+                replace_existing=True,
+            )
+
+        self.scheduler.add_job(
+            self._run_shutdown_job,
+            jobstore="default",
+            trigger="date",
+            run_date=max(
+                now, self.start_time + timedelta(seconds=self.timeline.duration)
+            ),
+            id=self._job_id("shutdown"),
+            args=[self._generation],
+            misfire_grace_time=None,
+            replace_existing=True,
+        )
+        if self.store and self.resume_policy == "paused":
+            add_periodic(
+                self.scheduler,
+                self.checkpoint,
+                self.checkpoint_interval,
+                id=self._job_id("schedule-checkpoint"),
+                heavy=True,
+                jobstore="default",
+                now=now,
             )
-        else:
-            if not self.scheduler.get_job("shutdown"):
-                logging.warning(
-                    "Existing scheduler found, but no shutdown job was found"
-                )
-                self.scheduler.add_job(
-                    self.actuators.reset_actuators,
-                    jobstore="default",
-                    trigger="date",
-                    run_date=task_start_time,
-                    id=f"shutdown",
-                )
-            logging.info("Keeping existing schedule")
+
+    def _resume(self, stored, now):
+        self.timeline = stored.timeline
+        self.start_time = stored.timeline.start_time
+        self.extended = stored.extended
+        logging.info(f"Resuming the schedule started at {self.start_time}")
+        if self.timeline.to_dict()["schedule"] != self.schedule.to_dict()["schedule"]:
+            logging.warning(
+                "The configured schedule differs from the running one, "
+                "use --clear to start it"
+            )
+
+        if self.resume_policy == "paused" and stored.checkpoint:
+            # The time spent down does not count toward the steps
+            downtime = max(now - stored.checkpoint, timedelta(0))
+            logging.info(f"Pausing the schedule for the {downtime} spent down")
+            self.start_time += downtime
+            self.store.save(self.timeline, self.start_time, now, self.extended)
+
+        # Steps before now are not replayed: the state of the current step
+        # is applied at once
+        step = self.current_step(now)
+        if step is not None:
+            logging.info(f"Resuming at step {step.index}")
+            self.run_step(step.state, step.setpoints)
+
+    def checkpoint(self):
+        self.store.save(self.timeline, self.start_time, self.clock(), self.extended)
+
+    def current_step(self, now=None):
+        """
+        The step that should be running at `now`, or None outside of the
+        schedule.
+        """
+        now = now or self.clock()
+        return self.timeline.step_at((now - self.start_time).total_seconds())
+
+    def remaining(self, now=None):
+        # Seconds until the end of the schedule
+        if self.finished:
+            return 0
+        now = now or self.clock()
+        end = self.start_time + timedelta(seconds=self.timeline.duration)
+        return max((end - now).total_seconds(), 0)
+
+    def end(self):
+        """
+        Ends the schedule now, e.g. when the product is dry early.
+        """
+        with self._lock:
+            self._generation += 1
+            self._remove_jobs("default")
+            self.finish()
+
+    def extend(self, seconds):
+        """
+        Makes the last step of the running schedule `seconds` longer.
+        """
+        with self._lock:
+            schedule = self.timeline.to_dict()
+            schedule["schedule"][-1]["duration"] += seconds / 60
+            return self._replace(self.validate(schedule), False, self.extended + seconds)
+
+    def finish(self):
+        logging.info("Schedule finished")
+        self.finished = True
+        self.run_step({})
+        if self.store:
+            checkpoint_job = self._job_id("schedule-checkpoint")
+            if self.scheduler.get_job(checkpoint_job):
+                self.scheduler.remove_job(checkpoint_job)
+            self.store.clear()
+
+    def _run_step_job(self, generation, state, setpoints):
+        with self._lock:
+            if generation != self._generation:
+                logging.info("Skipping a step of the previous schedule")
+                return
+            self.run_step(state, setpoints)
+
+    def _run_shutdown_job(self, generation):
+        # A left over end of a swapped or extended schedule must not end it
+        with self._lock:
+            if generation != self._generation:
+                logging.info("Skipping the end of the previous schedule")
+                return
+            self.finish()
+
+    def run_step(self, state, setpoints=None):
+        with self._lock:
+            keep = set(self.shared_actuators)
+            if self.climate:
+                self.climate.set_setpoints(setpoints)
+                keep.update(self.climate.controlled_ids)
+            self.actuators.apply_step(state, keep=keep)
+
+    def swap(self, schedule, restart=False):
+        """
+        Replaces the running schedule without restarting the scheduler.
+
+        The new schedule continues from the current position of the running
+        one, or starts from now with `restart`. The state of its current
+        step is applied at once, and as steps are diffed the actuators that
+        keep their state are not touched.
+        """
+        return self._replace(self.validate(schedule), restart, extended=0.0)
+
+    def _replace(self, timeline, restart, extended):
+        with self._lock:
+            now = self.clock()
+            self._generation += 1
+            self._remove_jobs("default")
+            self.finished = False
+            self.schedule = timeline
+            self.timeline = timeline
+            self.extended = extended
+            if restart or self.start_time is None:
+                self.start_time = now
+            logging.info(f"Swapped the schedule, started at {self.start_time}")
+            if self.store:
+                self.store.save(self.timeline, self.start_time, now, self.extended)
+            self._schedule_steps(now)
+            self._process_intervals()
+
+            step = self.current_step(now)
+            if step is not None:
+                self.run_step(step.state, step.setpoints)
+        return timeline
 
     def stop(self):
         logging.info(f"Shutting down all actuators and schedules")
-        self.scheduler.shutdown(wait=False)
+        checkpoint_job = self.scheduler.get_job(self._job_id("schedule-checkpoint"))
+        if self._owns_scheduler:
+            self.scheduler.shutdown(wait=False)
+        else:
+            # Only this schedule stops, the other ones keep the scheduler
+            self._remove_jobs("default")
+            self._remove_jobs("memory")
+        if checkpoint_job:
+            # The schedule stops being run now
+            self.checkpoint()
+        if self.climate:
+            # Its job was removed with the other ones
+            self.climate.set_setpoints(None)
         self.actuators.reset_actuators()
 
     def clear(self):
+        # Drops the running schedule and starts the configured one from now
         logging.info(f"Clearing all jobs")
-        self.scheduler.remove_all_jobs()
+        self._remove_jobs("default")
+        if self.store:
+            self.store.clear()
+        self._process_schedule(start_delay=0)
 
     def start(self):
         if not self.scheduler.running:
@@ -148,3 +357,13 @@ class ScheduleControl:
             self.scheduler.start()
         else:
             logging.info(f"Scheduler already running")
+        climate_job = self._job_id("climate-control")
+        if self.climate and not self.scheduler.get_job(climate_job):
+            # An actuator job like the steps, on the default executor
+            add_periodic(
+                self.scheduler,
+                self.climate.tick,
+                self.climate.tick_interval,
+                id=climate_job,
+                now=self.clock(),
+            )
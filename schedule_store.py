@@ -0,0 +1,81 @@
+"""
+Persistence of the running schedule.
+
+Only the start time, the compiled steps of the schedule and how much it
+was extended by are stored, as one small JSON file replaced atomically,
+read once at startup. It is written when a schedule starts, is swapped or
+extended, and with the "paused" resume policy on every checkpoint
+(SCHEDULE_CHECKPOINT_INTERVAL) and on shutdown, so the SD card sees a
+small write every few minutes at most and no database is needed.
+"""
+import json
+import logging
+import os
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from file_utils import write_atomic
+from schedule_timeline import ScheduleValidationError, Timeline, compile_schedule
+from settings import SCHEDULE_STATE_PATH
+
+FORMAT_VERSION = 1
+
+
+class StoredRun(NamedTuple):
+    timeline: Timeline  # with its start time
+    # Last time the controller was known to be running the schedule
+    checkpoint: Optional[datetime] = None
+    # Seconds the schedule was extended by while running (see extend())
+    extended: float = 0.0
+
+
+class ScheduleStore:
+    def __init__(self, path=SCHEDULE_STATE_PATH) -> None:
+        self.path = path
+
+    def load(self):
+        """
+        The StoredRun of the running schedule, or None when no schedule is
+        running or the file cannot be used.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                state = json.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logging.error(f"Cannot read the schedule state {self.path}", exc_info=True)
+            return None
+
+        if state.get("version") != FORMAT_VERSION:
+            logging.warning(f"Ignoring schedule state with version {state.get('version')}")
+            return None
+        try:
+            timeline = compile_schedule(state["timeline"])
+            timeline.start_time = datetime.fromisoformat(state["start_time"])
+            checkpoint = state.get("checkpoint")
+            if checkpoint is not None:
+                checkpoint = datetime.fromisoformat(checkpoint)
+            extended = float(state.get("extended", 0))
+        except (KeyError, TypeError, ValueError, ScheduleValidationError):
+            logging.error(f"Invalid schedule state {self.path}", exc_info=True)
+            return None
+        return StoredRun(timeline, checkpoint, extended)
+
+    def save(
+        self, timeline: Timeline, start_time: datetime, checkpoint=None, extended=0.0
+    ):
+        state = {
+            "version": FORMAT_VERSION,
+            "start_time": start_time.isoformat(),
+            "checkpoint": checkpoint.isoformat() if checkpoint else None,
+            "extended": extended,
+            "timeline": timeline.to_dict(),
+        }
+        write_atomic(self.path, json.dumps(state).encode(), sync=True)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,220 @@
+"""
+Declarative schedule format and its compiled timeline.
+
+A schedule refers to the actuators by their label, so it can be stored,
+reloaded after a restart and validated without the actuator objects:
+
+    {
+      "start_time": null,
+      "schedule": [
+        {"duration": 30, "actions": [{"actuator": "heater", "status": 1}],
+         "setpoints": {"temperature": 45, "humidity": 30}}
+      ],
+      "intervals": [{"interval": 30, "actuator": "camera", "status": 1}]
+    }
+
+`compile_schedule` turns it into a Timeline: the flat list of steps sorted
+by their start offset, each with the full state of the scheduled actuators
+(every actuator not listed in a step is off). The step running at any time
+is then a bisection of the start offsets.
+"""
+import json
+from bisect import bisect_right
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+SETPOINTS = ("temperature", "humidity")
+
+
+class ScheduleValidationError(Exception):
+    pass
+
+
+class Step(NamedTuple):
+    index: int
+    start: float  # seconds from the schedule start
+    duration: float  # seconds
+    state: dict  # {actuator label: status}
+    setpoints: Optional[dict] = None
+
+    @property
+    def end(self):
+        return self.start + self.duration
+
+
+class Interval(NamedTuple):
+    actuator: str
+    status: int
+    interval: float  # minutes
+
+
+class Timeline:
+    def __init__(self, steps, intervals=(), start_time: datetime = None) -> None:
+        self.steps = list(steps)
+        self.intervals = list(intervals)
+        self.start_time = start_time
+        self._starts = [step.start for step in self.steps]
+
+    @property
+    def duration(self):
+        # seconds
+        return self.steps[-1].end if self.steps else 0.0
+
+    @property
+    def actuators(self):
+        labels = {label for step in self.steps for label in step.state}
+        labels.update(interval.actuator for interval in self.intervals)
+        return labels
+
+    def step_at(self, elapsed):
+        """
+        The step running `elapsed` seconds after the start, or None before
+        the start and after the end of the schedule.
+        """
+        if elapsed < 0 or elapsed >= self.duration:
+            return None
+        return self.steps[bisect_right(self._starts, elapsed) - 1]
+
+    def to_dict(self):
+        return {
+            "start_time": self.start_time.isoformat() if self.start_time else None,
+            "schedule": [
+                {
+                    "duration": step.duration / 60,
+                    "actions": [
+                        {"actuator": label, "status": status}
+                        for label, status in step.state.items()
+                        if status
+                    ],
+                    **({"setpoints": step.setpoints} if step.setpoints else {}),
+                }
+                for step in self.steps
+            ],
+            "intervals": [interval._asdict() for interval in self.intervals],
+        }
+
+
+def _number(value, what):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ScheduleValidationError(f"{what} must be a number, got {value!r}")
+    return value
+
+
+def _object(value, what):
+    if not isinstance(value, dict):
+        raise ScheduleValidationError(f"{what} must be an object, got {value!r}")
+    return value
+
+
+def _list(value, what):
+    if not isinstance(value, list):
+        raise ScheduleValidationError(f"{what} must be a list, got {value!r}")
+    return value
+
+
+def _status(value, what):
+    if value not in (0, 1) or isinstance(value, float):
+        raise ScheduleValidationError(f"{what} must be 0 or 1, got {value!r}")
+    return int(value)
+
+
+def _label(value, what, known):
+    if not isinstance(value, str):
+        raise ScheduleValidationError(
+            f"{what} must be an actuator label, got {value!r}"
+        )
+    if known is not None and value not in known:
+        raise ScheduleValidationError(
+            f"{what} refers to unknown actuator '{value}'. Available actuators: {sorted(known)}"
+        )
+    return value
+
+
+def _start_time(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ScheduleValidationError(
+            f"start_time must be null or an ISO datetime, got {value!r}"
+        )
+
+
+def compile_schedule(schedule: dict, actuators=None) -> Timeline:
+    """
+    Validates a schedule and compiles it into a Timeline.
+
+    `actuators` is the collection of the known actuator labels; when given
+    every label of the schedule must be one of them.
+    """
+    if not isinstance(schedule, dict):
+        raise ScheduleValidationError("A schedule must be an object")
+    known = set(actuators) if actuators is not None else None
+
+    raw_steps = _list(schedule.get("schedule", []), "schedule")
+    parsed = []
+    for idx, raw in enumerate(raw_steps):
+        where = f"schedule[{idx}]"
+        _object(raw, where)
+        duration = _number(raw.get("duration"), f"{where}.duration")
+        if duration <= 0:
+            raise ScheduleValidationError(f"{where}.duration must be positive")
+        actions = {}
+        raw_actions = _list(raw.get("actions", []), f"{where}.actions")
+        for action_idx, action in enumerate(raw_actions):
+            what = f"{where}.actions[{action_idx}]"
+            _object(action, what)
+            label = _label(action.get("actuator"), f"{what}.actuator", known)
+            actions[label] = _status(action.get("status"), f"{what}.status")
+        setpoints = raw.get("setpoints") or None
+        if setpoints is not None:
+            _object(setpoints, f"{where}.setpoints")
+            for name, value in setpoints.items():
+                if name not in SETPOINTS:
+                    raise ScheduleValidationError(
+                        f"{where}.setpoints has unknown setpoint '{name}'. Available setpoints: {list(SETPOINTS)}"
+                    )
+                _number(value, f"{where}.setpoints.{name}")
+        parsed.append((duration * 60, actions, setpoints))
+
+    # Every relay status defaults to 0, so each step holds the full state
+    # of the actuators used by the schedule
+    labels = sorted({label for _, actions, _ in parsed for label in actions})
+    steps = []
+    start = 0.0
+    for idx, (duration, actions, setpoints) in enumerate(parsed):
+        state = {label: actions.get(label, 0) for label in labels}
+        steps.append(Step(idx, start, duration, state, setpoints))
+        start += duration
+
+    intervals = []
+    for idx, raw in enumerate(_list(schedule.get("intervals", []), "intervals")):
+        where = f"intervals[{idx}]"
+        _object(raw, where)
+        interval = _number(raw.get("interval"), f"{where}.interval")
+        if interval <= 0:
+            raise ScheduleValidationError(f"{where}.interval must be positive")
+        intervals.append(
+            Interval(
+                _label(raw.get("actuator"), f"{where}.actuator", known),
+                _status(raw.get("status"), f"{where}.status"),
+                interval,
+            )
+        )
+
+    return Timeline(steps, intervals, _start_time(schedule.get("start_time")))
+
+
+def load_schedule(path) -> dict:
+    """
+    Reads a JSON schedule, or a YAML one when PyYAML is installed.
+    """
+    path = Path(path)
+    with open(path) as file:
+        if path.suffix in (".yaml", ".yml"):
+            import yaml
+
+            return yaml.safe_load(file)
+        return json.load(file)
@@ -0,0 +1,145 @@
+import heapq
+import threading
+import time
+import logging
+from typing import NamedTuple, Optional
+
+import instrumentation
+from logging_setup import RATE_LIMITED
+from settings import SENSOR_MIN_INTERVAL
+
+
+class Reading(NamedTuple):
+    temperature: Optional[float]
+    humidity: Optional[float]
+    timestamp: float
+
+
+class SensorAcquisitionEngine:
+    """
+    Reads temperature/humidity sensors on a background thread and keeps
+    the latest reading of each one in a shared buffer.
+
+    Sensors are kept open and each one is read at most every `min_interval`
+    seconds (the DHT22 needs 2s between reads). The interval is tracked per
+    sensor, so adding sensors does not slow down the others.
+
+    Readers call `snapshot()`, which returns the current buffer without
+    locking or copying: the acquisition thread never mutates a published
+    buffer, it swaps in a new one.
+    """
+
+    def __init__(self, min_interval=SENSOR_MIN_INTERVAL) -> None:
+        self.min_interval = min_interval
+        self.sensors = {}
+        self._latest: dict[str, Reading] = {}
+        self.listeners = []
+        self._queue = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add_sensor(self, label, sensor):
+        with self._lock:
+            self.sensors[label] = sensor
+            heapq.heappush(self._queue, (time.monotonic(), label))
+        self._wakeup.set()
+
+    def subscribe(self, callback):
+        # callback(label, reading) is called on the acquisition thread for
+        # every successful reading
+        self.listeners.append(callback)
+
+    def snapshot(self) -> dict[str, Reading]:
+        return self._latest
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="sensor-acquisition", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout)
+        for label, sensor in self.sensors.items():
+            try:
+                sensor.exit()
+            except Exception:
+                logging.error("Failed deactivating sensor %s", label, exc_info=True)
+
+    def _next_due(self):
+        with self._lock:
+            if not self._queue:
+                return None, None
+            return self._queue[0]
+
+    def _run(self):
+        while not self._stop.is_set():
+            due, label = self._next_due()
+            if label is None:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            delay = due - time.monotonic()
+            if delay > 0:
+                # Woken up early when a sensor is added or on stop
+                if self._wakeup.wait(delay):
+                    self._wakeup.clear()
+                continue
+
+            with self._lock:
+                heapq.heappop(self._queue)
+            read_at = time.monotonic()
+            try:
+                self.read_sensor(label)
+            except Exception:
+                # The thread must survive anything, a stall resets the actuators
+                logging.exception("Failed reading sensor %s", label)
+            finally:
+                with self._lock:
+                    heapq.heappush(self._queue, (read_at + self.min_interval, label))
+
+    def read_sensor(self, label):
+        sensor = self.sensors[label]
+        started = time.perf_counter()
+        try:
+            temperature = sensor.temperature
+            humidity = sensor.humidity
+        except RuntimeError:
+            # Errors happen fairly often, DHT's are hard to read, just keep going
+            logging.debug("Failed reading sensor %s", label, exc_info=True)
+            return
+        except Exception:
+            logging.error(
+                "Failed reading sensor %s", label, exc_info=True, extra=RATE_LIMITED
+            )
+            return
+        finally:
+            # Failed reads take as long, so they are recorded too
+            instrumentation.observe(
+                "sensor_read_seconds", time.perf_counter() - started, sensor=label
+            )
+
+        if temperature is None or humidity is None:
+            logging.debug("Failed to retrieve data from sensor %s", label)
+            return
+
+        reading = Reading(temperature, humidity, time.time())
+        latest = dict(self._latest)
+        latest[label] = reading
+        self._latest = latest
+        for callback in self.listeners:
+            try:
+                callback(label, reading)
+            except Exception:
+                logging.exception(
+                    "Sensor listener %r failed", callback, extra=RATE_LIMITED
+                )
@@ -1,9 +1,201 @@
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent
-DB_PATH = "sqlite:///" + str(BASE_DIR) + "/sqlite.db"
+# Drying program, see the format in schedule_timeline.py
+SCHEDULE_PATH = BASE_DIR / "configs" / "schedule.json"
+# Start time and steps of the running schedule, kept across restarts
+SCHEDULE_STATE_PATH = BASE_DIR / "schedule_state.json"
+# What happens to the time the controller was down when resuming a schedule:
+# - "elapsed": it counts toward the steps, the schedule resumes where it
+#   would be had it kept running
+# - "paused": it does not count, the schedule resumes where it stopped
+#   (within SCHEDULE_CHECKPOINT_INTERVAL)
+SCHEDULE_RESUME_POLICY = "elapsed"
+SCHEDULE_CHECKPOINT_INTERVAL = 300  # seconds, only used when "paused"
+# Several racks driven from one process, see the format in zones.py.
+# None runs the single room of SCHEDULE_PATH.
+ZONES_PATH = None  # e.g. BASE_DIR / "configs" / "zones.json"
+# Threads running the actuator jobs of the scheduler (shared by all the
+# zones), and the slow ones (camera, checkpoints), see job_dispatch.py
+SCHEDULER_WORKERS = 10
+SCHEDULER_HEAVY_WORKERS = 1
 
+# Telemetry is sampled every SAMPLING_INTERVAL and sent in one batch
+# every PUBLISHING_INTERVAL
+SAMPLING_INTERVAL = 30  # seconds
 PUBLISHING_INTERVAL = 30  # seconds
+
+# BCM pin of the actuators driven by a relay, e.g. {"heater": 17}.
+# Actuators that are not listed are only logged.
+RELAY_PINS = {}
+GPIO_CHIP = "/dev/gpiochip0"
+
+# Hardware backends, from the registry in backends.py. Their libraries are
+# only imported when a configured device needs them.
+SENSOR_BACKEND = "dht22"
+GPIO_BACKEND = "gpiod"
+FLASH_BACKEND = "rpi_gpio"
+CAMERA_BACKEND = "picamera"
+MQTT_BACKEND = "thingsboard"
+MQTT_GATEWAY_BACKEND = "thingsboard_gateway"
+# Send all the devices through one ThingsBoard gateway connection, with
+# THINGSBOARD_GATEWAY_ACCESS_TOKEN instead of one token per device
+MQTT_GATEWAY = False
+# Most relay boards switch on when the input is pulled low
+RELAYS_ACTIVE_LOW = True
 IMAGES_FOLDER = "images"
 
+# Telemetry that could not be sent is kept on disk until the link is back
+SPOOL_FOLDER = str(BASE_DIR) + "/spool"
+SPOOL_SEGMENT_RECORDS = 500
+SPOOL_MAX_SEGMENTS = 200
+# Maximum number of records sent in one MQTT message
+TELEMETRY_BATCH_SIZE = 100
+# Spooled batches not acknowledged by the broker within this stay spooled
+TELEMETRY_ACK_TIMEOUT = 10  # seconds
+# Time a flush may spend sending the spool, the rest is sent by the next ones
+TELEMETRY_DRAIN_TIME = 20  # seconds
+RECONNECT_INTERVAL = 60  # seconds
+
+# Local history of the telemetry and actuator changes, see history_store.py.
+# None to disable.
+HISTORY_FOLDER = str(BASE_DIR) + "/history"
+# Samples are written to the daily segments in batches, to limit SD writes
+HISTORY_FLUSH_INTERVAL = 300  # seconds
+HISTORY_BUFFER_RECORDS = 4096
+# Records a new daily segment file is sized for, it grows when full
+HISTORY_SEGMENT_RECORDS = 65536
+# Days of raw samples and of 1 min / 15 min / 1 h rollups kept
+HISTORY_RAW_DAYS = 31
+HISTORY_ROLLUP_DAYS = 366
+
+# Run the publishing loop on asyncio (also enabled with `main.py --async`)
+ASYNC_RUNTIME = False
+# Threads used by the asyncio runtime for blocking device calls
+EXECUTOR_WORKERS = 4
+
 PHOTO_INTERVAL = 30  # minutes
+# Pictures are deleted, oldest first, above this size
+IMAGES_QUOTA_MB = 4096
+# Pictures older than this are deleted, None to keep them
+IMAGES_MAX_AGE = 60  # days
+# Time-lapse tiers: (age in hours, keep every Nth picture)
+IMAGES_TIERS = [(24, 4), (24 * 7, 12)]
+CAMERA_ISO = 600
+# Exposure and white balance are measured again after this time
+CAMERA_CALIBRATION_TTL = 3600  # seconds
+# Time given to the automatic gain control to settle when calibrating
+CAMERA_SETTLE_TIME = 2  # seconds
+CAMERA_FLASH_WARMUP = 0.2  # seconds
+# (width, height) to downscale pictures on the GPU, None for full resolution
+CAMERA_RESIZE = None
+# (width, height) of the thumbnails saved next to the images, None to disable.
+# Needs Pillow.
+CAMERA_THUMBNAIL_SIZE = None
+# Pictures waiting to be written to disk
+CAMERA_QUEUE_SIZE = 8
+# Statistics of every picture sent as telemetry, see image_analysis.py.
+# Needs Pillow, imported with numpy on the first capture.
+IMAGE_ANALYSIS = True
+IMAGE_ANALYSIS_SIZE = (160, 120)  # (width, height) the pictures are decoded at
+IMAGE_ANALYSIS_GRID = (2, 2)  # (rows, columns) of regions
+IMAGE_ANALYSIS_BINS = 12  # hue bins
+# Pictures are only stored when they changed this much (0-1) since the last
+# stored one, None to store them all
+IMAGE_CHANGE_THRESHOLD = 0.1
+# ... or when none was stored for this long, None to disable
+IMAGE_KEYFRAME_INTERVAL = 6 * 3600  # seconds
+
+# Temperature/humidity sensors, pins are board pin names.
+# A sensor can set its own "backend".
+SENSORS = [
+    {"pin": "D5", "label": "Top"},
+    {"pin": "D6", "label": "Top-middle"},
+    {"pin": "D13", "label": "Bottom-middle"},
+    {"pin": "D19", "label": "Bottom"},
+]
+# DHT22 sensors cannot be read more often than every 2 seconds
+SENSOR_MIN_INTERVAL = 2.0  # seconds
+# Readings older than this are published as empty values
+SENSOR_MAX_AGE = 60  # seconds
+# Readings are aggregated over AGGREGATION_WINDOW, and the min, max, mean,
+# EMA and dewpoint of each sensor are sent once per window
+AGGREGATION_WINDOW = 60  # seconds
+AGGREGATION_BUFFER_SIZE = 16  # last readings kept per sensor for outliers
+AGGREGATION_EMA_ALPHA = 0.1
+# Readings further than this many median absolute deviations from the
+# recent median are rejected
+AGGREGATION_OUTLIER_THRESHOLD = 5
+
+# Closed-loop climate control, active in schedule steps that define
+# "setpoints": {"temperature": 45, "humidity": 30}
+CONTROL_MODE = "hysteresis"  # or "pid"
+CONTROL_TICK_INTERVAL = 10  # seconds
+CONTROL_TEMPERATURE_BAND = 2  # degrees, total width around the setpoint
+CONTROL_HUMIDITY_BAND = 5  # %RH, total width around the setpoint
+# (kp, ki, kd) of the heater PID, output is a duty cycle between 0 and 1
+CONTROL_PID_GAINS = (0.3, 0.0005, 0.0)
+# Time-proportioning window of the PID duty cycle
+CONTROL_PID_WINDOW = 600  # seconds
+# Anti-short-cycle guards for the heater and fan relays
+CONTROL_MIN_ON_TIME = 120  # seconds
+CONTROL_MIN_OFF_TIME = 120  # seconds
+# The heater is switched off above this temperature whatever the guards
+CONTROL_MAX_TEMPERATURE = 70  # degrees
+
+# Drying progress estimation, see drying_estimator.py. The run ends early
+# once every shelf is below DRYING_TARGET_HUMIDITY, and its last step is
+# extended (up to DRYING_MAX_EXTENSION) when the product needs longer.
+# None disables it.
+DRYING_TARGET_HUMIDITY = None  # %RH
+# Aggregation windows in the drying rate regression
+DRYING_WINDOW = 60
+DRYING_MIN_SAMPLES = 10
+DRYING_MIN_RUN = 60  # minutes, before the run can end early
+DRYING_MAX_EXTENSION = 240  # minutes
+DRYING_CHECK_INTERVAL = 5  # minutes
+
+# Fail-safe supervisor, see supervisor.py. All the actuators are reset when
+# a heartbeat is older than its timeout or a reading is above
+# SUPERVISOR_MAX_TEMPERATURE, within SUPERVISOR_CHECK_INTERVAL +
+# SUPERVISOR_RESET_DEADLINE, or the process exits.
+SUPERVISOR_CHECK_INTERVAL = 1  # seconds
+SUPERVISOR_RESET_DEADLINE = 2  # seconds
+SUPERVISOR_HEARTBEAT_INTERVAL = 10  # seconds, of the scheduler heartbeat job
+SUPERVISOR_TIMEOUTS = {
+    "scheduler": 60,  # seconds
+    "sensors": 120,
+    "uplink": 10 * SAMPLING_INTERVAL,
+}
+SUPERVISOR_MAX_TEMPERATURE = 80  # degrees, above CONTROL_MAX_TEMPERATURE
+# After an over temperature the actuators are held off until every sensor
+# stayed SUPERVISOR_TEMPERATURE_MARGIN below the limit for
+# SUPERVISOR_CLEAR_AFTER, or the "clearFault" RPC (None: only the RPC)
+SUPERVISOR_TEMPERATURE_MARGIN = 5  # degrees
+SUPERVISOR_CLEAR_AFTER = 600  # seconds
+
+# Latency histograms of the hot paths, see instrumentation.py.
+# Each power of two is split in 2 ** METRICS_PRECISION buckets.
+METRICS_PRECISION = 5
+METRICS_QUANTILES = (0.5, 0.9, 0.99)
+# Port of the Prometheus endpoint (/metrics), None to disable
+METRICS_PORT = 9108
+# Address it listens on, "" for every interface (e.g. a remote Prometheus)
+METRICS_HOST = "127.0.0.1"
+# Histograms summarized (p95 and max) in the RPIDevice telemetry, () to
+# disable. The uplink may be metered, the full set is on METRICS_PORT.
+METRICS_TELEMETRY = (
+    "scheduler_lateness_seconds",
+    "gpio_write_seconds",
+    "sensor_read_seconds",
+    "telemetry_send_seconds",
+)
+
+# Logging, see logging_setup.py
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "%(asctime)s - %(message)s"
+# Identical frequent errors (e.g. of the sensors) are written at most once
+# per LOG_RATE_LIMIT
+LOG_RATE_LIMIT = 60  # seconds, 0 to disable
+# Debug records kept in memory and written along the next error
+LOG_RING_SIZE = 200  # 0 to disable
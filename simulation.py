@@ -0,0 +1,804 @@
+"""
+Drying room simulation.
+
+Compares the fixed on/off schedule with the closed-loop ClimateController
+on a lumped thermal/humidity model of the room:
+
+    python simulation.py
+
+It also provides the simulation backend used by `benchmark.py`: fake DHT22
+sensors reading the room model, a GPIO bank wired to the room heater and
+fan, a fake MQTT client and a scheduler running on a virtual clock, so
+ScheduleControl (or a ZoneController running several rooms) and the
+publish loop run off-device and faster than real time.
+"""
+import heapq
+import itertools
+import math
+import random
+import time
+import logging
+from datetime import datetime, timedelta
+
+from actuators_control import ActuatorsControl, CameraActuator, RelayActuator
+from camera_service import CapturedImage
+from climate_control import ClimateController, engine_climate
+from drying_estimator import DryingControl, DryingEstimator
+from gpio_bank import FakeOutputBank
+from job_dispatch import add_periodic
+from logging_setup import setup_logging
+from schedule_control import ScheduleControl
+from schedule_timeline import compile_schedule, load_schedule
+from sensor_engine import SensorAcquisitionEngine
+from settings import (
+    AGGREGATION_WINDOW,
+    CONTROL_TICK_INTERVAL,
+    DRYING_CHECK_INTERVAL,
+    SAMPLING_INTERVAL,
+    SCHEDULE_PATH,
+    SENSOR_MIN_INTERVAL,
+)
+from tb_device_client import RPIDevice, TempHumDevice
+from zones import ZoneController
+
+AIR_HEAT_CAPACITY = 1200  # J/(m3.K)
+LATENT_HEAT = 2450  # J/g of evaporated water
+
+
+def saturation_vapor_density(temperature):
+    # Magnus formula, in g/m3
+    pressure = 611.2 * math.exp(17.62 * temperature / (243.12 + temperature))
+    return pressure / (461.5 * (temperature + 273.15)) * 1000
+
+
+class RoomModel:
+    """
+    Lumped model of the drying room: one air temperature, one vapor density
+    and the water left in the product.
+
+    The heater adds `heater_power` watts, the walls lose heat to the ambient
+    air, the fan exchanges `fan_rate` m3/s of air with the outside (a small
+    `leak_rate` otherwise), and the product evaporates proportionally to its
+    remaining water and to the vapor deficit of the air.
+    """
+
+    def __init__(
+        self,
+        volume=4.0,  # m3
+        ambient_temperature=18.0,
+        ambient_humidity=60.0,  # %RH
+        heater_power=800.0,  # W
+        loss_coefficient=8.0,  # W/K
+        heat_capacity=60000.0,  # J/K, air + structure + product
+        leak_rate=0.0005,  # m3/s
+        fan_rate=0.02,  # m3/s
+        product_water=2000.0,  # g
+        evaporation_coefficient=0.0015,  # m3/s
+    ) -> None:
+        self.volume = volume
+        self.ambient_temperature = ambient_temperature
+        self.ambient_vapor = (
+            saturation_vapor_density(ambient_temperature) * ambient_humidity / 100
+        )
+        self.heater_power = heater_power
+        self.loss_coefficient = loss_coefficient
+        self.heat_capacity = heat_capacity
+        self.leak_rate = leak_rate
+        self.fan_rate = fan_rate
+        self.initial_water = product_water
+        self.evaporation_coefficient = evaporation_coefficient
+
+        self.temperature = ambient_temperature
+        self.vapor = self.ambient_vapor
+        self.water = product_water
+        self.heater_on = False
+        self.fan_on = False
+
+    @property
+    def humidity(self):
+        return min(self.vapor / saturation_vapor_density(self.temperature) * 100, 100)
+
+    @property
+    def moisture(self):
+        # Fraction of the initial water left in the product
+        return self.water / self.initial_water
+
+    def step(self, dt):
+        deficit = max(saturation_vapor_density(self.temperature) - self.vapor, 0)
+        evaporation = min(
+            self.evaporation_coefficient * self.moisture * deficit, self.water / dt
+        )
+        exchange = self.fan_rate if self.fan_on else self.leak_rate
+
+        heat = (
+            (self.heater_power if self.heater_on else 0)
+            - self.loss_coefficient * (self.temperature - self.ambient_temperature)
+            - exchange
+            * AIR_HEAT_CAPACITY
+            * (self.temperature - self.ambient_temperature)
+            - LATENT_HEAT * evaporation
+        )
+        self.temperature += heat / self.heat_capacity * dt
+        self.vapor += (
+            (evaporation + exchange * (self.ambient_vapor - self.vapor))
+            / self.volume
+            * dt
+        )
+        self.water -= evaporation * dt
+
+
+class SimulatedActuator:
+    def __init__(self, label, status=0) -> None:
+        self.label = label
+        self.status = status
+        self.momentary = False
+
+
+class RoomActuators:
+    """
+    ActuatorsControl look-alike whose "heater" and "fan" drive a RoomModel.
+    It also accounts for the time each actuator spent on.
+    """
+
+    def __init__(self, room: RoomModel) -> None:
+        self.room = room
+        self.actuators_map = {
+            "heater": SimulatedActuator("heater"),
+            "fan": SimulatedActuator("fan"),
+        }
+        self.on_time = {label: 0.0 for label in self.actuators_map}
+        self.switches = {label: 0 for label in self.actuators_map}
+
+    def apply_state(self, state):
+        for actuator_id, value in state.items():
+            actuator = self.actuators_map[actuator_id]
+            if actuator.status != value:
+                self.switches[actuator_id] += 1
+            actuator.status = value
+        self.room.heater_on = bool(self.actuators_map["heater"].status)
+        self.room.fan_on = bool(self.actuators_map["fan"].status)
+
+    def advance(self, dt):
+        for label, actuator in self.actuators_map.items():
+            if actuator.status:
+                self.on_time[label] += dt
+        self.room.step(dt)
+
+
+def fixed_cycle(on_minutes=30, off_minutes=30):
+    """
+    The fixed-duration strategy of the example schedule: heater and fan on
+    together for `on_minutes`, then off for `off_minutes`.
+    """
+    period = (on_minutes + off_minutes) * 60
+
+    def make_strategy(actuators):
+        def step(now):
+            value = int(now % period < on_minutes * 60)
+            actuators.apply_state({"heater": value, "fan": value})
+
+        return step
+
+    return make_strategy
+
+
+def closed_loop(setpoints, mode="hysteresis"):
+    """
+    ClimateController ticking at its own rate on simulated time.
+    """
+
+    def make_strategy(actuators):
+        room = actuators.room
+        controller = ClimateController(
+            actuators,
+            lambda: (room.temperature, room.humidity),
+            heater_id="heater",
+            fan_id="fan",
+            mode=mode,
+        )
+        controller.set_setpoints(setpoints)
+        next_tick = 0.0
+
+        def step(now):
+            nonlocal next_tick
+            if now >= next_tick:
+                controller.tick(now)
+                next_tick += controller.tick_interval
+
+        return step
+
+    return make_strategy
+
+
+def simulate(make_strategy, target_moisture=0.2, max_hours=72, dt=5.0, room=None):
+    """
+    Runs a strategy until the product is down to `target_moisture` of its
+    initial water, or for `max_hours`, and returns the run statistics.
+    """
+    room = room or RoomModel()
+    actuators = RoomActuators(room)
+    strategy = make_strategy(actuators)
+    now = 0.0
+    humidity_sum = 0.0
+    max_temperature = room.temperature
+    steps = 0
+    while room.moisture > target_moisture and now < max_hours * 3600:
+        strategy(now)
+        actuators.advance(dt)
+        humidity_sum += room.humidity
+        max_temperature = max(max_temperature, room.temperature)
+        steps += 1
+        now += dt
+
+    return {
+        "dried": room.moisture <= target_moisture,
+        "hours": round(now / 3600, 2),
+        "heater_minutes": round(actuators.on_time["heater"] / 60),
+        "heater_kwh": round(actuators.on_time["heater"] * room.heater_power / 3.6e6, 2),
+        "fan_minutes": round(actuators.on_time["fan"] / 60),
+        "heater_switches": actuators.switches["heater"],
+        "mean_humidity": round(humidity_sum / max(steps, 1), 1),
+        "max_temperature": round(max_temperature, 1),
+    }
+
+
+def compare():
+    setpoints = {"temperature": 45, "humidity": 30}
+    strategies = {
+        "fixed 30/30 min": fixed_cycle(),
+        "hysteresis": closed_loop(setpoints, "hysteresis"),
+        "pid": closed_loop(setpoints, "pid"),
+    }
+    results = {name: simulate(strategy) for name, strategy in strategies.items()}
+    columns = ["dried", "hours", "heater_minutes", "heater_kwh", "fan_minutes"]
+    columns += ["heater_switches", "mean_humidity", "max_temperature"]
+    print(f"{'strategy':<18}" + "".join(f"{column:>16}" for column in columns))
+    for name, result in results.items():
+        print(f"{name:<18}" + "".join(f"{str(result[column]):>16}" for column in columns))
+    return results
+
+
+class VirtualClock:
+    """
+    Simulated time, advanced by the SimulatedScheduler. `speedup` is the
+    number of simulated seconds per wall-clock second.
+    """
+
+    def __init__(self, speedup=600.0, start=None) -> None:
+        self.speedup = speedup
+        self.start = start or datetime.now()
+        self.elapsed = 0.0
+        self.wall_start = time.perf_counter()
+
+    def now(self):
+        return self.start + timedelta(seconds=self.elapsed)
+
+    def monotonic(self):
+        return self.elapsed
+
+    def wall_target(self, elapsed):
+        return self.wall_start + elapsed / self.speedup
+
+
+class SimulatedJob:
+    def __init__(self, job_id, func, args, next_run_time, interval, jobstore) -> None:
+        self.id = job_id
+        self.jobstore = jobstore
+        self.func = func
+        self.args = args
+        self.next_run_time = next_run_time
+        self.interval = interval
+
+    def __repr__(self):
+        return f"<SimulatedJob {self.id} next run at {self.next_run_time}>"
+
+
+class SimulatedScheduler:
+    """
+    The part of the APScheduler API used by ScheduleControl, running jobs on
+    a VirtualClock.
+
+    `run_until()` advances the clock job by job. Before each job it sleeps
+    until the matching wall-clock time, and records in `lateness` how late
+    (in wall seconds) the job actually started.
+    """
+
+    def __init__(self, clock: VirtualClock) -> None:
+        self.clock = clock
+        self.running = False
+        self.jobs = {}
+        self.lateness = []
+        self._queue = []
+        self._counter = itertools.count()
+
+    def add_executor(self, executor, alias="default"):
+        # Jobs run one at a time on the clock
+        pass
+
+    def add_jobstore(self, jobstore, alias="default"):
+        pass
+
+    def add_listener(self, callback, mask=None):
+        pass
+
+    def start(self):
+        self.running = True
+
+    def shutdown(self, wait=True):
+        self.running = False
+
+    def add_job(
+        self,
+        func,
+        trigger=None,
+        args=None,
+        id=None,
+        jobstore="default",
+        run_date=None,
+        start_date=None,
+        minutes=0,
+        seconds=0,
+        **kwargs,
+    ):
+        now = self.clock.now()
+        interval = None
+        if trigger == "interval":
+            interval = timedelta(minutes=minutes, seconds=seconds)
+            next_run_time = start_date or now + interval
+            while next_run_time < now:
+                next_run_time += interval
+        else:
+            next_run_time = run_date or now
+        job = SimulatedJob(
+            id or f"job-{next(self._counter)}",
+            func,
+            args or [],
+            next_run_time,
+            interval,
+            jobstore,
+        )
+        self.jobs[job.id] = job
+        heapq.heappush(self._queue, (next_run_time, next(self._counter), job))
+        return job
+
+    def get_jobs(self, jobstore=None):
+        return [
+            job
+            for job in self.jobs.values()
+            if jobstore is None or job.jobstore == jobstore
+        ]
+
+    def get_job(self, job_id):
+        return self.jobs.get(job_id)
+
+    def remove_job(self, job_id, jobstore=None):
+        self.jobs.pop(job_id, None)
+
+    def remove_all_jobs(self, jobstore=None):
+        for job in self.get_jobs(jobstore):
+            self.jobs.pop(job.id)
+
+    def print_jobs(self, jobstore=None):
+        for job in self.jobs.values():
+            print(job)
+
+    def run_until(self, end, on_advance=None, max_step=5.0):
+        while self._queue and self._queue[0][0] <= end:
+            run_time, _, job = heapq.heappop(self._queue)
+            if self.jobs.get(job.id) is not job:
+                # Removed or replaced
+                continue
+            self._advance_to(run_time, on_advance, max_step)
+
+            delay = self.clock.wall_target(self.clock.elapsed) - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            self.lateness.append(
+                time.perf_counter() - self.clock.wall_target(self.clock.elapsed)
+            )
+            try:
+                job.func(*job.args)
+            except Exception:
+                logging.error(f"Job {job.id} failed", exc_info=True)
+
+            if job.interval:
+                job.next_run_time = run_time + job.interval
+                heapq.heappush(
+                    self._queue, (job.next_run_time, next(self._counter), job)
+                )
+            else:
+                self.jobs.pop(job.id, None)
+        self._advance_to(end, on_advance, max_step)
+
+    def _advance_to(self, when, on_advance, max_step):
+        target = (when - self.clock.start).total_seconds()
+        while self.clock.elapsed < target:
+            dt = min(max_step, target - self.clock.elapsed)
+            if on_advance:
+                on_advance(dt)
+            self.clock.elapsed += dt
+
+
+class RoomOutputBank(FakeOutputBank):
+    """
+    FakeOutputBank whose heater and fan pins switch the RoomModel.
+    """
+
+    def __init__(self, room: RoomModel, pins, heater_pin, fan_pin) -> None:
+        super().__init__(pins)
+        self.room = room
+        self.heater_pin = heater_pin
+        self.fan_pin = fan_pin
+
+    def write(self, values):
+        self.writes.append(dict(values))
+        if self.heater_pin in values:
+            self.room.heater_on = bool(values[self.heater_pin])
+        if self.fan_pin in values:
+            self.room.fan_on = bool(values[self.fan_pin])
+
+
+class SimulatedDHT22:
+    """
+    DHT22 look-alike reading the RoomModel, with measurement noise and the
+    occasional failed read (raising RuntimeError like the real driver).
+    """
+
+    def __init__(self, room: RoomModel, offset=0.0, noise=0.2, failure_rate=0.05):
+        self.room = room
+        self.offset = offset
+        self.noise = noise
+        self.failure_rate = failure_rate
+
+    @property
+    def temperature(self):
+        if random.random() < self.failure_rate:
+            raise RuntimeError("Checksum did not validate. Try again.")
+        return round(self.room.temperature + self.offset + random.gauss(0, self.noise), 1)
+
+    @property
+    def humidity(self):
+        return round(self.room.humidity + random.gauss(0, self.noise * 5), 1)
+
+    def exit(self):
+        pass
+
+
+class FakeMessageInfo:
+    # paho's MQTTMessageInfo, acknowledged after `latency`
+    rc = 0
+
+    def __init__(self, latency) -> None:
+        self.latency = latency
+        self._published = False
+
+    def wait_for_publish(self, timeout=None):
+        time.sleep(self.latency if timeout is None else min(self.latency, timeout))
+        self._published = timeout is None or self.latency <= timeout
+
+    def is_published(self):
+        return self._published
+
+
+class FakePublishInfo:
+    def __init__(self, latency) -> None:
+        self.latency = latency
+        self.message_info = FakeMessageInfo(latency)
+
+    def rc(self):
+        return 0
+
+    def get(self):
+        self.message_info.wait_for_publish(1)
+        return 0
+
+
+class FakeMqttClient:
+    """
+    TBDeviceMqttClient look-alike recording the messages it is given.
+    `latency` is the wall time waited for an acknowledgement.
+    """
+
+    def __init__(self, latency=0.005) -> None:
+        self.latency = latency
+        self.connected = False
+        self.messages = []
+        self.rpc_handler = None
+
+    def connect(self, *args, **kwargs):
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    def disconnect(self):
+        self.connected = False
+
+    def send_telemetry(self, telemetry, quality_of_service=None):
+        self.messages.append(("telemetry", telemetry))
+        return FakePublishInfo(self.latency)
+
+    def send_attributes(self, attributes, quality_of_service=None):
+        self.messages.append(("attributes", attributes))
+        return FakePublishInfo(self.latency)
+
+    def send_rpc_reply(self, req_id, resp, quality_of_service=None, wait_for_publish=False):
+        self.messages.append(("rpc_reply", resp))
+
+    def subscribe_to_all_attributes(self, callback):
+        pass
+
+    def request_attributes(self, client_keys=None, shared_keys=None, callback=None):
+        if callback:
+            callback({"shared": {}}, None)
+
+    def set_server_side_rpc_request_handler(self, handler):
+        self.rpc_handler = handler
+
+
+class SimulatedCameraService:
+    def __init__(self, clock: VirtualClock, capture_time=0.0) -> None:
+        self.clock = clock
+        self.capture_time = capture_time
+        self.captures = 0
+
+    def capture(self, flash_on=None, flash_off=None):
+        time.sleep(self.capture_time)
+        self.captures += 1
+        name = f"image_{self.clock.now():%Y_%m_%d-%I_%M_%S_%p}.jpg"
+        return CapturedImage(name, b"", self.clock.now().timestamp())
+
+
+class DryingRoomSimulation:
+    """
+    The controller of main.py wired to the simulation backend: the example
+    schedule runs through ScheduleControl on a SimulatedScheduler, the
+    relays of a RoomOutputBank drive the RoomModel, TempHumDevice reads
+    SimulatedDHT22 sensors and both devices publish to FakeMqttClients.
+    """
+
+    PINS = {"relay_1": 17, "relay_2": 27, "fan": 22, "heater": 23}
+
+    def __init__(
+        self,
+        speedup=600.0,
+        room: RoomModel = None,
+        control=True,
+        mqtt_latency=0.005,
+        sensor_failure_rate=0.05,
+        drying_target=None,
+    ) -> None:
+        self.clock = VirtualClock(speedup)
+        self.scheduler = SimulatedScheduler(self.clock)
+        self.room = room or RoomModel()
+        labels = ("Top", "Top-middle", "Bottom-middle", "Bottom")
+        self.estimator = None
+        if drying_target is not None:
+            self.estimator = DryingEstimator(
+                labels,
+                target=drying_target,
+                clock=lambda: self.clock.now().timestamp(),
+            )
+        self.bank = RoomOutputBank(
+            self.room, self.PINS.values(), self.PINS["heater"], self.PINS["fan"]
+        )
+        self.camera_service = SimulatedCameraService(self.clock)
+        relays = {
+            label: RelayActuator(label, pin, self.bank)
+            for label, pin in self.PINS.items()
+        }
+        camera = CameraActuator("camera", service=self.camera_service)
+
+        self.th = TempHumDevice(
+            "simulation",
+            name="simulation-TempHumDevice",
+            client=FakeMqttClient(mqtt_latency),
+            aggregation_window=AGGREGATION_WINDOW / speedup,
+            sensors_config=[
+                {
+                    "label": label,
+                    "sensor": SimulatedDHT22(
+                        self.room, offset, failure_rate=sensor_failure_rate
+                    ),
+                }
+                for label, offset in zip(labels, (1.0, 0.5, -0.5, -1.0))
+            ],
+            estimator=self.estimator,
+        )
+        # Keep the sensors read at the same simulated rate
+        self.th.engine.min_interval = SENSOR_MIN_INTERVAL / speedup
+        self.pi = RPIDevice(
+            "simulation",
+            name="simulation-RPIDevice",
+            client=FakeMqttClient(mqtt_latency),
+        )
+        self.devices = [self.pi, self.th]
+
+        self.actuators = ActuatorsControl([camera, *relays.values()])
+        self.climate = None
+        if control:
+            self.climate = ClimateController(
+                self.actuators,
+                engine_climate(self.th.engine),
+                heater_id="heater",
+                fan_id="fan",
+            )
+            add_periodic(
+                self.scheduler,
+                lambda: self.climate.tick(self.clock.monotonic()),
+                CONTROL_TICK_INTERVAL,
+                id="climate-control",
+                now=self.clock.now(),
+            )
+
+        self.timeline = compile_schedule(load_schedule(SCHEDULE_PATH))
+        self.schedule_control = ScheduleControl(
+            self.timeline,
+            scheduler_class=lambda: self.scheduler,
+            start_delay=0,
+            monitor=False,
+            persistent=False,
+            actuators=self.actuators,
+            climate=self.climate,
+            clock=self.clock.now,
+        )
+        self.drying = None
+        if self.estimator:
+            self.drying = DryingControl(self.estimator, self.schedule_control)
+            add_periodic(
+                self.scheduler,
+                self.drying.check,
+                DRYING_CHECK_INTERVAL * 60,
+                id="drying-control",
+                heavy=True,
+                now=self.clock.now(),
+            )
+
+        self.publish_latency = {device.name: [] for device in self.devices}
+        self.publish_cpu = {device.name: [] for device in self.devices}
+        self.heater_seconds = 0.0
+        self.fan_seconds = 0.0
+        for device in self.devices:
+            add_periodic(
+                self.scheduler,
+                self.publish,
+                SAMPLING_INTERVAL,
+                id=f"publish-{device.name}",
+                args=[device],
+                now=self.clock.now(),
+            )
+
+    @property
+    def duration(self):
+        # Minutes until the end of the example schedule
+        return self.timeline.duration / 60
+
+    def publish(self, device):
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        device.sample()
+        device.flush()
+        self.publish_cpu[device.name].append(time.thread_time() - cpu_started)
+        self.publish_latency[device.name].append(time.perf_counter() - started)
+
+    def advance(self, dt):
+        self.room.step(dt)
+        if self.room.heater_on:
+            self.heater_seconds += dt
+        if self.room.fan_on:
+            self.fan_seconds += dt
+
+    def run(self, minutes=None):
+        minutes = minutes if minutes is not None else self.duration + 10
+        self.th.engine.start()
+        cpu_started = time.process_time()
+        wall_started = time.perf_counter()
+        try:
+            self.scheduler.run_until(
+                self.clock.now() + timedelta(minutes=minutes), on_advance=self.advance
+            )
+        finally:
+            self.cpu_time = time.process_time() - cpu_started
+            self.wall_time = time.perf_counter() - wall_started
+            self.th.engine.stop()
+        return self
+
+
+class MultiZoneSimulation:
+    """
+    `zones` drying rooms, each with its own RoomModel, relays and two
+    SimulatedDHT22, run by one ZoneController: the zones share the
+    SimulatedScheduler, the SensorAcquisitionEngine and a single
+    TempHumDevice publishing all their sensors.
+    """
+
+    PINS = DryingRoomSimulation.PINS
+
+    def __init__(
+        self,
+        zones=2,
+        speedup=600.0,
+        mqtt_latency=0.005,
+        sensor_failure_rate=0.05,
+    ) -> None:
+        self.clock = VirtualClock(speedup)
+        self.scheduler = SimulatedScheduler(self.clock)
+        self.engine = SensorAcquisitionEngine(SENSOR_MIN_INTERVAL / speedup)
+        self.controller = ZoneController(
+            scheduler=self.scheduler, engine=self.engine, clock=self.clock.monotonic
+        )
+        self.timeline = compile_schedule(load_schedule(SCHEDULE_PATH))
+        self.rooms = {}
+        for index in range(zones):
+            name = f"zone_{index + 1}"
+            room = self.rooms[name] = RoomModel()
+            bank = RoomOutputBank(
+                room, self.PINS.values(), self.PINS["heater"], self.PINS["fan"]
+            )
+            actuators = ActuatorsControl(
+                [
+                    CameraActuator("camera", service=SimulatedCameraService(self.clock)),
+                    *(RelayActuator(label, pin, bank) for label, pin in self.PINS.items()),
+                ]
+            )
+            self.controller.add_zone(
+                name,
+                self.timeline,
+                actuators,
+                sensors_config=[
+                    {
+                        "label": label,
+                        "sensor": SimulatedDHT22(
+                            room, offset, failure_rate=sensor_failure_rate
+                        ),
+                    }
+                    for label, offset in (("Top", 0.5), ("Bottom", -0.5))
+                ],
+                start_delay=0,
+                monitor=False,
+                persistent=False,
+            )
+
+        self.th = TempHumDevice(
+            "simulation",
+            name="simulation-zones",
+            client=FakeMqttClient(mqtt_latency),
+            aggregation_window=AGGREGATION_WINDOW / speedup,
+            sensors_config=self.controller.sensors_config,
+            engine=self.engine,
+        )
+        add_periodic(
+            self.scheduler,
+            self.publish,
+            SAMPLING_INTERVAL,
+            id="publish-zones",
+            now=self.clock.now(),
+        )
+
+    def publish(self):
+        self.th.sample()
+        self.th.flush()
+
+    def advance(self, dt):
+        for room in self.rooms.values():
+            room.step(dt)
+
+    def run(self, minutes=None):
+        minutes = minutes if minutes is not None else self.timeline.duration / 60 + 10
+        self.controller.start()
+        cpu_started = time.process_time()
+        wall_started = time.perf_counter()
+        try:
+            self.scheduler.run_until(
+                self.clock.now() + timedelta(minutes=minutes), on_advance=self.advance
+            )
+        finally:
+            self.cpu_time = time.process_time() - cpu_started
+            self.wall_time = time.perf_counter() - wall_started
+            self.controller.stop()
+        return self
+
+
+if __name__ == "__main__":
+    setup_logging(level=logging.WARNING)
+    compare()
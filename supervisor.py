@@ -0,0 +1,288 @@
+"""
+Fail-safe supervisor of the actuators.
+
+The scheduler, the sensor acquisition engine and the uplink loop each
+report a heartbeat with `beat(name)`. A thread checks them every
+`check_interval` seconds, and the sensor readings are checked as they
+arrive. On a fault all the actuators are reset:
+
+- a heartbeat older than its timeout (a dead scheduler thread, a publish or
+  a sensor read hanging) resets the actuators, then exits the process so
+  systemd restarts it and the schedule is resumed,
+- a reading above `max_temperature` resets the actuators on every check
+  while the temperature stays above it. The fault is latched: the
+  fail-safe callables (e.g. ActuatorsControl.trip) hold the actuators off
+  until the readings stayed `temperature_margin` below the limit for
+  `clear_after` seconds, or an operator calls `clear()` (the "clearFault"
+  RPC). The `release` callables then lift the latch.
+
+The reset runs on its own thread. If it does not complete within
+`reset_deadline` (e.g. a GPIO write blocked behind a hung thread) the
+`force_off` callables (e.g. ActuatorsControl.force_off) write the relays
+off without taking the locks, for at most FORCE_OFF_WAIT seconds, and the
+process exits. Exiting does not switch anything off by itself: os._exit
+skips the GPIO cleanup and a released gpiod line keeps its last level, so a
+relay whose forced write also hung stays as it was until systemd restarts
+the service, which requests the lines off.
+
+The time between a fault becoming detectable and the actuators being
+reset is recorded in the "supervisor_reaction_seconds" histogram.
+
+Under systemd (Type=notify), the supervisor reports READY=1 when started
+and pings the watchdog (WatchdogSec) on every healthy check, so systemd
+also restarts the service when the supervisor itself hangs.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+
+import instrumentation
+from settings import (
+    SUPERVISOR_CHECK_INTERVAL,
+    SUPERVISOR_CLEAR_AFTER,
+    SUPERVISOR_MAX_TEMPERATURE,
+    SUPERVISOR_RESET_DEADLINE,
+    SUPERVISOR_TEMPERATURE_MARGIN,
+)
+
+# Exit status after a stall, see Restart= in rpimonitor.service
+EXIT_STALLED = 3
+# Longest wait for the forced writes before exiting after a stall
+FORCE_OFF_WAIT = 1.0
+
+
+def sd_notify(state):
+    """
+    Sends `state` (e.g. "READY=1" or "WATCHDOG=1") to systemd. Returns
+    False when not run by systemd with a notification socket.
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        # Abstract namespace socket
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode())
+    except OSError:
+        logging.error("Failed notifying systemd of %s", state, exc_info=True)
+        return False
+    return True
+
+
+def watchdog_timeout():
+    # WatchdogSec of the service, None when the watchdog is not enabled
+    usec = os.environ.get("WATCHDOG_USEC")
+    pid = os.environ.get("WATCHDOG_PID")
+    if not usec or (pid and int(pid) != os.getpid()):
+        return None
+    return int(usec) / 1e6
+
+
+class Supervisor:
+    def __init__(
+        self,
+        fail_safe=(),
+        timeouts: dict = None,
+        max_temperature=SUPERVISOR_MAX_TEMPERATURE,
+        release=(),
+        temperature_margin=SUPERVISOR_TEMPERATURE_MARGIN,
+        clear_after=SUPERVISOR_CLEAR_AFTER,
+        force_off=(),
+        check_interval=SUPERVISOR_CHECK_INTERVAL,
+        reset_deadline=SUPERVISOR_RESET_DEADLINE,
+        notify=sd_notify,
+        exit=os._exit,
+        clock=time.monotonic,
+    ) -> None:
+        # Callables switching actuators off, e.g. ActuatorsControl.trip, and
+        # lifting the latch of an over temperature, e.g. ActuatorsControl.release
+        self.fail_safe = list(fail_safe)
+        self.release = list(release)
+        # Lock-free switch off when the fail-safe hangs, e.g.
+        # ActuatorsControl.force_off
+        self.force_off = list(force_off)
+        self.max_temperature = max_temperature
+        self.temperature_margin = temperature_margin
+        self.clear_after = clear_after
+        self.check_interval = check_interval
+        self.reset_deadline = reset_deadline
+        self.notify = notify
+        self.exit = exit
+        self.clock = clock
+
+        self.timeouts = {}
+        self._beats = {}
+        for name, timeout in (timeouts or {}).items():
+            self.watch(name, timeout)
+        # {sensor label: when it was first read above max_temperature}
+        self._hot = {}
+        self._over_temperature = False
+        # When the last hot sensor cooled down, while the fault is latched
+        self._cool_since = None
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        watchdog = watchdog_timeout()
+        if watchdog is not None and watchdog < 2 * check_interval:
+            logging.warning(
+                f"WatchdogSec={watchdog:g} is too short for a "
+                f"{check_interval:g}s supervisor check interval"
+            )
+
+    def watch(self, name, timeout):
+        # The timeout counts from now until the first heartbeat
+        self.timeouts[name] = timeout
+        self._beats[name] = self.clock()
+
+    def beat(self, name):
+        self._beats[name] = self.clock()
+
+    def on_reading(self, label, reading):
+        """
+        SensorAcquisitionEngine listener: a reading is a heartbeat of the
+        engine, and a reading above max_temperature wakes the supervisor up.
+        A sensor stays hot until it reads `temperature_margin` below it.
+        """
+        self.beat("sensors")
+        if reading.temperature is None:
+            return
+        if reading.temperature >= self.max_temperature:
+            if label not in self._hot:
+                self._hot[label] = self.clock()
+                self._wakeup.set()
+        elif (
+            label in self._hot
+            and reading.temperature < self.max_temperature - self.temperature_margin
+        ):
+            del self._hot[label]
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="supervisor", daemon=True
+        )
+        self._thread.start()
+        self.notify("READY=1")
+
+    def stop(self):
+        self.notify("STOPPING=1")
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.check()
+            except Exception:
+                logging.error("Supervisor check failed", exc_info=True)
+            self._wakeup.wait(self.check_interval)
+            self._wakeup.clear()
+
+    def check(self):
+        now = self.clock()
+        for name, timeout in self.timeouts.items():
+            detectable = self._beats[name] + timeout
+            if now > detectable:
+                logging.critical(
+                    f"No {name} heartbeat for {now - self._beats[name]:.0f}s, "
+                    "resetting the actuators"
+                )
+                self.trip("stall", detectable)
+                self.exit(EXIT_STALLED)
+                return
+
+        hot = dict(self._hot)
+        if hot:
+            logging.critical(
+                f"Over temperature on {', '.join(sorted(hot))}, "
+                "resetting the actuators"
+            )
+            # Only the first reset of an over temperature is a reaction
+            self.trip("temperature", None if self._over_temperature else min(hot.values()))
+            self._over_temperature = True
+            self._cool_since = None
+        elif self._over_temperature:
+            # Latched until it stayed cool for clear_after
+            if self._cool_since is None:
+                self._cool_since = now
+            elif self.clear_after is not None and now - self._cool_since >= self.clear_after:
+                logging.warning(
+                    f"Cool for {now - self._cool_since:.0f}s, clearing the over temperature"
+                )
+                self.clear()
+        self.notify("WATCHDOG=1")
+
+    def clear(self):
+        """
+        Lifts the over temperature latch. Returns False while a sensor is
+        still hot.
+        """
+        if self._hot:
+            return False
+        self._over_temperature = False
+        self._cool_since = None
+        for release in self.release:
+            try:
+                release()
+            except Exception:
+                logging.error("Fail-safe release failed", exc_info=True)
+        return True
+
+    def trip(self, fault, detectable=None):
+        """
+        Resets the actuators, or exits when that takes longer than
+        `reset_deadline`. The reaction time is counted from `detectable`.
+        """
+        done = threading.Event()
+
+        def reset():
+            for fail_safe in self.fail_safe:
+                try:
+                    fail_safe()
+                except Exception:
+                    logging.error("Fail-safe reset failed", exc_info=True)
+            done.set()
+
+        threading.Thread(target=reset, name="fail-safe", daemon=True).start()
+        if not done.wait(self.reset_deadline):
+            logging.critical(
+                f"The actuators were not reset within {self.reset_deadline}s, exiting"
+            )
+            self.force_off_and_exit()
+            return
+        if detectable is not None:
+            instrumentation.observe(
+                "supervisor_reaction_seconds", self.clock() - detectable, fault=fault
+            )
+
+    def force_off_and_exit(self):
+        done = threading.Event()
+
+        def force_off():
+            for force_off in self.force_off:
+                try:
+                    force_off()
+                except Exception:
+                    logging.error("Forced switch off failed", exc_info=True)
+            done.set()
+
+        threading.Thread(target=force_off, name="force-off", daemon=True).start()
+        if not done.wait(FORCE_OFF_WAIT):
+            logging.critical("The relays could not be forced off")
+        self.exit(EXIT_STALLED)
+
+    @staticmethod
+    def reaction_quantiles(fault, quantiles=(0.5, 0.95, 0.99)):
+        return instrumentation.histogram(
+            "supervisor_reaction_seconds", fault=fault
+        ).quantiles(quantiles)
@@ -0,0 +1,181 @@
+import glob
+import os
+import shutil
+import socket
+import logging
+
+
+class ProcFile:
+    """
+    A file under /proc or /sys that is opened once and re-read with seek(0).
+    Missing files (e.g. no thermal zone in a container) read as None.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            # Unbuffered so every read hits the kernel and returns fresh data
+            self.handle = open(path, "rb", buffering=0)
+        except OSError:
+            logging.warning(f"Cannot open {path}, related metrics will be empty")
+            self.handle = None
+
+    def read(self):
+        if self.handle is None:
+            return None
+        self.handle.seek(0)
+        return self.handle.read(8192).decode()
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+
+class SystemSampler:
+    """
+    Collects the RPIDevice telemetry without forking any process.
+
+    CPU usage is computed on the delta between two consecutive samples, so it
+    reflects the load since the previous publish rather than since boot.
+    """
+
+    def __init__(
+        self,
+        thermal_zone="/sys/class/thermal/thermal_zone0/temp",
+        disk_path="/",
+    ) -> None:
+        self.disk_path = disk_path
+        self.stat = ProcFile("/proc/stat")
+        self.meminfo = ProcFile("/proc/meminfo")
+        self.uptime = ProcFile("/proc/uptime")
+        self.loadavg = ProcFile("/proc/loadavg")
+        self.thermal = ProcFile(thermal_zone)
+        self._last_cpu = self._read_cpu_times()
+
+    def close(self):
+        for proc_file in (
+            self.stat,
+            self.meminfo,
+            self.uptime,
+            self.loadavg,
+            self.thermal,
+        ):
+            proc_file.close()
+
+    def _read_cpu_times(self):
+        content = self.stat.read()
+        if not content:
+            return None
+        # First line is the aggregate: "cpu user nice system idle ..."
+        fields = content.split("\n", 1)[0].split()
+        user, _, system, idle = (int(value) for value in fields[1:5])
+        return user + system, user + system + idle
+
+    def cpu_usage(self):
+        current = self._read_cpu_times()
+        previous, self._last_cpu = self._last_cpu, current
+        if current is None or previous is None:
+            return None
+        busy = current[0] - previous[0]
+        total = current[1] - previous[1]
+        if total <= 0:
+            return 0.0
+        return round(busy * 100 / total, 2)
+
+    def memory_usage(self):
+        content = self.meminfo.read()
+        if not content:
+            return None, None
+        meminfo = {}
+        for line in content.splitlines():
+            key, _, value = line.partition(":")
+            meminfo[key] = int(value.split()[0])
+
+        mem_total = meminfo["MemTotal"]
+        mem_available = meminfo.get("MemAvailable", meminfo["MemFree"])
+        ram_usage = round((mem_total - mem_available) * 100 / mem_total, 2)
+
+        swap_total = meminfo.get("SwapTotal", 0)
+        swap_usage = 0.0
+        if swap_total:
+            swap_used = swap_total - meminfo.get("SwapFree", 0)
+            swap_usage = round(swap_used * 100 / swap_total, 2)
+        return ram_usage, swap_usage
+
+    def processes_count(self):
+        content = self.loadavg.read()
+        if not content:
+            return None
+        # "0.04 0.05 0.01 2/72 2622": the 4th field is running/total tasks
+        return int(content.split()[3].split("/")[1])
+
+    def boot_time(self):
+        content = self.uptime.read()
+        if not content:
+            return None
+        return format_uptime(float(content.split()[0]))
+
+    def soc_temperature(self):
+        content = self.thermal.read()
+        if not content:
+            return None
+        return int(content) / 1000
+
+    def sample(self):
+        ram_usage, swap_usage = self.memory_usage()
+        cpu_usage = self.cpu_usage()
+        disk = shutil.disk_usage(self.disk_path)
+        soc_temp = self.soc_temperature()
+
+        avg_load = None
+        if cpu_usage is not None and ram_usage is not None:
+            avg_load = (cpu_usage + ram_usage) / 2
+
+        return {
+            "cpu_usage": cpu_usage,
+            "processes_count": self.processes_count(),
+            "disk_usage": disk.used / 1024 / 1024 / 1024,
+            "disk_available": disk.free / 1024 / 1024 / 1024,
+            "RAM_usage": ram_usage,
+            "swap_memory_usage": swap_usage,
+            "boot_time": self.boot_time(),
+            "avg_load": avg_load,
+            "cpu_temp": soc_temp,
+            # CPU and GPU share the same die and sensor on the Pi,
+            # vcgencmd measure_temp reports the same value
+            "gpu_temp": soc_temp,
+        }
+
+
+def format_uptime(seconds):
+    # Same output as `uptime -p`, e.g. "up 1 day, 3 hours, 2 minutes"
+    minutes = int(seconds // 60)
+    parts = []
+    for unit, size in (("week", 10080), ("day", 1440), ("hour", 60), ("minute", 1)):
+        value, minutes = divmod(minutes, size)
+        if value:
+            parts.append(f"{value} {unit}{'s' if value > 1 else ''}")
+    if not parts:
+        parts.append("0 minutes")
+    return "up " + ", ".join(parts)
+
+
+def ip_address():
+    # Connecting a UDP socket sends no packet, it only selects the outbound
+    # interface, whose address is what `hostname -I` reports first.
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        try:
+            s.connect(("10.255.255.255", 1))
+            return s.getsockname()[0]
+        except OSError:
+            return "127.0.0.1"
+
+
+def mac_address():
+    for path in sorted(glob.glob("/sys/class/net/*/address")):
+        if os.path.basename(os.path.dirname(path)) == "lo":
+            continue
+        with open(path) as f:
+            return f.read().strip()
+    return None
@@ -1,19 +1,31 @@
 import logging.handlers
-import os
-import shutil
-from tb_gateway_mqtt import TBDeviceMqttClient
 import time
-import adafruit_dht
-from board import D5, D6, D13, D19
-
-from dotenv import load_dotenv
-
-load_dotenv()
-
-THINGSBOARD_SERVER = os.getenv("THINGSBOARD_SERVER")
-THINGSBOARD_PORT = int(os.getenv("THINGSBOARD_PORT"))
-
-logging.basicConfig(format="%(asctime)s - %(message)s", level=logging.INFO)
+from typing import TYPE_CHECKING
+
+from aggregation import SensorAggregator
+from attribute_store import AttributeStore
+import backends
+import instrumentation
+from sensor_engine import SensorAcquisitionEngine
+from settings import (
+    AGGREGATION_WINDOW,
+    METRICS_TELEMETRY,
+    MQTT_BACKEND,
+    SAMPLING_INTERVAL,
+    SENSOR_BACKEND,
+    SENSORS,
+    SPOOL_FOLDER,
+)
+from history_store import HistoryStore
+from logging_setup import RATE_LIMITED
+from rpc import RpcDispatcher, RpcError
+from system_stats import SystemSampler, ip_address, mac_address
+from telemetry_pipeline import SegmentRingBuffer, TelemetryPipeline
+
+if TYPE_CHECKING:
+    from camera_service import CameraCaptureService
+    # Only needed with drying estimation, which imports numpy
+    from drying_estimator import DryingEstimator
 
 
 class ThingsBoardDevice:
@@ -21,281 +33,308 @@ class ThingsBoardDevice:
     This class is a wrapper for the ThingsBoardClient class.
     It allows you to create a device with states and RPC callbacks.
 
-    "states" format: { "state_name": { "value": "state_value" } }
+    "states" format: { "state_name": { "value": "state_value" } } or { "state_name": "state_value" }
     "rpc_callbacks" format: { "rpc_method_name": "callback_function or string representing class method" }
 
+    States are shared attributes kept in `self.attributes`, typed after their
+    default value. Every device has the "samplingInterval" and
+    "publishingInterval" states, applied as soon as they change.
+
+    With a HistoryStore, the telemetry is also kept locally as the series
+    "<device name>/<key>", and the "backfillTelemetry" RPC sends it again.
     """
 
-    client: TBDeviceMqttClient = None
-    states: dict = {}
-    rpc_callbacks: dict = {}
+    client = None
+    attributes: AttributeStore = None
+    rpc_callbacks: dict = None
 
     def __init__(
-        self, ACCESS_TOKEN, states: dict = {}, rpc_callbacks: dict = {}
+        self,
+        ACCESS_TOKEN,
+        states: dict = None,
+        rpc_callbacks: dict = None,
+        name=None,
+        sampling_interval=SAMPLING_INTERVAL,
+        client=None,
+        history: HistoryStore = None,
     ) -> None:
-        logging.info(f"Initializing ThingsBoardDevice {self.__class__.__name__}")
-        self.client = TBDeviceMqttClient(
-            THINGSBOARD_SERVER, THINGSBOARD_PORT, ACCESS_TOKEN
-        )
+        self.name = name or self.__class__.__name__
+        self.sampling_interval = sampling_interval
+        self.history = history
+        logging.info(f"Initializing ThingsBoardDevice {self.name}")
+        # Any object with the TBDeviceMqttClient interface can be given,
+        # e.g. the simulation's fake client
+        self.client = client or backends.create("mqtt", MQTT_BACKEND, ACCESS_TOKEN)
         self.connect()
+        self._last_attributes = None
+        self.pipeline = TelemetryPipeline(
+            self.client,
+            spool=SegmentRingBuffer(f"{SPOOL_FOLDER}/{self.name}"),
+            reconnect=self.connect,
+        )
 
-        if states:
-            if type(states) is not dict:
-                raise TypeError("States must be a dictionary")
-            self.states = states
-
-            for key, value in states.items():
-                # Initiate states
-                setattr(self, key, value)
-
-            self.client.subscribe_to_all_attributes(self.attribute_callback)
-            # Get all states from server
-            self.client.request_attributes(
-                shared_keys=list(self.states.keys()), callback=self.sync_state
-            )
+        if states is not None and type(states) is not dict:
+            raise TypeError("States must be a dictionary")
+        self.attributes = AttributeStore(
+            {
+                "samplingInterval": float(self.sampling_interval),
+                "publishingInterval": float(self.pipeline.flush_interval),
+                **(states or {}),
+            }
+        )
+        # Before requesting them, so no value from the server is missed
+        self.subscribe_attributes()
+        self.client.subscribe_to_all_attributes(self.attribute_callback)
+        # Get all states from server
+        self.client.request_attributes(
+            shared_keys=self.attributes.keys(), callback=self.sync_state
+        )
 
+        # RPC methods are resolved once into a dispatch table
+        self.rpc = RpcDispatcher(self)
+        self.rpc_callbacks = {}
+        self._rpc_handler_set = False
         if rpc_callbacks:
-            if type(rpc_callbacks) is not dict:
-                raise TypeError(
-                    f"RPC callbacks must be a dictionary, receive {type(rpc_callbacks)}"
-                )
-            self.rpc_callbacks = rpc_callbacks
+            self.add_rpc_callbacks(rpc_callbacks)
+        if history is not None:
+            self.add_rpc_callbacks({"backfillTelemetry": self.backfill})
+
+    def add_rpc_callbacks(self, rpc_callbacks: dict):
+        """
+        Adds RPC methods, `{method: callable or method name}`. Callables can
+        take the request params and return the RPC response.
+        """
+        if type(rpc_callbacks) is not dict:
+            raise TypeError(
+                f"RPC callbacks must be a dictionary, receive {type(rpc_callbacks)}"
+            )
+        self.rpc.update(rpc_callbacks)
+        self.rpc_callbacks = {**self.rpc_callbacks, **rpc_callbacks}
+        if not self._rpc_handler_set:
             self.client.set_server_side_rpc_request_handler(self.register_rpc_callbacks)
+            self._rpc_handler_set = True
+
+    def subscribe_attributes(self):
+        """
+        Subscribes the handlers of the states, called before they are
+        requested from the server. Subclasses extend it for their states.
+        """
+        self.attributes.subscribe("samplingInterval", self._set_sampling_interval)
+        self.attributes.subscribe("publishingInterval", self._set_publishing_interval)
 
     # request attribute callback
     def sync_state(self, result, exception=None):
-        logging.info(f"Synchronizing ThingsBoardDevice {self.__class__.__name__}")
-        global period
+        logging.info(f"Synchronizing ThingsBoardDevice {self.name}")
         if exception is not None:
             logging.warning("Exception: " + str(exception), exc_info=exception)
         else:
-            shared_attributes = result.get("shared", {})
-            logging.info("Synchronizing status with server")
-            for key, value in shared_attributes.items():
-                logging.info(f"Setting {key} to {value}")
-                setattr(self, key, value)
+            self.attributes.update(result.get("shared", {}))
 
     # callback function that will call when we will change value of our Shared Attribute
     def attribute_callback(self, results, _):
-        logging.info("Received new shared attribute values from ThingsBoard")
-        for key, value in results.items():
-            logging.info(f"Setting {key} to {value}")
-            setattr(self, key, value)
+        logging.debug("Received new shared attribute values from ThingsBoard")
+        self.attributes.update(results)
+
+    def _set_sampling_interval(self, key, old, new):
+        if new <= 0:
+            raise ValueError(f"{key} must be positive")
+        self.sampling_interval = new
+
+    def _set_publishing_interval(self, key, old, new):
+        if new < 0:
+            raise ValueError(f"{key} cannot be negative")
+        self.pipeline.flush_interval = new
 
     # callback function that will call when we will send RPC
     def register_rpc_callbacks(self, id, request_body):
         # request body contains method and other parameters
-        logging.info(f"Received rpc callback with body: {request_body}")
-        method_key = request_body.get("method")
-        if method_key in self.rpc_callbacks.keys():
-            cb = None
-            if callable(self.rpc_callbacks[method_key]):
-                cb = self.rpc_callbacks[method_key]
-            elif (
-                type(self.rpc_callbacks[method_key]) is str
-                and hasattr(self, self.rpc_callbacks[method_key])
-                and callable(getattr(self, self.rpc_callbacks[method_key]))
-            ):
-                cb = getattr(self, self.rpc_callbacks[method_key])
-            if not cb:
-                logging.warning(f"Invalid callback for method '{method_key}'")
-            else:
-                logging.info(f"Executing RPC callback {cb}")
-                cb()
-        else:
-            logging.info(
-                f"Unknown method '{method_key}'. Available methods are: {self.rpc_callbacks.keys().join(', ')}"
-            )
+        method = request_body.get("method")
+        logging.info("Received rpc request %s", method)
+        response = self.rpc.dispatch(method, request_body.get("params"))
+        if "error" in response:
+            logging.warning("RPC %s: %s", method, response["error"])
+        try:
+            self.client.send_rpc_reply(id, response)
+        except Exception:
+            logging.error("Failed replying to RPC %s", method, exc_info=True)
 
     def get_data(self) -> tuple[dict, dict]:
         raise NotImplementedError()
 
     def connect(self):
-        logging.info(f"Connecting ThingsBoardDevice {self.__class__.__name__}")
+        logging.info(f"Connecting ThingsBoardDevice {self.name}")
         if not self.client.is_connected():
             self.client.connect()
 
-    def publish(self):
-        logging.info(f"Publishing data for ThingsBoardDevice {self.__class__.__name__}")
-        self.connect()
-        attributes, telemetry = self.get_data()
-        if attributes:
-            logging.info(f"Sending attributes: {attributes}")
-            self.client.send_attributes(attributes)
+    def sample(self):
+        with instrumentation.timed("device_sample_seconds", device=self.name):
+            attributes, telemetry = self.get_data()
+        if attributes and attributes != self._last_attributes:
+            # Attributes rarely change, only send them when they do
+            if self.client.is_connected():
+                logging.info("Sending attributes: %s", attributes)
+                self.client.send_attributes(attributes)
+                self._last_attributes = attributes
         if telemetry:
-            logging.info(f"Sending telemetry: {telemetry}")
-            self.client.send_telemetry(telemetry)
+            self.add_telemetry(telemetry)
+
+    def add_telemetry(self, telemetry, ts=None):
+        # Sent with the next flush, and kept in the history
+        ts = int(time.time() * 1000) if ts is None else ts
+        self.pipeline.add(telemetry, ts)
+        if self.history is not None:
+            self.history.add(telemetry, ts, prefix=f"{self.name}/")
+
+    def flush(self, force=False):
+        with instrumentation.timed("device_flush_seconds", device=self.name):
+            self.pipeline.flush(force)
+
+    def publish(self):
+        logging.debug("Publishing data for ThingsBoardDevice %s", self.name)
+        self.sample()
+        self.flush(force=True)
+
+    def backfill(self, params):
+        """
+        Queues the telemetry of the history between params "start" and "end"
+        (ms, now by default) in the spool, from which it is sent again at
+        the pace of the broker acknowledgements, e.g. after an outage longer
+        than the spool holds.
+        """
+        if not isinstance(params, dict) or "start" not in params:
+            raise RpcError("Missing 'start' parameter")
+        self.history.flush()
+        batches = self.history.replay(
+            f"{self.name}/", int(params["start"]), params.get("end")
+        )
+        records = sum(len(batch) for batch in batches)
+        for batch in batches:
+            self.pipeline.spool_records(batch)
+        logging.info("Backfilling %d records of %s", records, self.name)
+        return {"records": records}
 
     def disconnect(self):
         self.client.disconnect()
 
 
 class TempHumDevice(ThingsBoardDevice):
-    devices = []
+    engine: SensorAcquisitionEngine = None
 
     def __init__(
         self,
         ACCESS_TOKEN,
-        states: dict = {},
-        rpc_callbacks: dict = {},
-        sensors_config=[
-            {"pin": D5, "label": "Top"},
-            {"pin": D6, "label": "Top-middle"},
-            {"pin": D13, "label": "Bottom-middle"},
-            {"pin": D19, "label": "Bottom"},
-        ],
+        states: dict = None,
+        rpc_callbacks: dict = None,
+        sensors_config=SENSORS,
+        aggregation_window=AGGREGATION_WINDOW,
+        engine: SensorAcquisitionEngine = None,
+        estimator: "DryingEstimator" = None,
+        **kwargs,
     ) -> None:
-        rpc_callbacks.update({"getTelemetry": "publish"})
-        # states.update({"blinkingPeriod": 1.0})
-        super().__init__(ACCESS_TOKEN, states, rpc_callbacks)
-
+        rpc_callbacks = {"getTelemetry": "publish", **(rpc_callbacks or {})}
+        states = {"aggregationWindow": float(aggregation_window), **(states or {})}
+        # Every reading goes through an aggregator, the telemetry only
+        # carries the statistics of each window. Set before the states are
+        # requested, which may change it.
+        self.aggregation_window = aggregation_window
+        super().__init__(ACCESS_TOKEN, states, rpc_callbacks, **kwargs)
+
+        self.labels = [sensor_config["label"] for sensor_config in sensors_config]
+        self.aggregators = {label: SensorAggregator() for label in self.labels}
+        # Fed with the mean humidity of each window
+        self.estimator = estimator
+        self._window_start = time.monotonic()
+        # Sensors stay open for the whole run and are read in the background.
+        # A shared engine (e.g. of a ZoneController) is started and stopped
+        # by its owner, and can already hold some of the sensors.
+        self._owns_engine = engine is None
+        self.engine = engine or SensorAcquisitionEngine()
         for sensor_config in sensors_config:
-            self.devices.append(
-                {
-                    "sensor": adafruit_dht.DHT22(
-                        sensor_config["pin"], use_pulseio=False
-                    ),
-                    "label": sensor_config["label"],
-                }
+            if sensor_config["label"] in self.engine.sensors:
+                continue
+            # A ready sensor object can be given instead of a pin
+            sensor = sensor_config.get("sensor") or backends.create(
+                "sensor",
+                sensor_config.get("backend", SENSOR_BACKEND),
+                sensor_config["pin"],
             )
+            self.engine.add_sensor(sensor_config["label"], sensor)
+        self.engine.subscribe(self.aggregate)
+        if self._owns_engine:
+            self.engine.start()
+
+    def aggregate(self, label, reading):
+        aggregator = self.aggregators.get(label)
+        # A shared engine also reads sensors of other devices
+        if aggregator is not None:
+            aggregator.add(reading.temperature, reading.humidity)
+
+    def subscribe_attributes(self):
+        super().subscribe_attributes()
+        self.attributes.subscribe("aggregationWindow", self._set_aggregation_window)
+
+    def _set_aggregation_window(self, key, old, new):
+        self.aggregation_window = new
 
     def get_data(self):
-        logging.info("Getting temp humidity telemetry")
-        telemetry = []
-        # import pdb; pdb.set_trace()
-        for device in self.devices:
-            try:
-                logging.info(f"Reading sensor {device['label']}")
-
-                temperature = device["sensor"].temperature
-                humidity = device["sensor"].humidity
-
-                if humidity is not None and temperature is not None:
-                    logging.info(
-                        "Temp={0:0.1f}C  Humidity={1:0.1f}%".format(
-                            temperature, humidity
-                        )
-                    )
-                else:
-                    logging.info("Failed to retrieve data from humidity sensor")
-
-                telemetry.append(
-                    {
-                        f"temperature_{device['label']}": temperature,
-                        f"humidity_{device['label']}": humidity,
-                    }
-                )
-            except RuntimeError as error:
-                # Errors happen fairly often, DHT's are hard to read, just keep going
-                logging.error(f"Failed reading sensor {device['label']}", exc_info=True)
-            except:
-                logging.error(
-                    f"Failed reading sensor {device['label']}. Deactivating",
-                    exc_info=True,
+        now = time.monotonic()
+        if now - self._window_start < self.aggregation_window:
+            return {}, {}
+        self._window_start = now
+
+        telemetry = {}
+        for label in self.labels:
+            window = self.aggregators[label].collect(label)
+            if f"temperature_{label}" not in window:
+                logging.warning(
+                    "No valid data from humidity sensor %s", label, extra=RATE_LIMITED
                 )
-                # try:
-                #     device["sensor"].exit()
-                # except:
-                #     logging.error(f"Failed deactivating sensor {device['label']}", exc_info=True)
-
-            finally:
-                # ✅
-                logging.info("Exiting sensor")
-                time.sleep(2.0)
-                try:
-                    device["sensor"].exit()
-                except:
-                    logging.error(
-                        f"Failed deactivating sensor {device['label']}", exc_info=True
-                    )
-
-        logging.info(f"Telemetry for temhumidity: {telemetry}")
+            telemetry.update(window)
+        if self.estimator is not None:
+            self.estimator.add(
+                {label: telemetry.get(f"humidity_{label}") for label in self.labels}
+            )
+            telemetry.update(self.estimator.telemetry())
+
+        logging.debug("Telemetry for temhumidity: %s", telemetry)
         return {}, telemetry
 
+    def disconnect(self):
+        if self._owns_engine:
+            self.engine.stop()
+        super().disconnect()
+
 
 class RPIDevice(ThingsBoardDevice):
     def __init__(
-        self, ACCESS_TOKEN, states: dict = {}, rpc_callbacks: dict = {}
+        self,
+        ACCESS_TOKEN,
+        states: dict = None,
+        rpc_callbacks: dict = None,
+        image_store=None,
+        camera_service: "CameraCaptureService" = None,
+        **kwargs,
     ) -> None:
-        rpc_callbacks.update({"getTelemetry": "publish"})
-        states.update({"blinkingPeriod": 1.0})
-        super().__init__(ACCESS_TOKEN, states, rpc_callbacks)
+        rpc_callbacks = {"getTelemetry": "publish", **(rpc_callbacks or {})}
+        states = {"blinkingPeriod": 1.0, **(states or {})}
+        # Files under /proc and /sys are kept open and re-read on every publish
+        self.sampler = SystemSampler()
+        self.image_store = image_store
+        # Its picture statistics are sent timestamped with the capture
+        self.camera_service = camera_service
+        super().__init__(ACCESS_TOKEN, states, rpc_callbacks, **kwargs)
 
     def get_data(self):
-        cpu_usage = round(
-            float(
-                os.popen(
-                    """grep 'cpu ' /proc/stat | awk '{usage=($2+$4)*100/($2+$4+$5)} END {print usage }' """
-                )
-                .readline()
-                .replace("\n", "")
-                .replace(",", ".")
-            ),
-            2,
-        )
-        ip_address = (
-            os.popen("""hostname -I""")
-            .readline()
-            .replace("\n", "")
-            .replace(",", ".")[:-1]
-        )
-        mac_address = (
-            os.popen("""cat /sys/class/net/*/address""")
-            .readline()
-            .replace("\n", "")
-            .replace(",", ".")
-        )
-        processes_count = (
-            os.popen("""ps -Al | grep -c bash""")
-            .readline()
-            .replace("\n", "")
-            .replace(",", ".")
-        )
-        swap_memory_usage = (
-            os.popen("free -m | grep Swap | awk '{print ($3/$2)*100}'")
-            .readline()
-            .replace("\n", "")
-            .replace(",", ".")
-        )
-        ram_usage = float(
-            os.popen("free -m | grep Mem | awk '{print ($3/$2) * 100}'")
-            .readline()
-            .replace("\n", "")
-            .replace(",", ".")[:-1]
-        )
-
-        disk_available = shutil.disk_usage("/").free / 1024 / 1024 / 1024
-        disk_used = shutil.disk_usage("/").used / 1024 / 1024 / 1024
-        boot_time = os.popen("uptime -p").read()[:-1]
-        avg_load = (cpu_usage + ram_usage) / 2
-        cpu_temp = float(
-            os.popen(
-                "cat /sys/class/thermal/thermal_zone0/temp | awk '{print $1/1000}'"
-            )
-            .readline()
-            .replace("\n", "")
-            .replace(",", ".")
-        )
-
-        gpu_temp = float(
-            os.popen("vcgencmd measure_temp | grep  -o -E '[[:digit:]].*'")
-            .readline()
-            .replace("\n", "")
-            .replace("'C", "")
-            .replace(",", ".")
-        )
-
-        attributes = {"ip_address": ip_address, "macaddress": mac_address}
-        telemetry = {
-            "cpu_usage": cpu_usage,
-            "processes_count": processes_count,
-            "disk_usage": disk_used,
-            "disk_available": disk_available,
-            "RAM_usage": ram_usage,
-            "swap_memory_usage": swap_memory_usage,
-            "boot_time": boot_time,
-            "avg_load": avg_load,
-            "cpu_temp": cpu_temp,
-            "gpu_temp": gpu_temp,
-        }
+        attributes = {"ip_address": ip_address(), "macaddress": mac_address()}
+        telemetry = self.sampler.sample()
+        if self.image_store is not None:
+            telemetry.update(self.image_store.usage())
+        if METRICS_TELEMETRY:
+            telemetry.update(instrumentation.telemetry())
         return attributes, telemetry
+
+    def sample(self):
+        super().sample()
+        if self.camera_service is not None:
+            for ts, telemetry in self.camera_service.collect_analysis():
+                self.add_telemetry(telemetry, ts)
@@ -0,0 +1,139 @@
+"""
+ThingsBoard gateway mode: all the devices share one MQTT connection.
+
+A Gateway holds a single TBGatewayMqttClient connection authenticated with
+a gateway access token, and `gateway.device(name)` returns a client with
+the TBDeviceMqttClient interface used by ThingsBoardDevice and
+TelemetryPipeline. The devices keep their states and RPC callbacks: the
+attribute updates and RPC requests received by the gateway are routed to
+the device they are for.
+
+    gateway = Gateway(os.getenv("THINGSBOARD_GATEWAY_ACCESS_TOKEN"))
+    th = TempHumDevice(None, name="TempHum", client=gateway.device("TempHum"))
+"""
+import logging
+import threading
+
+import backends
+from settings import MQTT_GATEWAY_BACKEND
+
+
+class Gateway:
+    def __init__(self, ACCESS_TOKEN=None, client=None) -> None:
+        # Any object with the TBGatewayMqttClient interface can be given
+        self.client = client or backends.create(
+            "mqtt", MQTT_GATEWAY_BACKEND, ACCESS_TOKEN
+        )
+        self.devices: dict[str, "GatewayDeviceClient"] = {}
+        self._lock = threading.Lock()
+        self._subscribed = False
+
+    def device(self, name, device_type="default") -> "GatewayDeviceClient":
+        with self._lock:
+            if name not in self.devices:
+                self.devices[name] = GatewayDeviceClient(self, name, device_type)
+            return self.devices[name]
+
+    def is_connected(self):
+        return self.client.is_connected()
+
+    def connect(self):
+        with self._lock:
+            if not self.client.is_connected():
+                logging.info("Connecting ThingsBoard gateway")
+                self.client.connect()
+            if not self._subscribed:
+                # One subscription for all the devices
+                self.client.gw_subscribe_to_all_attributes(self._on_attributes)
+                self.client.gw_set_server_side_rpc_request_handler(self._on_rpc)
+                self._subscribed = True
+
+    def disconnect(self, device=None):
+        with self._lock:
+            if device is not None:
+                device.connected = False
+            # The connection is closed with the last device
+            if not any(device.connected for device in self.devices.values()):
+                logging.info("Disconnecting ThingsBoard gateway")
+                self.client.disconnect()
+                self._subscribed = False
+
+    def _on_attributes(self, *args):
+        # content: {"device": name, "data": {key: value}}
+        content = args[-1]
+        device = self.devices.get(content.get("device"))
+        if device is None or device.attributes_callback is None:
+            logging.debug(f"Attributes for unknown device {content.get('device')}")
+            return
+        device.attributes_callback(content.get("data", {}), None)
+
+    def _on_rpc(self, *args):
+        # content: {"device": name, "data": {"id": id, "method": method, "params": params}}
+        content = args[-1]
+        device = self.devices.get(content.get("device"))
+        if device is None or device.rpc_handler is None:
+            logging.warning(f"RPC request for unknown device {content.get('device')}")
+            return
+        data = content.get("data", {})
+        device.rpc_handler(
+            data.get("id"), {"method": data.get("method"), "params": data.get("params")}
+        )
+
+
+class GatewayDeviceClient:
+    """
+    The part of the TBDeviceMqttClient interface used by the devices, sent
+    through the gateway connection on behalf of device `name`.
+    """
+
+    def __init__(self, gateway: Gateway, name, device_type="default") -> None:
+        self.gateway = gateway
+        self.name = name
+        self.device_type = device_type
+        self.connected = False
+        self.attributes_callback = None
+        self.rpc_handler = None
+
+    def is_connected(self):
+        return self.connected and self.gateway.is_connected()
+
+    def connect(self):
+        self.gateway.connect()
+        self.gateway.client.gw_connect_device(self.name, self.device_type)
+        self.connected = True
+
+    def disconnect(self):
+        self.gateway.client.gw_disconnect_device(self.name)
+        self.gateway.disconnect(self)
+
+    def send_telemetry(self, telemetry):
+        # A whole batch of [{"ts": ts, "values": {...}}] is one message
+        return self.gateway.client.gw_send_telemetry(self.name, telemetry)
+
+    def send_attributes(self, attributes):
+        return self.gateway.client.gw_send_attributes(self.name, attributes)
+
+    def subscribe_to_all_attributes(self, callback):
+        self.attributes_callback = callback
+
+    def request_attributes(self, client_keys=None, shared_keys=None, callback=None):
+        def on_response(result, exception=None):
+            if exception is not None or result is None:
+                callback(result, exception)
+                return
+            # A single key is returned as "value"
+            if "values" in result:
+                values = result["values"]
+            else:
+                values = {shared_keys[0]: result.get("value")}
+            callback({"shared": values}, None)
+
+        return self.gateway.client.gw_request_shared_attributes(
+            self.name, shared_keys or [], on_response
+        )
+
+    def set_server_side_rpc_request_handler(self, handler):
+        self.rpc_handler = handler
+
+    def send_rpc_reply(self, req_id, resp):
+        return self.gateway.client.gw_send_rpc_reply(self.name, req_id, resp)
@@ -0,0 +1,259 @@
+import json
+import os
+import time
+import logging
+from pathlib import Path
+
+import instrumentation
+from logging_setup import RATE_LIMITED
+from settings import (
+    PUBLISHING_INTERVAL,
+    RECONNECT_INTERVAL,
+    SPOOL_MAX_SEGMENTS,
+    SPOOL_SEGMENT_RECORDS,
+    TELEMETRY_ACK_TIMEOUT,
+    TELEMETRY_BATCH_SIZE,
+    TELEMETRY_DRAIN_TIME,
+)
+
+
+class SegmentRingBuffer:
+    """
+    Bounded FIFO of telemetry records stored on disk.
+
+    Records are appended as JSON lines to numbered segment files holding at
+    most `segment_records` records each. When there are more than
+    `max_segments` segments the oldest one is deleted, so the spool never
+    grows past a known size. Segments are only ever appended to and removed
+    whole, which keeps SD-card writes sequential.
+
+    Records are read back oldest first with `peek()` and removed with
+    `commit()` once they have been delivered. The read position is kept in
+    memory only: after a restart the oldest segment is sent again from the
+    start, which is harmless as ThingsBoard overwrites values with the same
+    key and timestamp.
+    """
+
+    def __init__(
+        self,
+        folder,
+        segment_records=SPOOL_SEGMENT_RECORDS,
+        max_segments=SPOOL_MAX_SEGMENTS,
+    ) -> None:
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+
+        self.segments = sorted(int(path.stem) for path in self.folder.glob("*.jsonl"))
+        self._read_offset = 0
+        # Records of the oldest segment, loaded lazily
+        self._head = None
+        # Number of records in the segment being written
+        self._tail_count = (
+            self._count_records(self.segments[-1]) if self.segments else 0
+        )
+
+    def __len__(self):
+        if not self.segments:
+            return 0
+        if len(self.segments) == 1:
+            return self._tail_count - self._read_offset
+        head_count = len(self._load_head())
+        middle = (len(self.segments) - 2) * self.segment_records
+        return head_count - self._read_offset + middle + self._tail_count
+
+    def _path(self, segment):
+        return self.folder / f"{segment:010d}.jsonl"
+
+    def _count_records(self, segment):
+        with open(self._path(segment), "rb") as f:
+            return sum(1 for _ in f)
+
+    def _load_head(self):
+        if self._head is None:
+            with open(self._path(self.segments[0])) as f:
+                self._head = [json.loads(line) for line in f if line.strip()]
+        return self._head
+
+    def append(self, records):
+        while records:
+            if not self.segments or self._tail_count >= self.segment_records:
+                self._new_segment()
+            room = self.segment_records - self._tail_count
+            chunk, records = records[:room], records[room:]
+            with open(self._path(self.segments[-1]), "a") as f:
+                f.write("".join(json.dumps(record) + "\n" for record in chunk))
+                f.flush()
+                os.fsync(f.fileno())
+            self._tail_count += len(chunk)
+            if len(self.segments) == 1:
+                self._head = None
+
+    def _new_segment(self):
+        segment = self.segments[-1] + 1 if self.segments else 0
+        self.segments.append(segment)
+        self._tail_count = 0
+        while len(self.segments) > self.max_segments:
+            dropped = self._drop_head()
+            logging.warning(f"Telemetry spool full, dropped {dropped} records")
+
+    def _drop_head(self):
+        dropped = len(self._load_head()) - self._read_offset
+        self._path(self.segments.pop(0)).unlink(missing_ok=True)
+        self._head = None
+        self._read_offset = 0
+        return dropped
+
+    def peek(self, count):
+        if not self.segments:
+            return []
+        return self._load_head()[self._read_offset : self._read_offset + count]
+
+    def commit(self, count):
+        self._read_offset += count
+        if self._read_offset >= len(self._load_head()):
+            is_tail = len(self.segments) == 1
+            self._drop_head()
+            if is_tail:
+                self._tail_count = 0
+
+
+class TelemetryPipeline:
+    """
+    Collects timestamped telemetry samples and sends them in batches.
+
+    Samples are queued with `add()` at the sampling rate and sent as one
+    `[{"ts": ..., "values": {...}}, ...]` message by `flush()` every
+    `flush_interval` seconds. While the client is disconnected samples are
+    moved to the on-disk spool. After reconnecting the spool is drained
+    oldest first, `batch_size` records per message, until it is empty, a
+    batch is not acknowledged within `ack_timeout` or `drain_time` is used
+    up. A batch is only removed from the spool once the broker acknowledged
+    it.
+    """
+
+    def __init__(
+        self,
+        client,
+        spool: SegmentRingBuffer = None,
+        reconnect=None,
+        flush_interval=PUBLISHING_INTERVAL,
+        batch_size=TELEMETRY_BATCH_SIZE,
+        reconnect_interval=RECONNECT_INTERVAL,
+        ack_timeout=TELEMETRY_ACK_TIMEOUT,
+        drain_time=TELEMETRY_DRAIN_TIME,
+    ) -> None:
+        self.client = client
+        self.spool = spool
+        self.reconnect = reconnect
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.reconnect_interval = reconnect_interval
+        self.ack_timeout = ack_timeout
+        self.drain_time = drain_time
+        self.pending = []
+        self._last_flush = 0
+        self._last_reconnect = 0
+
+    def add(self, values, ts=None):
+        if not values:
+            return
+        if ts is None:
+            ts = int(time.time() * 1000)
+        self.pending.append({"ts": ts, "values": values})
+        if len(self.pending) >= self.batch_size:
+            # Never keep more than one batch in memory
+            self._spool_pending()
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+
+        if not self.client.is_connected():
+            self._spool_pending()
+            self._try_reconnect(now)
+            return
+
+        if self.spool is not None and len(self.spool):
+            self._drain_spool()
+
+        if self.pending:
+            batch, self.pending = self.pending, []
+            if not self._send(batch):
+                self._spool_pending(batch)
+
+    def _drain_spool(self):
+        started = time.monotonic()
+        sent = 0
+        while len(self.spool) and time.monotonic() - started < self.drain_time:
+            batch = self.spool.peek(self.batch_size)
+            # Wait for the broker acknowledgement before removing from disk,
+            # so a backlog is never pushed faster than the link can take it
+            if not batch or not self._send(batch, wait=True):
+                break
+            self.spool.commit(len(batch))
+            sent += len(batch)
+        if sent:
+            logging.info("Sent %d spooled records, %d left", sent, len(self.spool))
+
+    def _send(self, batch, wait=False):
+        started = time.perf_counter()
+        try:
+            info = self.client.send_telemetry(batch)
+            if wait:
+                # Round trip up to the broker acknowledgement
+                sent = self._acknowledged(info)
+                instrumentation.observe(
+                    "telemetry_ack_seconds", time.perf_counter() - started
+                )
+                return sent
+            sent = info.rc() == 0
+            instrumentation.observe("telemetry_send_seconds", time.perf_counter() - started)
+            return sent
+        except Exception:
+            logging.error("Failed sending telemetry", exc_info=True, extra=RATE_LIMITED)
+            return False
+
+    def _acknowledged(self, info):
+        # rc is 0 for a message only queued, is_published() tells the ack
+        message_info = info.message_info
+        if message_info.rc != 0:
+            return False
+        try:
+            message_info.wait_for_publish(self.ack_timeout)
+        except (RuntimeError, ValueError):
+            # Not queued anymore, e.g. the connection was lost
+            return False
+        if not message_info.is_published():
+            logging.warning(
+                "No acknowledgement within %ss, keeping the spool", self.ack_timeout
+            )
+            return False
+        return True
+
+    def spool_records(self, records):
+        # Sent oldest first before the pending samples, e.g. a backfill
+        self._spool_pending(list(records))
+
+    def _spool_pending(self, records=None):
+        records = records if records is not None else self.pending
+        if records and self.spool is not None:
+            self.spool.append(records)
+        elif records:
+            logging.warning("No telemetry spool, dropping %d records", len(records))
+        if records is self.pending:
+            self.pending = []
+
+    def _try_reconnect(self, now):
+        if self.reconnect is None:
+            return
+        if now - self._last_reconnect < self.reconnect_interval:
+            return
+        self._last_reconnect = now
+        try:
+            self.reconnect()
+        except Exception:
+            logging.error("Reconnection failed", exc_info=True, extra=RATE_LIMITED)
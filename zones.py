@@ -0,0 +1,263 @@
+"""
+Several drying racks ("zones") driven from one process.
+
+Each zone owns its actuators, sensors, schedule and climate control loop,
+and keeps its state per instance: its schedule jobs are prefixed with the
+zone name and its running schedule is stored in its own state file. The
+zones share what is costly to duplicate on a Pi:
+
+- one scheduler, so all the schedule steps, intervals and climate ticks run
+  on a single thread pool and the cameras on its heavy one,
+- one SensorAcquisitionEngine reading the sensors of all the zones, whose
+  labels are prefixed with the zone name ("rack_1-Top"),
+- the actuators given to several zones (the same object, e.g. one camera
+  over the racks), scheduled by the first zone only,
+- one uplink: a single TempHumDevice publishes the sensors of every zone,
+  and the schedule RPC methods are prefixed with the zone name
+  ("rack_1/uploadSchedule").
+
+The zones of configs/zones.json (set ZONES_PATH to use it):
+
+    {
+      "zones": [
+        {
+          "name": "rack_1",
+          "schedule": "schedule.json",
+          "relays": {"heater": 23, "fan": 22},
+          "sensors": [{"pin": "D5", "label": "Top"}]
+        }
+      ]
+    }
+
+"schedule" is relative to the zones file, "relays" are the relay pins by
+actuator label and "sensors" has the format of SENSORS.
+"""
+import json
+import logging
+import time
+from pathlib import Path
+
+from apscheduler.schedulers.background import BackgroundScheduler
+
+import backends
+from actuators_control import ActuatorsControl
+from climate_control import ClimateController, engine_climate
+from job_dispatch import add_periodic, create_scheduler
+from rpc import schedule_commands
+from schedule_control import ScheduleControl
+from schedule_store import ScheduleStore
+from schedule_timeline import Timeline, load_schedule
+from sensor_engine import SensorAcquisitionEngine
+from settings import (
+    CONTROL_MODE,
+    SCHEDULE_STATE_PATH,
+    SCHEDULER_WORKERS,
+    SENSOR_BACKEND,
+)
+
+
+class Zone:
+    """
+    One rack: its ActuatorsControl, the labels of its sensors in the shared
+    engine, its ClimateController and its ScheduleControl.
+    """
+
+    def __init__(
+        self,
+        name,
+        timeline: Timeline,
+        actuators: ActuatorsControl,
+        scheduler,
+        engine: SensorAcquisitionEngine,
+        sensor_labels=(),
+        control_mode=CONTROL_MODE,
+        clock=time.monotonic,
+        **schedule_options,
+    ) -> None:
+        self.name = name
+        self.actuators = actuators
+        self.sensor_labels = list(sensor_labels)
+        self.scheduler = scheduler
+        self.clock = clock
+
+        self.climate = None
+        if self.sensor_labels and {"heater", "fan"} <= set(actuators.actuators_map):
+            self.climate = ClimateController(
+                actuators,
+                engine_climate(engine, labels=self.sensor_labels),
+                heater_id="heater",
+                fan_id="fan",
+                mode=control_mode,
+            )
+
+        if schedule_options.get("persistent", True):
+            schedule_options.setdefault(
+                "store",
+                ScheduleStore(
+                    SCHEDULE_STATE_PATH.with_name(f"schedule_state-{name}.json")
+                ),
+            )
+        self.schedule_control = ScheduleControl(
+            timeline,
+            scheduler=scheduler,
+            name=name,
+            actuators=actuators,
+            climate=self.climate,
+            **schedule_options,
+        )
+
+    @property
+    def _climate_job(self):
+        return f"{self.name}:climate-control"
+
+    def tick(self):
+        self.climate.tick(self.clock())
+
+    def start(self):
+        if self.climate and not self.scheduler.get_job(self._climate_job):
+            add_periodic(
+                self.scheduler,
+                self.tick,
+                self.climate.tick_interval,
+                id=self._climate_job,
+                now=self.schedule_control.clock(),
+            )
+
+    def stop(self):
+        # Also removes the climate job, as it is in the zone's job namespace
+        self.schedule_control.stop()
+
+    def clear(self):
+        self.schedule_control.clear()
+
+
+class ZoneController:
+    """
+    Runs the zones on a shared scheduler and SensorAcquisitionEngine.
+
+    It has the start/stop/clear interface of ScheduleControl, so it can be
+    given to the runtimes in its place.
+    """
+
+    def __init__(
+        self,
+        scheduler=None,
+        engine: SensorAcquisitionEngine = None,
+        max_workers=SCHEDULER_WORKERS,
+        clock=time.monotonic,
+    ) -> None:
+        self._owns_scheduler = scheduler is None
+        if scheduler is None:
+            scheduler = create_scheduler(BackgroundScheduler, max_workers)
+        self.scheduler = scheduler
+        self.engine = engine or SensorAcquisitionEngine()
+        self.clock = clock
+        self.zones: dict[str, Zone] = {}
+        # Zone driving each actuator object, by id: an actuator shared by
+        # zones (e.g. one camera) is only scheduled by the first one
+        self._actuator_zones = {}
+
+    def add_zone(
+        self,
+        name,
+        timeline: Timeline,
+        actuators: ActuatorsControl,
+        sensors_config=(),
+        **kwargs,
+    ) -> Zone:
+        """
+        Adds a zone reading the sensors of `sensors_config` (the format of
+        SENSORS, with a "pin" or a ready "sensor").
+        """
+        if not name or ":" in name:
+            raise ValueError(f"Invalid zone name {name!r}")
+        if name in self.zones:
+            raise ValueError(f"Zone {name} already exists")
+        labels = []
+        for sensor_config in sensors_config:
+            label = f"{name}-{sensor_config['label']}"
+            sensor = sensor_config.get("sensor") or backends.create(
+                "sensor",
+                sensor_config.get("backend", SENSOR_BACKEND),
+                sensor_config["pin"],
+            )
+            self.engine.add_sensor(label, sensor)
+            labels.append(label)
+
+        shared = set()
+        for label, actuator in actuators.actuators_map.items():
+            owner = self._actuator_zones.setdefault(id(actuator), name)
+            if owner != name:
+                logging.info(f"Actuator {label} of zone {name} is driven by zone {owner}")
+                shared.add(label)
+
+        zone = Zone(
+            name,
+            timeline,
+            actuators,
+            self.scheduler,
+            self.engine,
+            sensor_labels=labels,
+            clock=self.clock,
+            shared_actuators=shared,
+            **kwargs,
+        )
+        self.zones[name] = zone
+        logging.info(f"Added zone {name} with sensors {labels}")
+        return zone
+
+    @property
+    def sensors_config(self):
+        # For the TempHumDevice publishing all the zones
+        return [
+            {"label": label, "sensor": self.engine.sensors[label]}
+            for zone in self.zones.values()
+            for label in zone.sensor_labels
+        ]
+
+    def rpc_callbacks(self) -> dict:
+        # The schedule methods of every zone, e.g. "rack_1/getSchedule"
+        return {
+            f"{name}/{method}": callback
+            for name, zone in self.zones.items()
+            for method, callback in schedule_commands(zone.schedule_control).items()
+        }
+
+    def start(self):
+        if not self.scheduler.running:
+            logging.info(f"Starting scheduler")
+            self.scheduler.start()
+        self.engine.start()
+        for zone in self.zones.values():
+            zone.start()
+
+    def stop(self):
+        logging.info(f"Shutting down all zones")
+        for name, zone in self.zones.items():
+            try:
+                zone.stop()
+            except Exception:
+                logging.error(f"Failed stopping zone {name}", exc_info=True)
+        if self._owns_scheduler and self.scheduler.running:
+            self.scheduler.shutdown(wait=False)
+        self.engine.stop()
+
+    def clear(self):
+        for zone in self.zones.values():
+            zone.clear()
+
+
+def load_zones(path) -> list[dict]:
+    """
+    Reads the zones file, with the schedule of each zone loaded.
+    """
+    path = Path(path)
+    with open(path) as file:
+        zones = json.load(file)["zones"]
+    names = set()
+    for zone in zones:
+        if zone.get("name") in names:
+            raise ValueError(f"Duplicate zone {zone.get('name')}")
+        names.add(zone.get("name"))
+        zone["schedule"] = load_schedule(path.parent / zone["schedule"])
+    return zones